@@ -1,400 +1,4097 @@
 from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 import time
-from flask import Flask, render_template_string, request, jsonify, url_for, redirect
+from flask import Flask, Response, g, has_request_context, make_response, render_template, request, jsonify, url_for, redirect
 import subprocess
+import signal
 import sqlite3
 import json
-import requests
-from datetime import datetime
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.interval import IntervalTrigger
+import threading
+import uuid
+import socket
+import base64
+import zlib
+import hashlib
+import hmac
+import gzip
+import binascii
+import atexit
+import csv
+import io
+import struct
+import sys
+from array import array
+import click
+import queue
+import concurrent.futures
+from collections import OrderedDict, deque
+import math
+import itertools
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
 
 import logging
-from apscheduler.executors.pool import ThreadPoolExecutor
 
-def clear_and_reinitialize_executor():
-    if 'default' in scheduler._executors:
-        executor = scheduler._executors['default']
-        if executor._pool is not None:
-            executor.shutdown(wait=False)
-    new_executor = ThreadPoolExecutor(max_workers=1) 
-    scheduler._executors['default'] = new_executor
-
-    if not scheduler.running:
-        scheduler.start(paused=False)
-
-    print("Executor cleared and reinitialized.")
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
-DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'speedtest.db')
-LOCKFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'speedtest.lock')
+logging.basicConfig(level=os.environ.get('SPEEDTEST_LOG_LEVEL', 'INFO'))
+logging.getLogger('apscheduler').setLevel(os.environ.get('APSCHEDULER_LOG_LEVEL', 'WARNING'))
+
+# Importing this module only defines things: it touches no database, starts
+# no threads and leaves requests and APScheduler unimported, so tooling and
+# CLI commands load in milliseconds. create_app() (gunicorn runs
+# "app:create_app()") or the first request does the rest, once.
+startup = {"done": False, "timings": {}}
+startup_lock = threading.Lock()
+
+@app.before_request
+def ensure_started():
+    if not startup["done"]:
+        create_app()
+
+# Timing spans for routes, scheduler jobs and the phases inside them
+# (network, db, template, subprocess, lock). Disabled, span() hands back a
+# shared no-op context manager, so instrumented code pays one call.
+PERF_ENABLED = os.environ.get('SPEEDTEST_PERF', '0') not in ('', '0')
+SLOW_REQUEST_MS = float(os.environ.get('SPEEDTEST_SLOW_REQUEST_MS', 500))
+PERF_SAMPLES = 1000
+
+perf_samples = {}
+perf_lock = threading.Lock()
+no_span = nullcontext()
+
+def record_timing(name, seconds):
+    milliseconds = seconds * 1000
+    with perf_lock:
+        samples = perf_samples.get(name)
+        if samples is None:
+            samples = perf_samples[name] = deque(maxlen=PERF_SAMPLES)
+        samples.append(milliseconds)
+    if has_request_context():
+        phases = g.setdefault("perf_phases", {})
+        phases[name] = phases.get(name, 0.0) + milliseconds
+
+@contextmanager
+def timed_span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, time.perf_counter() - start)
+
+def span(name):
+    return timed_span(name) if PERF_ENABLED else no_span
+
+@app.before_request
+def start_request_timer():
+    if PERF_ENABLED:
+        g.perf_start = time.perf_counter()
+
+@app.after_request
+def record_request_timing(response):
+    start = g.pop("perf_start", None) if PERF_ENABLED else None
+    if start is not None:
+        elapsed = time.perf_counter() - start
+        record_timing(f"route:{request.endpoint}", elapsed)
+        if elapsed * 1000 >= SLOW_REQUEST_MS:
+            phases = ", ".join(f"{name}={ms:.1f}ms" for name, ms in g.get("perf_phases", {}).items() if not name.startswith("route:"))
+            app.logger.warning(f"Slow request {request.method} {request.path}: {elapsed * 1000:.1f}ms ({phases})")
+    return response
+
+DATABASE = os.environ.get('SPEEDTEST_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'speedtest.db'))
+# "memory" serialises tests within this process; "sqlite" adds a lease row
+# in the database so several worker processes share one test at a time.
+LOCK_BACKEND = os.environ.get('SPEEDTEST_LOCK_BACKEND', 'memory')
+# Every result is tagged with the site that measured it, so a collector can
+# hold many sites' results in one database.
+SITE_ID = os.environ.get('SPEEDTEST_SITE_ID', 'local')
+
+DB_POOL_SIZE = 8
+DB_BUSY_TIMEOUT = 5000
+DB_STATEMENT_CACHE = 256
+
+db_state = {"ready": False}
+db_init_lock = threading.Lock()
+
+db_pool = queue.LifoQueue()
+
+def open_db():
+    # check_same_thread is off because pooled connections move between
+    # threads; a connection is only ever used by the thread that checked it out.
+    conn = sqlite3.connect(
+        DATABASE,
+        timeout=DB_BUSY_TIMEOUT / 1000,
+        cached_statements=DB_STATEMENT_CACHE,
+        check_same_thread=False
+    )
+    # WAL lets readers proceed while the scheduler thread writes a result.
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT}')
+    conn.create_function("analytics_bin", 1, analytics_bin, deterministic=True)
+    return conn
+
+@contextmanager
+def get_db():
+    if not db_state["ready"]:
+        init_db()
+    try:
+        conn = db_pool.get_nowait()
+    except queue.Empty:
+        conn = open_db()
+    try:
+        with span("db"), conn:
+            yield conn
+    finally:
+        if db_pool.qsize() < DB_POOL_SIZE:
+            db_pool.put(conn)
+        else:
+            conn.close()
 
-scheduler = BackgroundScheduler()
-scheduler.start()
+# Bandwidth tests are serialised on test_executor, so the scheduler pool
+# only ever runs cheap work (dispatching tests, probes, catalog refresh).
+# Built on first use; start_background() starts it.
+scheduler = None
+scheduler_create_lock = threading.Lock()
+
+def get_scheduler():
+    global scheduler
+    if scheduler is None:
+        with scheduler_create_lock:
+            if scheduler is None:
+                from apscheduler.schedulers.background import BackgroundScheduler
+                from apscheduler.executors.pool import ThreadPoolExecutor
+                from apscheduler.events import EVENT_JOB_SUBMITTED
+                created = BackgroundScheduler(
+                    executors={'default': ThreadPoolExecutor(max_workers=10)},
+                    jobstores={'default': run_time_job_store()},
+                    # A run the scheduler wakes up late for (a paused worker
+                    # taking over, a stalled host) happens once, not once per
+                    # missed interval.
+                    job_defaults={'coalesce': True, 'misfire_grace_time': MISFIRE_GRACE if CATCHUP_POLICY == 'coalesce' else 1}
+                )
+                created.add_listener(record_last_run, EVENT_JOB_SUBMITTED)
+                if PERF_ENABLED:
+                    from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
+                    created.add_listener(record_job_timing, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+                scheduler = created
+    return scheduler
 
 DEFAULT_INTERVAL = 3600 
 
-def init_db():
-    with sqlite3.connect(DATABASE) as conn:
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS speedtest_results (
+ROLLUP_RESOLUTIONS = ("hour", "day", "week")
+ROLLUP_METRICS = ("download", "upload", "ping")
+ROLLUP_SPANS = {"hour": timedelta(hours=1), "day": timedelta(days=1), "week": timedelta(weeks=1)}
+
+def rollup_bucket(resolution, timestamp):
+    if resolution == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    start = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if resolution == "week":
+        start -= timedelta(days=start.weekday())
+    return start
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list.
+    return sorted_values[max(math.ceil(fraction * len(sorted_values)) - 1, 0)]
+
+def rollup_row(resolution, bucket, rows):
+    row = [resolution, str(bucket), len(rows)]
+    for index in range(len(ROLLUP_METRICS)):
+        values = sorted(r[index] for r in rows if r[index] is not None)
+        if values:
+            row.extend([values[0], sum(values) / len(values), values[-1], percentile(values, 0.95)])
+        else:
+            row.extend([None, None, None, None])
+    return row
+
+ROLLUP_COLUMNS = '''resolution, bucket, count,
+         download_min, download_avg, download_max, download_p95,
+         upload_min, upload_avg, upload_max, upload_p95,
+         ping_min, ping_avg, ping_max, ping_p95'''
+
+def write_rollups(conn, rollup_rows, site_id=None):
+    # With a site_id the rows go to that site's rollups instead of the
+    # rollups across all sites.
+    if site_id is None:
+        conn.executemany(f'''
+            INSERT OR REPLACE INTO speedtest_rollups ({ROLLUP_COLUMNS})
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rollup_rows)
+    else:
+        conn.executemany(f'''
+            INSERT OR REPLACE INTO site_rollups (site_id, {ROLLUP_COLUMNS})
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [[site_id] + row for row in rollup_rows])
+
+def bucket_rollup(conn, resolution, bucket, site_id=None):
+    query = 'SELECT download, upload, ping FROM speedtest_results WHERE timestamp >= ? AND timestamp < ?'
+    params = [str(bucket), str(bucket + ROLLUP_SPANS[resolution])]
+    if site_id is not None:
+        query += ' AND site_id = ?'
+        params.append(site_id)
+    rows = conn.execute(query, params).fetchall()
+    return rollup_row(resolution, bucket, rows) if rows else None
+
+def update_rollups(conn, timestamp, site_id=None):
+    # Only the buckets containing the new row change. Re-aggregating them
+    # from the timestamp index keeps p95 exact and costs at most one
+    # week of rows.
+    rollup_rows = [bucket_rollup(conn, resolution, rollup_bucket(resolution, timestamp), site_id) for resolution in ROLLUP_RESOLUTIONS]
+    write_rollups(conn, [row for row in rollup_rows if row], site_id)
+
+def rollup_pass(rows):
+    # Single ordered pass over (timestamp, download, upload, ping) rows.
+    buckets = {resolution: (None, []) for resolution in ROLLUP_RESOLUTIONS}
+    rollup_rows = []
+    for timestamp, *values in rows:
+        timestamp = datetime.fromisoformat(timestamp)
+        for resolution in ROLLUP_RESOLUTIONS:
+            bucket = rollup_bucket(resolution, timestamp)
+            current, bucket_rows = buckets[resolution]
+            if bucket != current:
+                if bucket_rows:
+                    rollup_rows.append(rollup_row(resolution, current, bucket_rows))
+                buckets[resolution] = current, bucket_rows = bucket, []
+            bucket_rows.append(values)
+    for resolution, (current, bucket_rows) in buckets.items():
+        if bucket_rows:
+            rollup_rows.append(rollup_row(resolution, current, bucket_rows))
+    return rollup_rows
+
+def rebuild_rollups(conn, since=None):
+    # Used to backfill existing data.
+    query = 'SELECT timestamp, download, upload, ping FROM speedtest_results'
+    params = ()
+    if since:
+        query += ' WHERE timestamp >= ?'
+        params = (str(rollup_bucket("week", since)),)
+    query += ' ORDER BY timestamp'
+    write_rollups(conn, rollup_pass(conn.execute(query, params)))
+
+def rebuild_site_rollups(conn, since=None, sites=None):
+    if sites is None:
+        sites = [row[0] for row in conn.execute('SELECT DISTINCT site_id FROM speedtest_results WHERE site_id IS NOT NULL')]
+    for site_id in sites:
+        query = 'SELECT timestamp, download, upload, ping FROM speedtest_results WHERE site_id = ?'
+        params = [site_id]
+        if since:
+            query += ' AND timestamp >= ?'
+            params.append(str(rollup_bucket("week", since)))
+        query += ' ORDER BY timestamp'
+        write_rollups(conn, rollup_pass(conn.execute(query, params)), site_id)
+
+def tag_local_site(conn):
+    conn.execute('UPDATE speedtest_results SET site_id = ? WHERE site_id IS NULL', (SITE_ID,))
+
+# Per-day and per-month histograms of every result for /api/analytics, so
+# percentiles over months of history sum a few bins instead of sorting
+# every row. Bin b holds values in (ratio**(b-1), ratio**b], which puts a
+# percentile read from the bins within 1% of the exact one. Values of 0 or
+# less share a bin.
+ANALYTICS_BIN_RATIO = 1.02
+ANALYTICS_ZERO_BIN = -1 << 20
+# Each family breaks the results down by its grp expression. NULL server
+# IDs are stored as -1 because key columns cannot be NULL. server_hour
+# packs both into one grp, server_id * 24 + hour, for the hourly view of a
+# single server.
+ANALYTICS_GROUPS = {
+    "server": "COALESCE(server_id, -1)",
+    "hour": "CAST(substr(timestamp, 12, 2) AS INTEGER)",
+    "server_hour": "COALESCE(server_id, -1) * 24 + CAST(substr(timestamp, 12, 2) AS INTEGER)"
+}
+# Each span keys its bins by the date it starts on.
+ANALYTICS_SPANS = {
+    "day": "substr(timestamp, 1, 10)",
+    "month": "substr(timestamp, 1, 7) || '-01'"
+}
+
+def analytics_bin(value):
+    if value <= 0:
+        return ANALYTICS_ZERO_BIN
+    return math.ceil(math.log(value, ANALYTICS_BIN_RATIO))
+
+def analytics_bin_value(index):
+    # The point off both bin edges by the same ratio.
+    if index == ANALYTICS_ZERO_BIN:
+        return 0.0
+    return 2 * ANALYTICS_BIN_RATIO ** index / (ANALYTICS_BIN_RATIO + 1)
+
+def count_analytics(conn, where, params, sign=1, spans=tuple(ANALYTICS_SPANS), families=tuple(ANALYTICS_GROUPS)):
+    # Adds the matching results to the histograms, or takes them out with
+    # sign=-1 before they are deleted. The span of time they cover is
+    # logged so each worker only drops the cached analytics it touches.
+    for family, span, metric in itertools.product(families, spans, ROLLUP_METRICS):
+        conn.execute(f'''
+            INSERT INTO analytics_bins (family, span, start, site_id, grp, metric, bin, count, total)
+            SELECT '{family}', '{span}', {ANALYTICS_SPANS[span]}, COALESCE(site_id, ''), {ANALYTICS_GROUPS[family]}, '{metric}',
+                   analytics_bin({metric}), {sign} * COUNT(*), {sign} * SUM({metric})
+            FROM speedtest_results
+            WHERE {where} AND {metric} IS NOT NULL
+            GROUP BY 3, 4, 5, 7
+            ON CONFLICT DO UPDATE SET count = count + excluded.count, total = total + excluded.total
+        ''', params)
+    conn.execute(f'''
+        INSERT INTO analytics_changes (since, until, recorded)
+        SELECT MIN(timestamp), MAX(timestamp), ? FROM speedtest_results
+        WHERE {where} HAVING COUNT(*) > 0
+    ''', (str(datetime.now()), *params))
+
+def rebuild_analytics_bins(conn, families=tuple(ANALYTICS_GROUPS)):
+    # The month bins are summed from the day bins, not from every result.
+    marks = ', '.join('?' * len(families))
+    conn.execute(f'DELETE FROM analytics_bins WHERE family IN ({marks})', families)
+    count_analytics(conn, "1", (), spans=("day",), families=families)
+    conn.execute(f'''
+        INSERT INTO analytics_bins (family, span, start, site_id, grp, metric, bin, count, total)
+        SELECT family, 'month', substr(start, 1, 7) || '-01', site_id, grp, metric, bin, SUM(count), SUM(total)
+        FROM analytics_bins WHERE span = 'day' AND family IN ({marks})
+        GROUP BY family, 3, site_id, grp, metric, bin
+    ''', families)
+
+def rebuild_server_hour_bins(conn):
+    rebuild_analytics_bins(conn, ("server_hour",))
+
+def enable_incremental_vacuum(conn):
+    # auto_vacuum can only be switched on an existing database by a full
+    # VACUUM, which cannot run inside a transaction, so init_db() calls
+    # this after the migrations have committed rather than as one of them.
+    # Once switched, it returns straight away.
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return
+    conn.commit()
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    app.logger.info("Switched the database to incremental vacuum")
+
+# Schema changes applied on top of the tables created in init_db(). Each
+# entry is one schema version (tracked in PRAGMA user_version) made of SQL
+# statements or callables taking the connection; append, never reorder.
+MIGRATIONS = [
+    [
+        'CREATE INDEX IF NOT EXISTS idx_results_timestamp ON speedtest_results (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_results_server_timestamp ON speedtest_results (server_id, timestamp)',
+    ],
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS speedtest_rollups (
+                resolution TEXT NOT NULL,
+                bucket DATETIME NOT NULL,
+                count INTEGER NOT NULL,
+                download_min REAL,
+                download_avg REAL,
+                download_max REAL,
+                download_p95 REAL,
+                upload_min REAL,
+                upload_avg REAL,
+                upload_max REAL,
+                upload_p95 REAL,
+                ping_min REAL,
+                ping_avg REAL,
+                ping_max REAL,
+                ping_p95 REAL,
+                PRIMARY KEY (resolution, bucket)
+            ) WITHOUT ROWID
+        ''',
+        rebuild_rollups,
+    ],
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS test_lease (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                owner TEXT,
+                pid INTEGER,
+                host TEXT,
+                expires_at REAL
+            )
+        ''',
+        'INSERT OR IGNORE INTO test_lease (id) VALUES (1)',
+    ],
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS speedtest_raw (
+                result_id INTEGER PRIMARY KEY,
+                codec TEXT NOT NULL,
+                payload BLOB NOT NULL
+            )
+        ''',
+        'ALTER TABLE speedtest_results ADD COLUMN jitter REAL',
+        'ALTER TABLE speedtest_results ADD COLUMN packet_loss REAL',
+        'ALTER TABLE speedtest_results ADD COLUMN download_bytes INTEGER',
+        'ALTER TABLE speedtest_results ADD COLUMN upload_bytes INTEGER',
+        'ALTER TABLE speedtest_results ADD COLUMN download_elapsed INTEGER',
+        'ALTER TABLE speedtest_results ADD COLUMN upload_elapsed INTEGER',
+        'ALTER TABLE speedtest_results ADD COLUMN download_latency_iqm REAL',
+        'ALTER TABLE speedtest_results ADD COLUMN upload_latency_iqm REAL',
+        'ALTER TABLE speedtest_results ADD COLUMN isp TEXT',
+        'ALTER TABLE speedtest_results ADD COLUMN interface TEXT',
+    ],
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS schedules (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT,
+                kind TEXT NOT NULL DEFAULT 'speedtest',
+                server_id INTEGER,
+                interface TEXT,
+                interval INTEGER NOT NULL,
+                jitter INTEGER NOT NULL DEFAULT 0,
+                enabled INTEGER NOT NULL DEFAULT 1
+            )
+        ''',
+    ],
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS probe_results (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 timestamp DATETIME,
-                download REAL,
-                upload REAL,
-                ping REAL,
-                url TEXT,
+                target TEXT,
                 server_id INTEGER,
-                server_name TEXT
+                latency REAL,
+                jitter REAL,
+                loss REAL
             )
-        ''')
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_probe_results_timestamp ON probe_results (timestamp)',
+        'ALTER TABLE schedules ADD COLUMN target TEXT',
+    ],
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS retention_policies (
+                name TEXT PRIMARY KEY,
+                max_age_days INTEGER
+            )
+        ''',
+        '''
+            INSERT OR IGNORE INTO retention_policies (name, max_age_days)
+            VALUES ('results', NULL), ('raw', NULL), ('probes', 7),
+                   ('rollups_hour', NULL), ('rollups_day', NULL), ('rollups_week', NULL)
+        ''',
+    ],
+    [
+        # Lets imports skip results that are already stored.
+        'CREATE INDEX IF NOT EXISTS idx_results_url ON speedtest_results (url)',
+    ],
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS scheduler_lease (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                owner TEXT,
+                pid INTEGER,
+                host TEXT,
+                expires_at REAL,
+                revision INTEGER NOT NULL DEFAULT 0
+            )
+        ''',
+        'INSERT OR IGNORE INTO scheduler_lease (id) VALUES (1)',
+        '''
+            CREATE TABLE IF NOT EXISTS content_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''',
+        "INSERT OR IGNORE INTO content_versions (name) VALUES ('results'), ('settings')",
+        '''
+            CREATE TABLE IF NOT EXISTS test_jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                source TEXT NOT NULL,
+                server_id INTEGER,
+                interface TEXT,
+                created DATETIME,
+                started DATETIME,
+                finished DATETIME,
+                progress TEXT,
+                result_id INTEGER,
+                error TEXT,
+                cause TEXT
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_test_jobs_created ON test_jobs (created)',
+        "INSERT OR IGNORE INTO retention_policies (name, max_age_days) VALUES ('jobs', 90)",
+    ],
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS baselines (
+                server_id INTEGER NOT NULL,
+                metric TEXT NOT NULL,
+                season INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                ewma REAL,
+                ewm_var REAL,
+                median REAL,
+                mad REAL,
+                degraded INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (server_id, metric, season)
+            ) WITHOUT ROWID
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS alerts (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp DATETIME,
+                result_id INTEGER,
+                server_id INTEGER,
+                metric TEXT,
+                kind TEXT,
+                value REAL,
+                baseline REAL,
+                score REAL,
+                message TEXT,
+                delivered INTEGER NOT NULL DEFAULT 0
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_alerts_timestamp ON alerts (timestamp)',
+        "INSERT OR IGNORE INTO retention_policies (name, max_age_days) VALUES ('alerts', NULL)",
+    ],
+    [
+        'ALTER TABLE settings ADD COLUMN adaptive INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE settings ADD COLUMN max_interval INTEGER',
+        'ALTER TABLE settings ADD COLUMN current_interval INTEGER',
+    ],
+    [
+        'ALTER TABLE test_jobs ADD COLUMN attempts INTEGER',
+        '''
+            CREATE TABLE IF NOT EXISTS job_cancellations (
+                job_id TEXT PRIMARY KEY,
+                requested TEXT
+            )
+        ''',
+    ],
+    [
+        'ALTER TABLE speedtest_results ADD COLUMN site_id TEXT',
+        tag_local_site,
+        'CREATE INDEX IF NOT EXISTS idx_results_site_timestamp ON speedtest_results (site_id, timestamp)',
+        '''
+            CREATE TABLE IF NOT EXISTS site_rollups (
+                site_id TEXT NOT NULL,
+                resolution TEXT NOT NULL,
+                bucket DATETIME NOT NULL,
+                count INTEGER NOT NULL,
+                download_min REAL,
+                download_avg REAL,
+                download_max REAL,
+                download_p95 REAL,
+                upload_min REAL,
+                upload_avg REAL,
+                upload_max REAL,
+                upload_p95 REAL,
+                ping_min REAL,
+                ping_avg REAL,
+                ping_max REAL,
+                ping_p95 REAL,
+                PRIMARY KEY (site_id, resolution, bucket)
+            ) WITHOUT ROWID
+        ''',
+        rebuild_site_rollups,
+        '''
+            CREATE TABLE IF NOT EXISTS rollup_dirty (
+                site_id TEXT NOT NULL,
+                resolution TEXT NOT NULL,
+                bucket DATETIME NOT NULL,
+                PRIMARY KEY (site_id, resolution, bucket)
+            ) WITHOUT ROWID
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS push_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                last_result_id INTEGER NOT NULL DEFAULT 0,
+                last_push TEXT,
+                last_error TEXT
+            )
+        ''',
+        'INSERT OR IGNORE INTO push_state (id) VALUES (1)',
+        '''
+            CREATE TABLE IF NOT EXISTS ingest_batches (
+                key TEXT PRIMARY KEY,
+                site_id TEXT,
+                received TEXT,
+                read INTEGER,
+                imported INTEGER
+            )
+        ''',
+        "INSERT OR IGNORE INTO retention_policies (name, max_age_days) VALUES ('ingest_batches', 30)",
+        '''
+            INSERT OR IGNORE INTO retention_policies (name, max_age_days)
+            SELECT 'site_' || name, max_age_days FROM retention_policies WHERE name LIKE 'rollups_%'
+        ''',
+    ],
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS schedule_runs (
+                job_id TEXT PRIMARY KEY,
                 interval INTEGER,
-                server_id INTEGER
+                last_run DATETIME,
+                next_run DATETIME
+            ) WITHOUT ROWID
+        ''',
+    ],
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS metric_counters (
+                counter TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (counter, key)
+            ) WITHOUT ROWID
+        ''',
+    ],
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS analytics_bins (
+                family TEXT NOT NULL,
+                span TEXT NOT NULL,
+                start TEXT NOT NULL,
+                site_id TEXT NOT NULL,
+                grp INTEGER NOT NULL,
+                metric TEXT NOT NULL,
+                bin INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                total REAL NOT NULL,
+                PRIMARY KEY (family, span, start, site_id, grp, metric, bin)
+            ) WITHOUT ROWID
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS analytics_changes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                since DATETIME,
+                until DATETIME,
+                recorded TEXT
+            )
+        ''',
+        rebuild_analytics_bins,
+        # Covers scheduled_availability(), which counts every job in the window.
+        'CREATE INDEX IF NOT EXISTS idx_test_jobs_scheduled ON test_jobs (source, status, created, cause, server_id)',
+    ],
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS push_rejected (
+                first_id INTEGER PRIMARY KEY,
+                last_id INTEGER NOT NULL,
+                status INTEGER,
+                error TEXT,
+                rejected TEXT
             )
+        ''',
+    ],
+    [
+        rebuild_server_hour_bins,
+    ],
+]
+
+# Rebuilding rollups or vacuuming a large history can hold the write lock
+# for minutes, far beyond DB_BUSY_TIMEOUT.
+MIGRATION_LOCK_TIMEOUT = 30 * 60 * 1000
+
+def migrate_db(conn):
+    # Workers started together race to migrate. Each version is applied
+    # under the write lock after re-reading user_version, so none runs twice.
+    while True:
+        conn.commit()
+        conn.execute('BEGIN IMMEDIATE')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(MIGRATIONS):
+            conn.commit()
+            return
+        for step in MIGRATIONS[version]:
+            if callable(step):
+                step(conn)
+            else:
+                conn.execute(step)
+        conn.execute(f'PRAGMA user_version = {version + 1}')
+        conn.commit()
+        app.logger.info(f"Database migrated to schema version {version + 1}")
+
+def init_db():
+    # Runs on the first get_db(); later calls return straight away.
+    with db_init_lock:
+        if db_state["ready"]:
+            return
+        conn = open_db()
+        # Workers that lose the race wait for the winner's migrations
+        # instead of failing with "database is locked".
+        conn.execute(f'PRAGMA busy_timeout={MIGRATION_LOCK_TIMEOUT}')
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS speedtest_results (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp DATETIME,
+                    download REAL,
+                    upload REAL,
+                    ping REAL,
+                    url TEXT,
+                    server_id INTEGER,
+                    server_name TEXT
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS settings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    interval INTEGER,
+                    server_id INTEGER
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS global_cooldown (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    last_test_time DATETIME
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS server_catalog (
+                    id INTEGER PRIMARY KEY,
+                    fetched_at REAL,
+                    payload TEXT
+                )
+            ''')
+            conn.execute('''
+                INSERT OR IGNORE INTO settings (id, interval, server_id)
+                VALUES (1, ?, ?)
+            ''', (DEFAULT_INTERVAL, None))
+            conn.execute('''
+                INSERT OR IGNORE INTO global_cooldown (id, last_test_time)
+                VALUES (1, ?)
+            ''', (datetime.now(),))
+            conn.commit()
+            migrate_db(conn)
+            enable_incremental_vacuum(conn)
+        finally:
+            conn.close()
+        db_state["ready"] = True
+
+COOLDOWN_PERIOD = 300
+def get_last_test_time():
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT last_test_time FROM global_cooldown WHERE id = 1')
+        row = cursor.fetchone()
+        if row and row[0]:
+            try:
+                return datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S.%f')
+            except ValueError:
+                return None
+        return None
+
+def update_last_test_time():
+    with get_db() as conn:
+        conn.execute('''
+            UPDATE global_cooldown
+            SET last_test_time = ?
+            WHERE id = 1
+        ''', (datetime.now(),))
+        conn.commit()
+
+LEASE_TTL = 600
+LEASE_POLL_INTERVAL = 1.0
+# How long a job waits for a test running in another worker before failing.
+LEASE_WAIT = 300
+
+# A running test renews its lease this often, so retries that take longer
+# than LEASE_TTL keep it while a dead worker's lease still expires.
+LEASE_RENEW_INTERVAL = LEASE_TTL / 4
+
+test_lock = threading.Lock()
+lease_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+peer_lease = {"locked": False, "checked": 0.0}
+test_lease = {"renewed": 0.0}
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def claim_lease(table, ttl):
+    # Takes a free or expired lease row, or extends one this process holds.
+    now = time.time()
+    with get_db() as conn:
+        row = conn.execute(f'SELECT owner, pid, host, expires_at FROM {table} WHERE id = 1').fetchone()
+        if (row and row[0] and row[0] != lease_owner and row[3] > now
+                and row[2] == socket.gethostname() and not pid_alive(row[1])):
+            # The holder died on this host; reclaim without waiting for expiry.
+            app.logger.warning(f"Reclaiming {table} from dead process {row[1]}")
+            conn.execute(f'UPDATE {table} SET owner = NULL WHERE id = 1 AND owner = ?', (row[0],))
+        acquired = conn.execute(f'''
+            UPDATE {table}
+            SET owner = ?, pid = ?, host = ?, expires_at = ?
+            WHERE id = 1 AND (owner IS NULL OR owner = ? OR expires_at <= ?)
+        ''', (lease_owner, os.getpid(), socket.gethostname(), now + ttl, lease_owner, now)).rowcount == 1
+    return acquired
+
+def release_lease(table):
+    with get_db() as conn:
+        conn.execute(f'UPDATE {table} SET owner = NULL, expires_at = NULL WHERE id = 1 AND owner = ?', (lease_owner,))
+
+def try_test_lock():
+    if not test_lock.acquire(blocking=False):
+        return False
+    if LOCK_BACKEND == 'sqlite':
+        try:
+            with span("lock"):
+                acquired = claim_lease('test_lease', LEASE_TTL)
+        except sqlite3.Error as e:
+            app.logger.error(f"Could not acquire test lease: {e}")
+            acquired = False
+        peer_lease["checked"] = 0.0
+        if not acquired:
+            test_lock.release()
+            return False
+        test_lease["renewed"] = time.monotonic()
+    return True
+
+def renew_test_lock():
+    # Called from the loops that wait on a running test.
+    if LOCK_BACKEND != 'sqlite' or not test_lock.locked():
+        return
+    now = time.monotonic()
+    if now - test_lease["renewed"] < LEASE_RENEW_INTERVAL:
+        return
+    test_lease["renewed"] = now
+    try:
+        if not claim_lease('test_lease', LEASE_TTL):
+            app.logger.warning("The test lease was taken over by another worker")
+    except sqlite3.Error as e:
+        app.logger.error(f"Could not renew test lease: {e}")
+
+def acquire_test_lock(wait=0, cancelled=None):
+    deadline = time.monotonic() + wait
+    while not try_test_lock():
+        if time.monotonic() >= deadline or (cancelled and cancelled()):
+            return False
+        time.sleep(LEASE_POLL_INTERVAL)
+    return True
+
+def release_test_lock():
+    try:
+        if LOCK_BACKEND == 'sqlite':
+            release_lease('test_lease')
+            peer_lease["checked"] = 0.0
+    finally:
+        test_lock.release()
+
+def is_locked():
+    if test_lock.locked():
+        return True
+    if LOCK_BACKEND != 'sqlite':
+        return False
+    # Another worker may hold the lease; look at most once per poll interval.
+    now = time.time()
+    if now - peer_lease["checked"] >= LEASE_POLL_INTERVAL:
+        with get_db() as conn:
+            row = conn.execute('''
+                SELECT 1 FROM test_lease WHERE id = 1 AND owner IS NOT NULL AND expires_at > ?
+            ''', (now,)).fetchone()
+        peer_lease["locked"] = row is not None
+        peer_lease["checked"] = now
+    return peer_lease["locked"]
+
+SERVERS_URL = os.environ.get('SPEEDTEST_SERVERS_URL', "https://www.speedtest.net/api/js/servers?engine=js&limit=10&https_functional=true")
+SERVERS_TTL = 3600
+SERVERS_TIMEOUT = (3.05, 10)
+SERVERS_RETRY = 60
+
+http = None
+
+def get_http():
+    global http
+    if http is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=1))
+        http = session
+    return http
+
+server_cache = {"servers": None, "fetched_at": 0.0, "attempted_at": 0.0}
+server_refresh_lock = threading.Lock()
+
+def load_server_cache():
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT fetched_at, payload FROM server_catalog WHERE id = 1')
+        row = cursor.fetchone()
+    if row:
+        try:
+            server_cache["servers"] = json.loads(row[1])
+            server_cache["fetched_at"] = row[0]
+        except (TypeError, ValueError):
+            pass
+
+def refresh_servers():
+    import requests
+    if not server_refresh_lock.acquire(blocking=False):
+        return
+    server_cache["attempted_at"] = time.time()
+    try:
+        with span("network"):
+            response = get_http().get(SERVERS_URL, timeout=SERVERS_TIMEOUT)
+        response.raise_for_status()
+        servers = response.json()
+        if not isinstance(servers, list):
+            raise ValueError("Unexpected servers payload")
+        fetched_at = time.time()
+        server_cache["servers"] = servers
+        server_cache["fetched_at"] = fetched_at
+        with get_db() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO server_catalog (id, fetched_at, payload)
+                VALUES (1, ?, ?)
+            ''', (fetched_at, json.dumps(servers)))
+            conn.commit()
+    except (requests.RequestException, ValueError) as e:
+        app.logger.warning(f"Server catalog refresh failed: {e}")
+    finally:
+        server_refresh_lock.release()
+
+def servers_stale():
+    return time.time() - server_cache["fetched_at"] > SERVERS_TTL
+
+def get_servers():
+    # Never blocks on the network: serve whatever is cached (possibly stale,
+    # possibly empty on a cold start) and revalidate in the background.
+    if (servers_stale() and not server_refresh_lock.locked()
+            and time.time() - server_cache["attempted_at"] > SERVERS_RETRY):
+        # Marked before the job runs, so requests arriving until it starts
+        # do not queue another one.
+        server_cache["attempted_at"] = time.time()
+        if scheduler_state["leader"]:
+            get_scheduler().add_job(refresh_servers, id='refresh_servers_now', replace_existing=True)
+        else:
+            # The leader refreshes the catalog; pick up what it stored.
+            load_server_cache()
+    return server_cache["servers"] or []
+
+class SpeedtestError(Exception):
+    def __init__(self, message, cause="cli_error"):
+        super().__init__(message)
+        self.cause = cause
+
+PROGRESS_PHASES = ("ping", "download", "upload")
+# Path to the Ookla CLI; bench/fake_speedtest.py stands in for it in benchmarks.
+SPEEDTEST_BIN = os.environ.get('SPEEDTEST_BIN', 'speedtest')
+FAKE_SPEEDTEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench', 'fake_speedtest.py')
+# "ookla" (the CLI above), "iperf3" (against SPEEDTEST_IPERF3_SERVER) or
+# "fake" (bench/fake_speedtest.py).
+SPEEDTEST_BACKEND = os.environ.get('SPEEDTEST_BACKEND', 'ookla')
+IPERF3_SERVER = os.environ.get('SPEEDTEST_IPERF3_SERVER')
+IPERF3_PORT = 5201
+IPERF3_SECONDS = 10
+# A test process that runs longer than this is killed with its children.
+SPEEDTEST_TIMEOUT = int(os.environ.get('SPEEDTEST_TIMEOUT', 120))
+TERMINATE_GRACE = 5
+
+def progress_event(event):
+    phase = event.get("type")
+    if phase not in PROGRESS_PHASES:
+        return None
+    details = event.get(phase, {})
+    progress = {"phase": phase, "progress": details.get("progress")}
+    if phase == "ping":
+        progress["latency"] = details.get("latency")
+    elif details.get("bandwidth") is not None:
+        progress["bandwidth"] = details["bandwidth"] / 125000
+    return progress
+
+def run_speedtest(server_id=None, on_progress=None, interface=None, cancelled=None):
+    backend = RUNNER_BACKENDS.get(SPEEDTEST_BACKEND)
+    if backend is None:
+        raise SpeedtestError(f"Unknown speedtest backend: {SPEEDTEST_BACKEND}", cause="config")
+    with span("subprocess"):
+        return backend(server_id, on_progress, interface, cancelled)
+
+def kill_process_group(process):
+    # The CLI may fork helpers that hold the pipe open; signal the whole group.
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(TERMINATE_GRACE)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def watch_process(process, outcome, cancelled):
+    deadline = time.monotonic() + SPEEDTEST_TIMEOUT
+    while process.poll() is None:
+        if cancelled and cancelled():
+            outcome["cause"] = "cancelled"
+        elif time.monotonic() >= deadline:
+            outcome["cause"] = "timeout"
+        else:
+            renew_test_lock()
+            time.sleep(min(LEASE_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+            continue
+        kill_process_group(process)
+        return
+
+def run_process(command, on_line, cancelled=None):
+    # stderr is folded into stdout so the pipe is drained as a single stream.
+    # The process gets its own session so a timeout or cancellation can
+    # kill everything it started.
+    try:
+        process = subprocess.Popen(
+            command,
+            text=True,
+            bufsize=1,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True
+        )
+    except OSError as e:
+        raise SpeedtestError(f"Could not start {command[0]}: {e}", cause="cli_error")
+    outcome = {"cause": None}
+    watchdog = threading.Thread(target=watch_process, args=(process, outcome, cancelled), name='speedtest-watchdog', daemon=True)
+    watchdog.start()
+    with process.stdout:
+        for line in process.stdout:
+            line = line.strip()
+            if line:
+                on_line(line)
+    returncode = process.wait()
+    watchdog.join()
+    if outcome["cause"] == "timeout":
+        raise SpeedtestError(f"Speedtest timed out after {SPEEDTEST_TIMEOUT} seconds.", cause="timeout")
+    if outcome["cause"] == "cancelled":
+        raise SpeedtestError("The test was cancelled.", cause="cancelled")
+    return returncode
+
+def read_speedtest_output(command, on_progress, cancelled=None):
+    # Lines that are not JSON are kept for the error message.
+    data = None
+    error_message = None
+    other_output = []
+
+    def on_line(line):
+        nonlocal data, error_message
+        try:
+            event = json.loads(line)
+        except json.JSONDecodeError:
+            other_output.append(line)
+            return
+        if event.get("type") == "result":
+            data = event
+        elif event.get("type") == "log" and event.get("level") == "error":
+            error_message = event.get("message", "Speedtest failed: Unknown error")
+        elif on_progress:
+            progress = progress_event(event)
+            if progress:
+                on_progress(progress)
+
+    returncode = run_process(command, on_line, cancelled)
+
+    if returncode != 0 or data is None:
+        raise SpeedtestError(
+            error_message or "\n".join(other_output) or "Speedtest failed: Unknown error",
+            cause="cli_error" if returncode != 0 else "no_result"
+        )
+
+    return data
+
+def ookla_command(binary, server_id=None, interface=None):
+    command = binary + [
+        "--accept-gdpr",
+        "--accept-license",
+        "--format=jsonl",
+        "--progress=yes"
+    ]
+
+    if server_id:
+        command.extend(["-s", str(server_id)])
+    if interface:
+        command.append(f"--interface={interface}")
+    return command
+
+def run_ookla(server_id=None, on_progress=None, interface=None, cancelled=None):
+    return read_speedtest_output(ookla_command([SPEEDTEST_BIN], server_id, interface), on_progress, cancelled)
+
+def run_fake(server_id=None, on_progress=None, interface=None, cancelled=None):
+    return read_speedtest_output(ookla_command([sys.executable, FAKE_SPEEDTEST], server_id, interface), on_progress, cancelled)
+
+def run_iperf3(server_id=None, on_progress=None, interface=None, cancelled=None):
+    # iperf3 measures against one known server, so server_id is ignored. The
+    # result is shaped like the Ookla CLI's so it is stored the same way.
+    if not IPERF3_SERVER:
+        raise SpeedtestError("SPEEDTEST_IPERF3_SERVER is not set.", cause="config")
+    host, port = parse_host_port(IPERF3_SERVER, IPERF3_PORT)
+    latency, jitter, loss = measure_latency(host, port)
+    if latency is None:
+        raise SpeedtestError(f"iperf3 server {host}:{port} is unreachable.", cause="cli_error")
+    if on_progress:
+        on_progress({"phase": "ping", "progress": 1.0, "latency": latency})
+    data = {
+        "type": "result",
+        "timestamp": datetime.now().isoformat(),
+        "ping": {"latency": latency, "jitter": jitter},
+        "interface": {"name": interface},
+        "server": {"id": None, "host": host, "port": port, "name": f"iperf3 {host}"},
+        "result": {"id": uuid.uuid4().hex, "url": f"iperf3://{host}:{port}/{uuid.uuid4().hex}", "persisted": False}
+    }
+    for phase in ("download", "upload"):
+        command = ["iperf3", "--client", host, "--port", str(port), "--json", "--time", str(IPERF3_SECONDS)]
+        if phase == "download":
+            command.append("--reverse")
+        if interface:
+            command.append(f"--bind-dev={interface}")
+        output = []
+        returncode = run_process(command, output.append, cancelled)
+        try:
+            report = json.loads("\n".join(output))
+        except json.JSONDecodeError:
+            raise SpeedtestError("\n".join(output) or "iperf3 failed: Unknown error", cause="no_result")
+        received = dig(report, "end", "sum_received")
+        if returncode != 0 or report.get("error") or not received:
+            raise SpeedtestError(report.get("error") or "iperf3 failed: Unknown error", cause="cli_error" if returncode != 0 else "no_result")
+        # Ookla reports bandwidth in bytes per second.
+        data[phase] = {
+            "bandwidth": received["bits_per_second"] / 8,
+            "bytes": received["bytes"],
+            "elapsed": int(received["seconds"] * 1000)
+        }
+        if on_progress:
+            on_progress({"phase": phase, "progress": 1.0, "bandwidth": received["bits_per_second"] / 1e6})
+    return data
+
+RUNNER_BACKENDS = {
+    "ookla": run_ookla,
+    "iperf3": run_iperf3,
+    "fake": run_fake,
+}
+
+def dig(data, *path):
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+# Columns derived from the full CLI result. Every raw result is archived in
+# speedtest_raw, so a metric added here (plus a migration adding its column)
+# can be filled in for past tests with backfill_derived_metrics().
+DERIVED_METRICS = {
+    "jitter": lambda data: dig(data, "ping", "jitter"),
+    "packet_loss": lambda data: dig(data, "packetLoss"),
+    "download_bytes": lambda data: dig(data, "download", "bytes"),
+    "upload_bytes": lambda data: dig(data, "upload", "bytes"),
+    "download_elapsed": lambda data: dig(data, "download", "elapsed"),
+    "upload_elapsed": lambda data: dig(data, "upload", "elapsed"),
+    "download_latency_iqm": lambda data: dig(data, "download", "latency", "iqm"),
+    "upload_latency_iqm": lambda data: dig(data, "upload", "latency", "iqm"),
+    "isp": lambda data: dig(data, "isp"),
+    "interface": lambda data: dig(data, "interface", "name"),
+}
+
+def compress_raw(data):
+    return "zlib", zlib.compress(json.dumps(data, separators=(",", ":")).encode(), 9)
+
+def decompress_raw(codec, payload):
+    if codec != "zlib":
+        raise ValueError(f"Unknown raw result codec: {codec}")
+    return json.loads(zlib.decompress(payload))
+
+def save_result(data, timestamp):
+    server_info = data.get('server', {})
+    columns = ["timestamp", "download", "upload", "ping", "url", "server_id", "server_name"] + list(DERIVED_METRICS) + ["site_id"]
+    values = [
+        timestamp,
+        data['download']['bandwidth'] / 125000,
+        data['upload']['bandwidth'] / 125000,
+        data['ping']['latency'],
+        data['result']['url'],
+        server_info.get('id'),
+        server_info.get('name')
+    ] + [extract(data) for extract in DERIVED_METRICS.values()] + [SITE_ID]
+
+    with get_db() as conn:
+        result_id = conn.execute(f'''
+            INSERT INTO speedtest_results 
+            ({', '.join(columns)})
+            VALUES ({', '.join('?' * len(columns))})
+        ''', values).lastrowid
+        conn.execute(
+            'INSERT INTO speedtest_raw (result_id, codec, payload) VALUES (?, ?, ?)',
+            (result_id, *compress_raw(data))
+        )
+        update_rollups(conn, timestamp)
+        update_rollups(conn, timestamp, SITE_ID)
+        count_analytics(conn, "id = ?", (result_id,))
+        alerts = detect_anomalies(conn, result_id, server_info.get('id'), timestamp, dict(zip(columns, values)))
+        conn.commit()
+    record_result_metrics(server_info.get('id'), server_info.get('name'), timestamp, dict(zip(columns, values)))
+    bump_content_version("results")
+    notify_alerts(alerts)
+    return result_id
+
+def load_raw_result(result_id):
+    with get_db() as conn:
+        row = conn.execute('SELECT codec, payload FROM speedtest_raw WHERE result_id = ?', (result_id,)).fetchone()
+    return decompress_raw(*row) if row else None
+
+def backfill_derived_metrics(metrics=None, batch_size=500):
+    metrics = list(metrics or DERIVED_METRICS)
+    assignments = ", ".join(f"{metric} = ?" for metric in metrics)
+    last_id = 0
+    updated = 0
+    while True:
+        with get_db() as conn:
+            rows = conn.execute('''
+                SELECT result_id, codec, payload FROM speedtest_raw
+                WHERE result_id > ? ORDER BY result_id LIMIT ?
+            ''', (last_id, batch_size)).fetchall()
+            if not rows:
+                return updated
+            updates = []
+            for result_id, codec, payload in rows:
+                data = decompress_raw(codec, payload)
+                updates.append([DERIVED_METRICS[metric](data) for metric in metrics] + [result_id])
+            conn.executemany(f'UPDATE speedtest_results SET {assignments} WHERE id = ?', updates)
+        updated += len(rows)
+        last_id = rows[-1][0]
+
+@app.cli.command("backfill-metrics")
+def backfill_metrics_command():
+    updated = backfill_derived_metrics()
+    print(f"Backfilled derived metrics for {updated} archived results.")
+
+# Anomaly detection. Every saved result updates per-server baselines in
+# O(1), without rescanning history: an EWMA and its variance, a streaming
+# (frugal) median and MAD, and the same per hour of day (season 0-23;
+# season -1 covers all hours). The result is judged against the baselines
+# as they stood before it arrived.
+ANOMALY_METRICS = {"download": -1, "upload": -1, "ping": 1}  # sign of "worse"
+ANOMALY_UNITS = {"download": "Mbps", "upload": "Mbps", "ping": "ms"}
+BASELINE_ALPHA = 0.2
+BASELINE_WARMUP_RATE = 0.2
+BASELINE_MEDIAN_RATE = 0.02
+BASELINE_SPREAD_FLOOR = 0.05
+ALERT_MIN_SAMPLES = 20
+ALERT_SEASONAL_MIN_SAMPLES = 8
+ALERT_Z = float(os.environ.get('SPEEDTEST_ALERT_Z', 4))
+ALERT_DRIFT = float(os.environ.get('SPEEDTEST_ALERT_DRIFT', 0.25))
+# Fixed limits; 0 disables. Download/upload are minimums, ping a maximum.
+ALERT_THRESHOLDS = {
+    "download": float(os.environ.get('SPEEDTEST_ALERT_MIN_DOWNLOAD', 0)),
+    "upload": float(os.environ.get('SPEEDTEST_ALERT_MIN_UPLOAD', 0)),
+    "ping": float(os.environ.get('SPEEDTEST_ALERT_MAX_PING', 0))
+}
+ALERT_WEBHOOK = os.environ.get('SPEEDTEST_ALERT_WEBHOOK')
+ALERT_WEBHOOK_TIMEOUT = (3.05, 10)
+ALERT_WEBHOOK_ATTEMPTS = 3
+BASELINE_FIELDS = ("count", "ewma", "ewm_var", "median", "mad", "degraded")
+ALERT_FIELDS = ("id", "timestamp", "result_id", "server_id", "metric", "kind", "value", "baseline", "score", "message", "delivered")
+
+alert_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='alerts')
+
+def new_baseline():
+    return {"count": 0, "ewma": None, "ewm_var": 0.0, "median": None, "mad": 0.0, "degraded": 0}
+
+def spread_floor(level):
+    # Keeps scores finite on a perfectly steady link.
+    return BASELINE_SPREAD_FLOOR * abs(level or 0) or 1e-9
+
+def update_baseline(baseline, value):
+    if not baseline["count"]:
+        baseline.update(count=1, ewma=value, ewm_var=0.0, median=value, mad=0.0)
+        return
+    delta = value - baseline["ewma"]
+    baseline["ewma"] += BASELINE_ALPHA * delta
+    baseline["ewm_var"] = (1 - BASELINE_ALPHA) * (baseline["ewm_var"] + BASELINE_ALPHA * delta * delta)
+    # Frugal estimates move a step towards the sample, sized by the spread;
+    # larger steps while warming up so the first days converge quickly.
+    rate = BASELINE_WARMUP_RATE if baseline["count"] < ALERT_MIN_SAMPLES else BASELINE_MEDIAN_RATE
+    step = rate * max(baseline["mad"], spread_floor(baseline["median"]))
+    if value > baseline["median"]:
+        baseline["median"] += step
+    elif value < baseline["median"]:
+        baseline["median"] -= step
+    if abs(value - baseline["median"]) > baseline["mad"]:
+        baseline["mad"] += step
+    else:
+        baseline["mad"] = max(baseline["mad"] - step, 0.0)
+    baseline["count"] += 1
+
+def describe(metric, value):
+    return f"{metric} {value:.1f} {ANOMALY_UNITS[metric]}"
+
+def score_anomalies(metric, value, overall, seasonal):
+    worse = ANOMALY_METRICS[metric]
+    found = []
+    threshold = ALERT_THRESHOLDS[metric]
+    if threshold and (value - threshold) * worse > 0:
+        found.append(("threshold", threshold, None,
+                      f"{describe(metric, value)} is {'above' if worse > 0 else 'below'} the {threshold:g} limit"))
+    if overall["count"] >= ALERT_MIN_SAMPLES:
+        z = (value - overall["median"]) / (1.4826 * max(overall["mad"], spread_floor(overall["median"])))
+        if z * worse > ALERT_Z:
+            found.append(("deviation", overall["median"], z,
+                          f"{describe(metric, value)} is {abs(z):.1f} robust SDs from the median {overall['median']:.1f}"))
+    if seasonal["count"] >= ALERT_SEASONAL_MIN_SAMPLES:
+        z = (value - seasonal["ewma"]) / max(math.sqrt(seasonal["ewm_var"]), spread_floor(seasonal["ewma"]))
+        if z * worse > ALERT_Z:
+            found.append(("seasonal", seasonal["ewma"], z,
+                          f"{describe(metric, value)} is {abs(z):.1f} SDs from the usual {seasonal['ewma']:.1f} at this hour"))
+    return found
+
+def degradation_change(metric, overall):
+    # The EWMA follows the last few results, the median the long run: a
+    # sustained gap between them is a degradation, reported once.
+    if overall["count"] < ALERT_MIN_SAMPLES:
+        return None
+    drift = (overall["ewma"] - overall["median"]) / (abs(overall["median"]) or 1e-9) * ANOMALY_METRICS[metric]
+    if drift > ALERT_DRIFT and not overall["degraded"]:
+        overall["degraded"] = 1
+        return ("degradation", overall["median"], drift,
+                f"{metric} has been {drift:.0%} worse than the median {overall['median']:.1f} {ANOMALY_UNITS[metric]} over recent tests")
+    if drift < ALERT_DRIFT / 2 and overall["degraded"]:
+        overall["degraded"] = 0
+        return ("recovered", overall["median"], drift, f"{metric} is back near the median {overall['median']:.1f} {ANOMALY_UNITS[metric]}")
+    return None
+
+def write_baselines(conn, baselines):
+    conn.executemany(f'''
+        INSERT OR REPLACE INTO baselines (server_id, metric, season, {', '.join(BASELINE_FIELDS)})
+        VALUES (?, ?, ?, {', '.join('?' * len(BASELINE_FIELDS))})
+    ''', [key + tuple(baseline[field] for field in BASELINE_FIELDS) for key, baseline in baselines.items()])
+
+def detect_anomalies(conn, result_id, server_id, timestamp, values):
+    server_key = server_id or 0
+    hour = timestamp.hour
+    rows = conn.execute(f'''
+        SELECT metric, season, {', '.join(BASELINE_FIELDS)} FROM baselines
+        WHERE server_id = ? AND season IN (-1, ?)
+    ''', (server_key, hour)).fetchall()
+    baselines = {(server_key, metric, season): dict(zip(BASELINE_FIELDS, rest)) for metric, season, *rest in rows}
+    alerts = []
+    for metric in ANOMALY_METRICS:
+        value = values.get(metric)
+        if value is None:
+            continue
+        overall = baselines.setdefault((server_key, metric, -1), new_baseline())
+        seasonal = baselines.setdefault((server_key, metric, hour), new_baseline())
+        found = score_anomalies(metric, value, overall, seasonal)
+        update_baseline(overall, value)
+        update_baseline(seasonal, value)
+        change = degradation_change(metric, overall)
+        if change:
+            found.append(change)
+        for kind, baseline, score, message in found:
+            alerts.append({
+                "timestamp": str(timestamp), "result_id": result_id, "server_id": server_id, "metric": metric,
+                "kind": kind, "value": value, "baseline": baseline, "score": score, "message": message, "delivered": 0
+            })
+    write_baselines(conn, baselines)
+    fields = ALERT_FIELDS[1:]
+    for alert in alerts:
+        alert["id"] = conn.execute(
+            f"INSERT INTO alerts ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})",
+            [alert[field] for field in fields]
+        ).lastrowid
+    return alerts
+
+def rebuild_baselines():
+    # One pass over the history, for results stored before detection existed
+    # or brought in by import.
+    baselines = {}
+    with get_db() as conn:
+        rows = conn.execute('SELECT server_id, timestamp, download, upload, ping FROM speedtest_results ORDER BY timestamp')
+        for server_id, timestamp, *metric_values in rows:
+            hour = datetime.fromisoformat(timestamp).hour
+            for metric, value in zip(ANOMALY_METRICS, metric_values):
+                if value is None:
+                    continue
+                for season in (-1, hour):
+                    update_baseline(baselines.setdefault((server_id or 0, metric, season), new_baseline()), value)
+                # Carry the degraded flag forward without raising old alerts.
+                degradation_change(metric, baselines[(server_id or 0, metric, -1)])
+        conn.execute('DELETE FROM baselines')
+        write_baselines(conn, baselines)
+    return len(baselines)
+
+@app.cli.command("rebuild-baselines")
+def rebuild_baselines_command():
+    count = rebuild_baselines()
+    print(f"Rebuilt {count} anomaly baselines from the stored results.")
+
+def deliver_alerts(alerts):
+    import requests
+    for attempt in range(ALERT_WEBHOOK_ATTEMPTS):
+        try:
+            get_http().post(ALERT_WEBHOOK, json={"alerts": alerts}, timeout=ALERT_WEBHOOK_TIMEOUT).raise_for_status()
+            break
+        except requests.RequestException as e:
+            app.logger.warning(f"Alert webhook failed (attempt {attempt + 1}/{ALERT_WEBHOOK_ATTEMPTS}): {e}")
+            if attempt + 1 < ALERT_WEBHOOK_ATTEMPTS:
+                time.sleep(2 ** attempt)
+    else:
+        return
+    ids = [alert["id"] for alert in alerts]
+    with get_db() as conn:
+        conn.execute(f"UPDATE alerts SET delivered = 1 WHERE id IN ({', '.join('?' * len(ids))})", ids)
+
+def notify_alerts(alerts):
+    if not alerts:
+        return
+    count_metrics([("alerts", (alert["metric"], alert["kind"]), 1) for alert in alerts])
+    for alert in alerts:
+        app.logger.warning(f"Alert for server {alert['server_id']}: {alert['message']}")
+        publish_event("alert", alert)
+    # Delivery retries with backoff, so it must never hold up the test.
+    if ALERT_WEBHOOK:
+        alert_executor.submit(deliver_alerts, alerts)
+
+# In-memory snapshot served by /metrics. It is updated as results are
+# written so a scrape never touches SQLite. With the sqlite lock backend
+# tests run in whichever worker took them, so the counters are kept in
+# metric_counters and every worker refreshes its copy from there (see
+# sync_worker_state), or each worker would report its own totals and a
+# scrape landing on another one would look like a counter reset.
+DURATION_BUCKETS = (15, 20, 25, 30, 40, 50, 60, 90, 120, 180)
+
+metrics_lock = threading.Lock()
+metrics = {
+    "latest": {},
+    "duration_buckets": [0] * len(DURATION_BUCKETS),
+    "duration_sum": 0.0,
+    "duration_count": 0,
+    "tests": {},
+    "failures": {},
+    "alerts": {},
+    "retries": {},
+    "db_bytes": 0
+}
+
+def database_file_size():
+    return sum(os.path.getsize(path) for path in (DATABASE, DATABASE + "-wal") if os.path.exists(path))
+
+def record_result_metrics(server_id, server_name, timestamp, values):
+    with metrics_lock:
+        metrics["latest"][server_id] = {
+            "server_name": server_name,
+            "timestamp": timestamp.timestamp(),
+            "download": values["download"],
+            "upload": values["upload"],
+            "ping": values["ping"],
+            "jitter": values.get("jitter")
+        }
+        metrics["db_bytes"] = database_file_size()
+
+COUNTERS = ("tests", "failures", "alerts", "retries", "duration_buckets", "duration_sum", "duration_count")
+counters_sync_lock = threading.Lock()
+
+def counter_key(counter, key):
+    # How a counter's key is stored in metric_counters.
+    if counter == "alerts":
+        return "|".join(key)
+    return "" if key is None else str(key)
+
+def add_counter(snapshot, counter, key, amount):
+    if counter in ("duration_sum", "duration_count"):
+        snapshot[counter] += amount
+    elif counter == "duration_buckets":
+        snapshot[counter][key] += amount
+    else:
+        snapshot[counter][key] = snapshot[counter].get(key, 0) + amount
+
+def count_metrics(increments):
+    # increments: (counter, key, amount) tuples.
+    if LOCK_BACKEND != 'sqlite':
+        with metrics_lock:
+            for counter, key, amount in increments:
+                add_counter(metrics, counter, key, amount)
+        return
+    # Write, then reload under one lock, so this worker's totals never step
+    # back past an increment it has already shown.
+    with counters_sync_lock:
+        try:
+            with get_db() as conn:
+                conn.executemany('''
+                    INSERT INTO metric_counters (counter, key, value) VALUES (?, ?, ?)
+                    ON CONFLICT (counter, key) DO UPDATE SET value = value + excluded.value
+                ''', [(counter, counter_key(counter, key), amount) for counter, key, amount in increments])
+        except sqlite3.Error as e:
+            app.logger.warning(f"Could not save metric counters: {e}")
+        load_metric_counters()
+
+def load_metric_counters():
+    with get_db() as conn:
+        rows = conn.execute('SELECT counter, key, value FROM metric_counters').fetchall()
+    snapshot = {
+        "tests": {}, "failures": {}, "alerts": {}, "retries": {},
+        "duration_buckets": [0] * len(DURATION_BUCKETS), "duration_sum": 0.0, "duration_count": 0
+    }
+    for counter, key, value in rows:
+        if counter == "alerts":
+            key = tuple(key.split("|", 1))
+        elif counter == "duration_buckets":
+            key = int(key)
+            if key >= len(DURATION_BUCKETS):
+                continue
+        elif counter not in COUNTERS:
+            continue
+        add_counter(snapshot, counter, key, value if counter == "duration_sum" else int(value))
+    with metrics_lock:
+        metrics.update(snapshot)
+
+def record_test_metrics(source, duration=None, failure=None):
+    increments = [("tests", source, 1)]
+    if failure:
+        increments.append(("failures", failure, 1))
+    if duration is not None:
+        increments += [("duration_buckets", index, 1) for index, bound in enumerate(DURATION_BUCKETS) if duration <= bound]
+        increments += [("duration_sum", None, duration), ("duration_count", None, 1)]
+    count_metrics(increments)
+
+def load_metrics_snapshot():
+    with get_db() as conn:
+        rows = conn.execute('''
+            SELECT server_id, server_name, timestamp, download, upload, ping, jitter
+            FROM speedtest_results
+            WHERE id IN (SELECT MAX(id) FROM speedtest_results GROUP BY server_id)
+        ''').fetchall()
+    for server_id, server_name, timestamp, download, upload, ping, jitter in rows:
+        record_result_metrics(server_id, server_name, datetime.fromisoformat(timestamp), {
+            "download": download, "upload": upload, "ping": ping, "jitter": jitter
+        })
+    with metrics_lock:
+        metrics["db_bytes"] = database_file_size()
+
+MAX_JOB_HISTORY = 100
+SSE_KEEPALIVE = 15
+
+event_subscribers = set()
+event_subscribers_lock = threading.Lock()
+
+def subscribe_events(subscriber=None):
+    # Anything with put_nowait() can subscribe; asgi.py hands events to its
+    # event loop this way.
+    subscriber = subscriber or queue.Queue(maxsize=256)
+    with event_subscribers_lock:
+        event_subscribers.add(subscriber)
+    return subscriber
+
+def unsubscribe_events(subscriber):
+    with event_subscribers_lock:
+        event_subscribers.discard(subscriber)
+
+def publish_event(event_type, payload):
+    with event_subscribers_lock:
+        subscribers = list(event_subscribers)
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait((event_type, payload))
+        except queue.Full:
+            # A stalled client must not hold up the test; it just misses events.
+            pass
+
+def job_event(job):
+    return {key: job[key] for key in ("id", "status", "source", "server_id", "interface", "error")}
+
+jobs = OrderedDict()
+jobs_lock = threading.Lock()
+test_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='speedtest')
+
+# Every job is also written to test_jobs, so any worker can answer for a
+# job another worker runs and the outcome history outlives `jobs`.
+JOB_FIELDS = ("id", "status", "source", "server_id", "interface", "created", "started", "finished", "progress", "result_id", "error", "cause", "attempts")
+JOB_PROGRESS_SAVE_INTERVAL = 1.0
+# A job still queued or running after this long belonged to a dead worker.
+JOB_STALE_AFTER = LEASE_WAIT + LEASE_TTL
+
+def save_job(job):
+    values = [json.dumps(job[field]) if field == "progress" and job[field] else job[field] for field in JOB_FIELDS]
+    try:
+        with get_db() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO test_jobs ({', '.join(JOB_FIELDS)}) VALUES ({', '.join('?' * len(JOB_FIELDS))})",
+                values
+            )
+    except sqlite3.Error as e:
+        app.logger.error(f"Could not save job {job['id']}: {e}")
+
+def load_job(job_id=None, active=False):
+    query = f"SELECT {', '.join(JOB_FIELDS)} FROM test_jobs"
+    if active:
+        query += " WHERE status IN ('queued', 'running') AND created >= ? ORDER BY created DESC LIMIT 1"
+        params = ((datetime.now() - timedelta(seconds=JOB_STALE_AFTER)).isoformat(),)
+    else:
+        query += " WHERE id = ?"
+        params = (job_id,)
+    with get_db() as conn:
+        row = conn.execute(query, params).fetchone()
+    if row is None:
+        return None
+    job = dict(zip(JOB_FIELDS, row))
+    job["progress"] = json.loads(job["progress"]) if job["progress"] else None
+    return job
+
+def find_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        job = load_job(job_id)
+        if job:
+            job["result"] = load_raw_result(job["result_id"]) if job["result_id"] else None
+    return job
+
+def fail_abandoned_jobs():
+    cutoff = (datetime.now() - timedelta(seconds=JOB_STALE_AFTER)).isoformat()
+    with get_db() as conn:
+        conn.execute('''
+            UPDATE test_jobs
+            SET status = 'failed', cause = 'abandoned', error = 'The worker running this job stopped.', finished = ?
+            WHERE status IN ('queued', 'running') AND created < ?
+        ''', (datetime.now().isoformat(), cutoff))
+        conn.execute('''
+            DELETE FROM job_cancellations
+            WHERE job_id NOT IN (SELECT id FROM test_jobs WHERE status IN ('queued', 'running'))
         ''')
+
+def active_jobs():
+    return [job for job in jobs.values() if job["status"] in ("queued", "running")]
+
+def active_job():
+    for job in reversed(jobs.values()):
+        if job["status"] in ("queued", "running"):
+            return job
+    if LOCK_BACKEND == 'sqlite':
+        return load_job(active=True)
+    return None
+
+def normalize_server_id(server_id):
+    return int(server_id) if server_id and str(server_id).isdigit() else None
+
+def create_job(server_id=None, source="manual", interface=None):
+    # Only one test may use the link at a time. A manual request that
+    # arrives while a job is queued or running is coalesced onto it; a
+    # scheduled one only when it targets the same server and interface,
+    # otherwise it queues behind the current job.
+    server_id = normalize_server_id(server_id)
+    interface = interface or None
+    with jobs_lock:
+        for job in active_jobs():
+            if source == "manual" or (job["server_id"], job["interface"]) == (server_id, interface):
+                return job, False
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "source": source,
+            "server_id": server_id,
+            "interface": interface,
+            "created": datetime.now().isoformat(),
+            "started": None,
+            "finished": None,
+            "progress": None,
+            "result": None,
+            "result_id": None,
+            "error": None,
+            "cause": None,
+            "attempts": 0
+        }
+        jobs[job["id"]] = job
+        while len(jobs) > MAX_JOB_HISTORY:
+            jobs.popitem(last=False)
+        save_job(job)
+        publish_event("job", job_event(job))
+        return job, True
+
+job_futures = {}
+cancel_requests = set()
+
+def start_job(job):
+    job_futures[job["id"]] = test_executor.submit(run_job, job)
+
+def submit_job(server_id=None, source="manual", interface=None):
+    job, created = create_job(server_id, source, interface)
+    if created:
+        start_job(job)
+    return job, created
+
+def job_cancelled(job_id):
+    if job_id in cancel_requests:
+        return True
+    if LOCK_BACKEND == 'sqlite':
+        with get_db() as conn:
+            if conn.execute('SELECT 1 FROM job_cancellations WHERE job_id = ?', (job_id,)).fetchone():
+                cancel_requests.add(job_id)
+                return True
+    return False
+
+def cancel_job(job_id):
+    # A job still waiting in this worker's executor is dropped at once; a
+    # running one is stopped by its watchdog. Jobs owned by another worker
+    # are flagged in job_cancellations for that worker to pick up.
+    job = jobs.get(job_id)
+    if job is None:
+        job = load_job(job_id)
+        if job and job["status"] in ("queued", "running") and LOCK_BACKEND == 'sqlite':
+            with get_db() as conn:
+                conn.execute('INSERT OR IGNORE INTO job_cancellations (job_id, requested) VALUES (?, ?)',
+                             (job_id, datetime.now().isoformat()))
+        return job
+    if job["status"] not in ("queued", "running"):
+        return job
+    future = job_futures.pop(job_id, None)
+    if future and future.cancel():
+        fail_job(job, "The test was cancelled.", "cancelled")
+    else:
+        cancel_requests.add(job_id)
+    return job
+
+def fail_job(job, error, cause):
+    job["status"] = "failed"
+    job["error"] = error
+    job["cause"] = cause
+    job["finished"] = datetime.now().isoformat()
+    record_test_metrics(job["source"], failure=cause)
+    save_job(job)
+    publish_event("job", job_event(job))
+
+SPEEDTEST_ATTEMPTS = int(os.environ.get('SPEEDTEST_ATTEMPTS', 3))
+RETRY_BACKOFF = 5
+RETRYABLE_CAUSES = ("cli_error", "no_result", "timeout")
+
+def failover_servers(server_id):
+    # The requested server (or the CLI's own choice) first, then the nearest
+    # servers from the catalog.
+    servers = [server_id]
+    for server in server_cache["servers"] or []:
+        candidate = normalize_server_id(server.get("id"))
+        if candidate and candidate not in servers:
+            servers.append(candidate)
+    return servers
+
+def run_attempts(job, on_progress, cancelled):
+    servers = failover_servers(job["server_id"])
+    for attempt in range(SPEEDTEST_ATTEMPTS):
+        server_id = servers[min(attempt, len(servers) - 1)]
+        job["attempts"] = attempt + 1
+        try:
+            return run_speedtest(server_id, on_progress=on_progress, interface=job["interface"], cancelled=cancelled)
+        except SpeedtestError as e:
+            if e.cause not in RETRYABLE_CAUSES or attempt + 1 >= SPEEDTEST_ATTEMPTS:
+                raise
+            delay = RETRY_BACKOFF * 2 ** attempt
+            app.logger.warning(
+                f"Speedtest attempt {attempt + 1}/{SPEEDTEST_ATTEMPTS} against server {server_id or 'auto'} "
+                f"failed ({e.cause}), retrying in {delay} seconds: {e}"
+            )
+            count_metrics([("retries", e.cause, 1)])
+            save_job(job)
+            deadline = time.monotonic() + delay
+            while time.monotonic() < deadline:
+                if cancelled():
+                    raise SpeedtestError("The test was cancelled.", cause="cancelled")
+                renew_test_lock()
+                time.sleep(min(LEASE_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+
+def run_job(job):
+    job_futures.pop(job["id"], None)
+    try:
+        execute_job(job)
+    finally:
+        cancel_requests.discard(job["id"])
+        if LOCK_BACKEND == 'sqlite':
+            try:
+                with get_db() as conn:
+                    conn.execute('DELETE FROM job_cancellations WHERE job_id = ?', (job["id"],))
+            except sqlite3.Error as e:
+                app.logger.error(f"Could not clear the cancellation of job {job['id']}: {e}")
+    if job["id"] == adaptive_state["job_id"]:
+        adapt_interval(job)
+
+def execute_job(job):
+    def cancelled():
+        try:
+            return job_cancelled(job["id"])
+        except sqlite3.Error:
+            return False
+
+    # Another worker's test holds the lease: queue behind it rather than fail.
+    if not acquire_test_lock(wait=LEASE_WAIT if LOCK_BACKEND == 'sqlite' else 0, cancelled=cancelled):
+        if cancelled():
+            fail_job(job, "The test was cancelled.", "cancelled")
+        else:
+            fail_job(job, "A speedtest is already in progress.", "lock_busy")
+        return
+    job["status"] = "running"
+    job["started"] = datetime.now().isoformat()
+    save_job(job)
+    publish_event("job", job_event(job))
+    started = time.monotonic()
+    progress_saved = started
+
+    def on_progress(progress):
+        nonlocal progress_saved
+        job["progress"] = progress
+        publish_event("progress", dict(progress, job_id=job["id"]))
+        if time.monotonic() - progress_saved >= JOB_PROGRESS_SAVE_INTERVAL:
+            progress_saved = time.monotonic()
+            save_job(job)
+
+    try:
+        data = run_attempts(job, on_progress, cancelled)
+        job["result_id"] = save_result(data, datetime.now())
+        if job["source"] == "manual":
+            update_last_test_time()
+        job["result"] = data
+        job["status"] = "done"
+        record_test_metrics(job["source"], duration=time.monotonic() - started)
+        app.logger.info(f"Speedtest job {job['id']} ({job['source']}) completed and results saved to the database.")
+    except SpeedtestError as e:
+        job["error"] = str(e)
+        job["status"] = "failed"
+        job["cause"] = e.cause
+        record_test_metrics(job["source"], failure=e.cause)
+        app.logger.warning(f"Speedtest failed: {e}")
+    except Exception as e:
+        job["error"] = f"An unexpected error occurred: {str(e)}"
+        job["status"] = "failed"
+        job["cause"] = "save_error" if isinstance(e, (sqlite3.Error, KeyError)) else "unexpected"
+        record_test_metrics(job["source"], failure=job["cause"])
+        app.logger.exception(job["error"])
+    finally:
+        job["finished"] = datetime.now().isoformat()
+        release_test_lock()
+        save_job(job)
+        publish_event("job", job_event(job))
+
+def speed_test(server_id=None, interface=None):
+    submit_job(server_id, source="scheduled", interface=interface)
+
+
+def get_next_run_time():
+    # Earliest upcoming bandwidth test across the default job and all targets.
+    tests = {job.id for job in get_scheduler().get_jobs() if job.func in (speed_test, adaptive_speed_test)}
+    run_times = [run for job_id, run in scheduled_next_runs().items() if job_id in tests]
+    if run_times:
+        next_run_time = min(run_times)
+        return next_run_time.strftime("%Y-%m-%d %H:%M:%S")
+    return "Automatic tests are disabled."
+
+def log_scheduler_state():
+    app.logger.debug(f"Scheduler running: {get_scheduler().running}")
+    for job in get_scheduler().get_jobs():
+        app.logger.debug(f"Job ID: {job.id}, Next Run: {job.next_run_time}, Trigger: {job.trigger}")
+
+def record_job_timing(event):
+    # Scheduled time to completion, so dispatch lag shows up as well.
+    record_timing(f"job:{event.job_id}", (datetime.now(event.scheduled_run_time.tzinfo) - event.scheduled_run_time).total_seconds())
+
+MIN_INTERVAL = 300
+DEFAULT_JITTER = 30
+DEFAULT_MAX_INTERVAL = 6 * 3600
+
+# The scheduler's jobs are rebuilt from settings and schedules on every
+# start, but the run times of the test jobs are kept in schedule_runs, so a
+# restart (or a new scheduler leader) keeps the cadence instead of starting
+# every interval over. Runs missed while nobody was scheduling are either
+# coalesced into one catch-up run, if no more than MISFIRE_GRACE seconds
+# late, or skipped to the next slot. Catch-up runs are spaced
+# CATCHUP_SPACING apart so a restart never fires them back to back.
+CATCHUP_POLICY = os.environ.get('SPEEDTEST_CATCHUP', 'coalesce')
+MISFIRE_GRACE = int(os.environ.get('SPEEDTEST_MISFIRE_GRACE', 3600))
+CATCHUP_SPACING = int(os.environ.get('SPEEDTEST_CATCHUP_SPACING', MIN_INTERVAL))
+
+catchup_state = {"next": None}
+# In-memory copy of schedule_runs, {job id: {"last_run", "next_run"}}, so
+# pages and /metrics can show run times without a query. The leader keeps
+# it current as it saves; other workers reload it in sync_worker_state().
+saved_runs = {"runs": {}}
+saved_runs_lock = threading.Lock()
+
+def remember_run(job_id, **times):
+    with saved_runs_lock:
+        runs = dict(saved_runs["runs"])
+        runs[job_id] = dict(runs.get(job_id, {"last_run": None, "next_run": None}), **times)
+        saved_runs["runs"] = runs
+
+def load_saved_runs():
+    with get_db() as conn:
+        rows = conn.execute('SELECT job_id, last_run, next_run FROM schedule_runs').fetchall()
+    runs = {
+        job_id: {
+            "last_run": datetime.fromisoformat(last_run) if last_run else None,
+            "next_run": datetime.fromisoformat(next_run) if next_run else None
+        }
+        for job_id, last_run, next_run in rows
+    }
+    with saved_runs_lock:
+        saved_runs["runs"] = runs
+
+def persisted_job(job_id):
+    return job_id == 'speed_test' or job_id.startswith('schedule-')
+
+def local_time(value):
+    # APScheduler hands out aware datetimes; the database keeps naive local time.
+    return value.astimezone().replace(tzinfo=None)
+
+def record_next_run(job):
+    # Only the leader's timers are live; paused copies must not overwrite them.
+    if not persisted_job(job.id) or not scheduler_state["leader"]:
+        return
+    next_run = local_time(job.next_run_time) if job.next_run_time else None
+    remember_run(job.id, next_run=next_run)
+    try:
+        with get_db() as conn:
+            conn.execute('''
+                INSERT INTO schedule_runs (job_id, interval, next_run) VALUES (?, ?, ?)
+                ON CONFLICT (job_id) DO UPDATE SET interval = excluded.interval, next_run = excluded.next_run
+            ''', (job.id, int(job.trigger.interval.total_seconds()), str(next_run) if next_run else None))
+    except sqlite3.Error as e:
+        app.logger.warning(f"Could not save the next run of {job.id}: {e}")
+
+def record_last_run(event):
+    if not persisted_job(event.job_id) or not scheduler_state["leader"]:
+        return
+    last_run = local_time(event.scheduled_run_times[-1])
+    remember_run(event.job_id, last_run=last_run)
+    try:
+        with get_db() as conn:
+            conn.execute('UPDATE schedule_runs SET last_run = ? WHERE job_id = ?', (str(last_run), event.job_id))
+    except sqlite3.Error as e:
+        app.logger.warning(f"Could not save the last run of {event.job_id}: {e}")
+
+def run_time_job_store():
+    from apscheduler.jobstores.memory import MemoryJobStore
+
+    class RunTimeJobStore(MemoryJobStore):
+        # add_job covers new jobs, update_job every reschedule, modify_job
+        # and the step to the next run after each submission.
+        def add_job(self, job):
+            super().add_job(job)
+            record_next_run(job)
+
+        def update_job(self, job):
+            super().update_job(job)
+            record_next_run(job)
+
+    return RunTimeJobStore()
+
+def planned_run(job_id, interval):
+    # First run for a job being (re)built: the saved next run while the
+    # interval is unchanged, else one interval after the last run. None
+    # leaves the scheduler to start a fresh interval from now.
+    with get_db() as conn:
+        row = conn.execute('SELECT interval, last_run, next_run FROM schedule_runs WHERE job_id = ?', (job_id,)).fetchone()
+    if row and row[2] and row[0] == interval:
+        run = datetime.fromisoformat(row[2])
+    elif row and row[1]:
+        run = datetime.fromisoformat(row[1]) + timedelta(seconds=interval)
+    else:
+        return None
+    now = datetime.now()
+    if run >= now:
+        return run
+    if CATCHUP_POLICY == 'coalesce' and (now - run).total_seconds() <= MISFIRE_GRACE:
+        run = max(now, catchup_state["next"] or now)
+        catchup_state["next"] = run + timedelta(seconds=CATCHUP_SPACING)
+        return run
+    missed = math.ceil((now - run).total_seconds() / interval)
+    return run + timedelta(seconds=missed * interval)
+
+def scheduled_next_runs():
+    # {job id: naive local next run}. A worker that does not own the
+    # scheduler reports the owner's saved run times, not its paused copy's.
+    jobs = get_scheduler().get_jobs()
+    if scheduler_state["leader"]:
+        return {job.id: local_time(job.next_run_time) for job in jobs if job.next_run_time}
+    runs = saved_runs["runs"]
+    return {job.id: runs[job.id]["next_run"] for job in jobs if job.id in runs and runs[job.id]["next_run"]}
+
+def schedule_speed_test(interval, server_id=None, adaptive=False):
+    # replace_existing swaps the trigger in place; the scheduler and its
+    # executors keep running, so other targets are not disturbed.
+    run = planned_run('speed_test', interval)
+    get_scheduler().add_job(
+        adaptive_speed_test if adaptive else speed_test,
+        'interval',
+        seconds=interval,
+        jitter=DEFAULT_JITTER,
+        id='speed_test',
+        args=[server_id] if server_id else [],
+        replace_existing=True,
+        **({"next_run_time": run} if run else {})
+    )
+
+def schedule_default_test(settings):
+    if settings["adaptive"]:
+        schedule_speed_test(settings["current_interval"] or settings["interval"], settings["server_id"], adaptive=True)
+    else:
+        schedule_speed_test(settings["interval"], settings["server_id"])
+
+def update_scheduler_interval(new_interval, server_id=None, adaptive=False, max_interval=None):
+    # Saving the settings restarts adaptation from the configured interval.
+    with get_db() as conn:
         conn.execute('''
-            CREATE TABLE IF NOT EXISTS global_cooldown (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                last_test_time DATETIME
+            UPDATE settings
+            SET interval = ?, server_id = ?, adaptive = ?, max_interval = ?, current_interval = NULL
+            WHERE id = 1
+        ''', (new_interval, server_id, int(bool(adaptive)), max_interval))
+        conn.commit()
+    schedule_default_test(load_settings_from_db())
+    app.logger.info(f"Modified job with interval {new_interval} seconds and server_id {server_id} (adaptive: {bool(adaptive)})")
+    bump_content_version("settings")
+    bump_schedule_revision()
+    log_scheduler_state()
+
+def load_settings_from_db():
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT interval, server_id, adaptive, max_interval, current_interval FROM settings WHERE id = 1')
+        row = cursor.fetchone()
+        return {
+            "interval": row[0] if row else DEFAULT_INTERVAL,
+            "server_id": row[1] if row else None,
+            "adaptive": bool(row[2]) if row else False,
+            "max_interval": (row[3] if row else None) or DEFAULT_MAX_INTERVAL,
+            "current_interval": row[4] if row else None
+        }
+
+# Adaptive mode for the default test. After each test the interval backs
+# off towards max_interval while the link is stable and tightens towards
+# MIN_INTERVAL when a test fails, raises an alert or the recent results
+# spread out. Stability comes from the anomaly baselines, so deciding
+# costs one small query. A test is deferred while the link is already
+# busy with other traffic, which would skew the result anyway.
+ADAPTIVE_BACKOFF = 1.5
+ADAPTIVE_TIGHTEN = 0.5
+ADAPTIVE_METRICS = ("download", "upload")
+ADAPTIVE_MIN_SAMPLES = 5
+ADAPTIVE_STABLE_CV = 0.1
+ADAPTIVE_UNSTABLE_CV = 0.25
+# Failures that say nothing about the link, as in scheduled_availability().
+ADAPTIVE_IGNORED_CAUSES = ("cancelled", "lock_busy")
+NET_DEV_PATH = '/proc/net/dev'
+BUSY_INTERFACE = os.environ.get('SPEEDTEST_BUSY_INTERFACE')
+BUSY_SAMPLE_SECONDS = 2.0
+# Traffic above this share of the usual download/upload counts as busy;
+# SPEEDTEST_BUSY_MBPS sets a fixed limit instead.
+BUSY_FRACTION = 0.2
+BUSY_MBPS = float(os.environ.get('SPEEDTEST_BUSY_MBPS', 0))
+BUSY_DEFER = 120
+BUSY_MAX_DEFERRALS = 5
+
+adaptive_state = {"job_id": None, "deferrals": 0}
+
+def read_net_dev(interface=None):
+    # Received and sent byte counters summed over the matching interfaces.
+    received = sent = 0
+    with open(NET_DEV_PATH) as f:
+        for line in f.readlines()[2:]:
+            name, _, counters = line.partition(":")
+            name = name.strip()
+            if (interface and name != interface) or (not interface and name == "lo"):
+                continue
+            fields = counters.split()
+            received += int(fields[0])
+            sent += int(fields[8])
+    return received, sent
+
+def busy_limits(server_id):
+    if BUSY_MBPS:
+        return BUSY_MBPS, BUSY_MBPS
+    # Without a fixed server the best server's medians stand for the link.
+    with get_db() as conn:
+        rows = dict(conn.execute('''
+            SELECT metric, MAX(median) FROM baselines
+            WHERE (? IS NULL OR server_id = ?) AND season = -1 AND metric IN ('download', 'upload') AND count >= ?
+            GROUP BY metric
+        ''', (server_id, server_id, ADAPTIVE_MIN_SAMPLES)).fetchall())
+    if len(rows) < 2:
+        return None
+    return BUSY_FRACTION * rows["download"], BUSY_FRACTION * rows["upload"]
+
+def link_busy(server_id):
+    limits = busy_limits(server_id)
+    if not limits:
+        return False
+    try:
+        before = read_net_dev(BUSY_INTERFACE)
+        time.sleep(BUSY_SAMPLE_SECONDS)
+        after = read_net_dev(BUSY_INTERFACE)
+    except (OSError, ValueError, IndexError):
+        return False
+    rates = [(end - start) * 8 / BUSY_SAMPLE_SECONDS / 1e6 for start, end in zip(before, after)]
+    return any(rate > limit for rate, limit in zip(rates, limits))
+
+def adaptive_speed_test(server_id=None):
+    if adaptive_state["deferrals"] < BUSY_MAX_DEFERRALS and link_busy(normalize_server_id(server_id)):
+        adaptive_state["deferrals"] += 1
+        app.logger.info(f"Link busy, deferring the scheduled test by {BUSY_DEFER} seconds ({adaptive_state['deferrals']}/{BUSY_MAX_DEFERRALS})")
+        get_scheduler().modify_job('speed_test', next_run_time=datetime.now() + timedelta(seconds=BUSY_DEFER))
+        return
+    adaptive_state["deferrals"] = 0
+    job, created = create_job(server_id, source="scheduled")
+    if created:
+        adaptive_state["job_id"] = job["id"]
+        start_job(job)
+
+def link_stability(job):
+    # "unstable", "stable", or None while the baselines are still warming up.
+    server_id = ((job["result"] or {}).get("server") or {}).get("id") or 0
+    with get_db() as conn:
+        if conn.execute("SELECT 1 FROM alerts WHERE result_id = ? AND kind != 'recovered'", (job["result_id"],)).fetchone():
+            return "unstable"
+        rows = conn.execute(f'''
+            SELECT count, ewma, ewm_var, degraded FROM baselines
+            WHERE server_id = ? AND season = -1 AND metric IN ({', '.join('?' * len(ADAPTIVE_METRICS))})
+        ''', (server_id, *ADAPTIVE_METRICS)).fetchall()
+    if len(rows) < len(ADAPTIVE_METRICS) or any(count < ADAPTIVE_MIN_SAMPLES for count, *_ in rows):
+        return None
+    if any(degraded for *_, degraded in rows):
+        return "unstable"
+    spread = max(math.sqrt(ewm_var) / (abs(ewma) or 1e-9) for _, ewma, ewm_var, _ in rows)
+    if spread > ADAPTIVE_UNSTABLE_CV:
+        return "unstable"
+    if spread < ADAPTIVE_STABLE_CV:
+        return "stable"
+    return None
+
+def adapt_interval(job):
+    adaptive_state["job_id"] = None
+    try:
+        settings = load_settings_from_db()
+        if not settings["adaptive"]:
+            return
+        current = settings["current_interval"] or settings["interval"]
+        if job["status"] == "failed" and job["cause"] in ADAPTIVE_IGNORED_CAUSES:
+            return
+        if job["status"] == "failed":
+            interval, reason = current * ADAPTIVE_TIGHTEN, f"test failed ({job['cause']})"
+        else:
+            stability = link_stability(job)
+            if stability == "unstable":
+                interval, reason = current * ADAPTIVE_TIGHTEN, "results are unstable"
+            elif stability == "stable":
+                interval, reason = current * ADAPTIVE_BACKOFF, "results are stable"
+            else:
+                return
+        interval = int(min(max(interval, MIN_INTERVAL), max(settings["max_interval"], MIN_INTERVAL)))
+        if interval == current:
+            return
+        with get_db() as conn:
+            conn.execute('UPDATE settings SET current_interval = ? WHERE id = 1', (interval,))
+        schedule_speed_test(interval, settings["server_id"], adaptive=True)
+        app.logger.info(f"Adaptive interval {current} -> {interval} seconds: {reason}")
+        bump_content_version("settings")
+        bump_schedule_revision()
+    except sqlite3.Error as e:
+        app.logger.error(f"Could not adapt the test interval: {e}")
+
+PROBE_INTERVAL = int(os.environ.get('PROBE_INTERVAL', 10))
+PROBE_MIN_INTERVAL = 5
+PROBE_COUNT = 5
+PROBE_TIMEOUT = 2.0
+PROBE_RETENTION_ROWS = 100000
+
+def parse_host_port(value, default_port=8080):
+    host, _, port = str(value).rpartition(":")
+    if not host or not port.isdigit():
+        return value, default_port
+    return host, int(port)
+
+def resolve_probe_target(server_id=None, target=None):
+    if target:
+        return parse_host_port(target)
+    if server_id is None:
+        server_id = normalize_server_id(load_settings_from_db()["server_id"])
+    for server in server_cache["servers"] or []:
+        if server_id is not None and str(server.get("id")) == str(server_id) and server.get("host"):
+            return parse_host_port(server["host"])
+    # Servers outside the cached catalog are found through the archived
+    # result of the last full test against them.
+    with get_db() as conn:
+        if server_id is None:
+            row = conn.execute('SELECT MAX(result_id) FROM speedtest_raw').fetchone()
+        else:
+            row = conn.execute('SELECT MAX(id) FROM speedtest_results WHERE server_id = ?', (server_id,)).fetchone()
+    data = load_raw_result(row[0]) if row and row[0] else None
+    host = dig(data, "server", "host")
+    if not host:
+        return None
+    return host, dig(data, "server", "port") or 8080
+
+def measure_latency(host, port, count=PROBE_COUNT, timeout=PROBE_TIMEOUT):
+    # TCP connect round trips: no privileges needed (unlike ICMP) and only
+    # a handful of packets on the wire.
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            with socket.create_connection((host, port), timeout=timeout):
+                samples.append((time.perf_counter() - start) * 1000)
+        except OSError:
+            pass
+    loss = 1 - len(samples) / count
+    if not samples:
+        return None, None, loss
+    latency = sum(samples) / len(samples)
+    jitter = sum(abs(b - a) for a, b in zip(samples, samples[1:])) / (len(samples) - 1) if len(samples) > 1 else 0.0
+    return latency, jitter, loss
+
+def probe(server_id=None, target=None):
+    if is_locked():
+        # A bandwidth test is saturating the link; its own ping covers this slot.
+        return
+    server_id = normalize_server_id(server_id)
+    resolved = resolve_probe_target(server_id, target)
+    if resolved is None:
+        return
+    host, port = resolved
+    latency, jitter, loss = measure_latency(host, port)
+    with get_db() as conn:
+        probe_id = conn.execute('''
+            INSERT INTO probe_results (timestamp, target, server_id, latency, jitter, loss)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (datetime.now(), f"{host}:{port}", server_id, latency, jitter, loss)).lastrowid
+        # Ring buffer: keep the newest PROBE_RETENTION_ROWS by rowid.
+        conn.execute('DELETE FROM probe_results WHERE id <= ?', (probe_id - PROBE_RETENTION_ROWS,))
+
+DB_MAX_BYTES = int(os.environ.get('SPEEDTEST_DB_MAX_BYTES', 0))
+PRUNE_INTERVAL = 3600
+PRUNE_BATCH_SIZE = 500
+PRUNE_BATCH_PAUSE = 0.05
+
+# What each retention policy prunes: the table, the key deleted by, a fixed
+# scope, the age condition for the cutoff and tables whose rows share the key.
+RETENTION_TARGETS = {
+    "results": {
+        "table": "speedtest_results", "key": "id", "scope": "1",
+        "older_than": "timestamp < ?", "cascade": [("speedtest_raw", "result_id")]
+    },
+    "raw": {
+        "table": "speedtest_raw", "key": "result_id", "scope": "1",
+        "older_than": "result_id < (SELECT COALESCE(MIN(id), 1 << 62) FROM speedtest_results WHERE timestamp >= ?)",
+        "cascade": []
+    },
+    "probes": {
+        "table": "probe_results", "key": "id", "scope": "1",
+        "older_than": "timestamp < ?", "cascade": []
+    },
+    "jobs": {
+        # Job times are ISO strings with a "T" separator.
+        "table": "test_jobs", "key": "rowid", "scope": "1",
+        "older_than": "created < replace(?, ' ', 'T')", "cascade": []
+    },
+    "alerts": {
+        "table": "alerts", "key": "id", "scope": "1",
+        "older_than": "timestamp < ?", "cascade": []
+    },
+}
+RETENTION_TARGETS["ingest_batches"] = {
+    "table": "ingest_batches", "key": "key", "scope": "1",
+    "older_than": "received < replace(?, ' ', 'T')", "cascade": []
+}
+for resolution in ROLLUP_RESOLUTIONS:
+    RETENTION_TARGETS[f"rollups_{resolution}"] = {
+        "table": "speedtest_rollups", "key": "bucket", "scope": f"resolution = '{resolution}'",
+        "older_than": "bucket < ?", "cascade": []
+    }
+    RETENTION_TARGETS[f"site_rollups_{resolution}"] = {
+        "table": "site_rollups", "key": "bucket", "scope": f"resolution = '{resolution}'",
+        "older_than": "bucket < ?", "cascade": []
+    }
+# When over the size cap, data is dropped oldest-first in this order.
+SIZE_CAP_ORDER = ("raw", "probes", "results", "rollups_hour")
+# Rollups re-aggregate the current week from raw rows, so keep at least that.
+MIN_RESULTS_RETENTION_DAYS = ROLLUP_SPANS["week"].days
+
+def retention_floor(name):
+    # Shortest time any policy, or the size cap, may keep this data.
+    return MIN_RESULTS_RETENTION_DAYS if name == "results" else 1
+
+def load_retention_policies():
+    with get_db() as conn:
+        return dict(conn.execute('SELECT name, max_age_days FROM retention_policies').fetchall())
+
+def save_retention_policy(name, max_age_days):
+    if name not in RETENTION_TARGETS:
+        raise ValueError(f"Unknown retention policy: {name}")
+    if max_age_days is not None:
+        max_age_days = int(max_age_days)
+        minimum = retention_floor(name)
+        if max_age_days < minimum:
+            raise ValueError(f"{name} must be kept for at least {minimum} days")
+    with get_db() as conn:
+        conn.execute('INSERT OR REPLACE INTO retention_policies (name, max_age_days) VALUES (?, ?)', (name, max_age_days))
+
+def delete_batch(target, condition="1", params=()):
+    # One short write transaction per batch so the scheduler's inserts and
+    # readers are never held up behind a long delete.
+    with get_db() as conn:
+        keys = [row[0] for row in conn.execute(f'''
+            SELECT {target["key"]} FROM {target["table"]}
+            WHERE {target["scope"]} AND {condition}
+            ORDER BY {target["key"]} LIMIT ?
+        ''', (*params, PRUNE_BATCH_SIZE))]
+        if not keys:
+            return 0
+        placeholders = ", ".join("?" * len(keys))
+        if target["table"] == "speedtest_results":
+            count_analytics(conn, f"id IN ({placeholders})", keys, sign=-1)
+        conn.execute(f'DELETE FROM {target["table"]} WHERE {target["scope"]} AND {target["key"]} IN ({placeholders})', keys)
+        for table, key in target["cascade"]:
+            conn.execute(f'DELETE FROM {table} WHERE {key} IN ({placeholders})', keys)
+    return len(keys)
+
+def db_size():
+    with get_db() as conn:
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        used_pages = conn.execute('PRAGMA page_count').fetchone()[0] - conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return used_pages * page_size
+
+def prune_db():
+    fail_abandoned_jobs()
+    deleted = {}
+    for name, max_age_days in load_retention_policies().items():
+        target = RETENTION_TARGETS.get(name)
+        if target is None or max_age_days is None:
+            continue
+        cutoff = str(datetime.now() - timedelta(days=max_age_days))
+        while True:
+            count = delete_batch(target, target["older_than"], (cutoff,))
+            deleted[name] = deleted.get(name, 0) + count
+            if count < PRUNE_BATCH_SIZE:
+                break
+            time.sleep(PRUNE_BATCH_PAUSE)
+
+    if DB_MAX_BYTES:
+        for name in SIZE_CAP_ORDER:
+            target = RETENTION_TARGETS[name]
+            cutoff = str(datetime.now() - timedelta(days=retention_floor(name)))
+            while db_size() > DB_MAX_BYTES:
+                count = delete_batch(target, target["older_than"], (cutoff,))
+                deleted[name] = deleted.get(name, 0) + count
+                if not count:
+                    break
+                time.sleep(PRUNE_BATCH_PAUSE)
+        size = db_size()
+        if size > DB_MAX_BYTES:
+            app.logger.warning(
+                f"Database holds {size} bytes, over the {DB_MAX_BYTES} byte cap, "
+                f"but the rest is within the minimum retention and was kept"
             )
-        ''')
-        conn.execute('''
-            INSERT OR IGNORE INTO settings (id, interval, server_id)
-            VALUES (1, ?, ?)
-        ''', (DEFAULT_INTERVAL, None))
-        conn.execute('''
-            INSERT OR IGNORE INTO global_cooldown (id, last_test_time)
-            VALUES (1, ?)
-        ''', (datetime.now(),))
+
+    # Hand freed pages back to the filesystem and cap the WAL file.
+    # executescript steps the pragma to completion; execute() would free
+    # a single page.
+    with get_db() as conn:
+        if deleted.get("results"):
+            conn.execute('DELETE FROM analytics_bins WHERE count <= 0')
+        conn.execute('DELETE FROM analytics_changes WHERE recorded < ?', (str(datetime.now() - timedelta(seconds=ANALYTICS_CHANGES_KEEP)),))
         conn.commit()
+        conn.executescript('PRAGMA incremental_vacuum;')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    with metrics_lock:
+        metrics["db_bytes"] = database_file_size()
+    if any(deleted.values()):
+        bump_content_version("results")
+        app.logger.info(f"Pruned database rows: {deleted}")
+    return deleted
 
+# Each schedule kind maps to the function the scheduler calls with the
+# listed schedule fields as keyword arguments. Kinds that saturate the
+# link hand the work to the serial test_executor; cheap checks such as
+# probes run directly in the scheduler pool and may overlap. A kind with
+# aims_at needs at least one of those fields to know what to test; the
+# built-in probe job already covers the default server.
+SCHEDULE_KINDS = {
+    "speedtest": {"run": speed_test, "min_interval": MIN_INTERVAL, "params": ("server_id", "interface")},
+    "probe": {"run": probe, "min_interval": PROBE_MIN_INTERVAL, "params": ("server_id", "target"), "aims_at": ("target", "server_id")},
+}
+SCHEDULE_FIELDS = ("id", "name", "kind", "server_id", "interface", "interval", "jitter", "enabled", "target")
 
-init_db()
+def schedule_job_id(schedule_id):
+    return f"schedule-{schedule_id}"
 
-COOLDOWN_PERIOD = 300
-def get_last_test_time():
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT last_test_time FROM global_cooldown WHERE id = 1')
-        row = cursor.fetchone()
-        if row and row[0]:
-            try:
-                return datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S.%f')
-            except ValueError:
-                return None
-        return None
+def apply_schedule(schedule):
+    job_id = schedule_job_id(schedule["id"])
+    if not schedule["enabled"]:
+        if get_scheduler().get_job(job_id):
+            get_scheduler().remove_job(job_id)
+        return
+    kind = SCHEDULE_KINDS[schedule["kind"]]
+    run = planned_run(job_id, schedule["interval"])
+    get_scheduler().add_job(
+        kind["run"],
+        'interval',
+        seconds=schedule["interval"],
+        jitter=schedule["jitter"] or None,
+        id=job_id,
+        name=schedule["name"] or job_id,
+        kwargs={param: schedule[param] for param in kind["params"]},
+        replace_existing=True,
+        **({"next_run_time": run} if run else {})
+    )
 
-def update_last_test_time():
-    with sqlite3.connect(DATABASE) as conn:
-        conn.execute('''
-            UPDATE global_cooldown
-            SET last_test_time = ?
-            WHERE id = 1
-        ''', (datetime.now(),))
-        conn.commit()
+def load_schedules():
+    with get_db() as conn:
+        rows = conn.execute(f"SELECT {', '.join(SCHEDULE_FIELDS)} FROM schedules ORDER BY id").fetchall()
+    return [dict(zip(SCHEDULE_FIELDS, row)) for row in rows]
 
-def create_lockfile():
-    with open(LOCKFILE, 'w') as f:
-        f.write('locked')
+def get_schedule(schedule_id):
+    with get_db() as conn:
+        row = conn.execute(f"SELECT {', '.join(SCHEDULE_FIELDS)} FROM schedules WHERE id = ?", (schedule_id,)).fetchone()
+    return dict(zip(SCHEDULE_FIELDS, row)) if row else None
 
-def remove_lockfile():
-    if os.path.exists(LOCKFILE):
-        os.remove(LOCKFILE)
+def validate_schedule(schedule):
+    kind = SCHEDULE_KINDS.get(schedule.get("kind"))
+    if kind is None:
+        raise ValueError(f"Unknown schedule kind: {schedule.get('kind')}")
+    try:
+        schedule["interval"] = int(schedule.get("interval"))
+        schedule["jitter"] = int(schedule.get("jitter") or 0)
+    except (TypeError, ValueError):
+        raise ValueError("interval and jitter must be integers")
+    if schedule["interval"] < kind["min_interval"]:
+        raise ValueError(f"Interval must be at least {kind['min_interval']} seconds.")
+    if not 0 <= schedule["jitter"] <= schedule["interval"]:
+        raise ValueError("jitter must be between 0 and the interval")
+    schedule["server_id"] = normalize_server_id(schedule.get("server_id"))
+    schedule["interface"] = schedule.get("interface") or None
+    schedule["target"] = schedule.get("target") or None
+    schedule["name"] = schedule.get("name") or None
+    if "aims_at" in kind and not any(schedule[field] is not None for field in kind["aims_at"]):
+        raise ValueError(f"A {schedule['kind']} schedule needs one of: {', '.join(kind['aims_at'])}")
+    # Strict, so the string "false" cannot save an enabled schedule.
+    enabled = schedule.get("enabled", True)
+    if not isinstance(enabled, int) or enabled not in (0, 1):
+        raise ValueError("enabled must be true, false, 0 or 1")
+    schedule["enabled"] = int(enabled)
+    return schedule
 
-def is_locked():
-    return os.path.exists(LOCKFILE)
+def save_schedule(schedule):
+    schedule = validate_schedule(schedule)
+    fields = [field for field in SCHEDULE_FIELDS if field != "id"]
+    with get_db() as conn:
+        if schedule.get("id"):
+            conn.execute(
+                f"UPDATE schedules SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+                [schedule.get(field) for field in fields] + [schedule["id"]]
+            )
+        else:
+            schedule["id"] = conn.execute(
+                f"INSERT INTO schedules ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})",
+                [schedule.get(field) for field in fields]
+            ).lastrowid
+    apply_schedule(schedule)
+    bump_schedule_revision()
+    return schedule
 
-def get_servers():
-    url = "https://www.speedtest.net/api/js/servers?engine=js&limit=10&https_functional=true"
+def delete_schedule(schedule_id):
+    with get_db() as conn:
+        deleted = conn.execute('DELETE FROM schedules WHERE id = ?', (schedule_id,)).rowcount
+        conn.execute('DELETE FROM schedule_runs WHERE job_id = ?', (schedule_job_id(schedule_id),))
+    with saved_runs_lock:
+        saved_runs["runs"] = {job_id: runs for job_id, runs in saved_runs["runs"].items() if job_id != schedule_job_id(schedule_id)}
+    if get_scheduler().get_job(schedule_job_id(schedule_id)):
+        get_scheduler().remove_job(schedule_job_id(schedule_id))
+    bump_schedule_revision()
+    return deleted > 0
+
+# With the sqlite lock backend every worker runs this module, but only the
+# holder of scheduler_lease runs jobs; the others keep a paused copy of the
+# schedule (for next-run display) and take over when the lease expires.
+# Settings and schedule edits may land on any worker, so they bump a
+# revision that makes every worker reload the schedule from the database.
+SCHEDULER_LEASE_TTL = 30
+SCHEDULER_LEASE_RENEW = 10
+
+scheduler_state = {"leader": LOCK_BACKEND != 'sqlite', "revision": None}
+
+def bump_schedule_revision():
+    if LOCK_BACKEND == 'sqlite':
+        with get_db() as conn:
+            conn.execute('UPDATE scheduler_lease SET revision = revision + 1 WHERE id = 1')
+
+def sync_schedules():
+    schedule_default_test(load_settings_from_db())
+    schedules = load_schedules()
+    for schedule in schedules:
+        apply_schedule(schedule)
+    current = {schedule_job_id(schedule["id"]) for schedule in schedules}
+    for job in get_scheduler().get_jobs():
+        if job.id.startswith("schedule-") and job.id not in current:
+            get_scheduler().remove_job(job.id)
+
+def elect_scheduler_leader():
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        servers = response.json() 
-        return servers 
-    except requests.RequestException as e:
-        return {"error": str(e)}
+        leader = claim_lease('scheduler_lease', SCHEDULER_LEASE_TTL)
+    except sqlite3.Error as e:
+        app.logger.error(f"Could not renew scheduler lease: {e}")
+        leader = False
+    if leader and not scheduler_state["leader"]:
+        app.logger.info(f"Worker {os.getpid()} now owns the scheduler")
+        scheduler_state["leader"] = True
+        # The paused copy's timers date from this worker's start; carry on
+        # from the run times the previous owner saved instead.
+        try:
+            sync_schedules()
+        except sqlite3.Error as e:
+            app.logger.error(f"Could not restore the saved schedule: {e}")
+        get_scheduler().resume()
+    elif not leader and scheduler_state["leader"]:
+        app.logger.warning(f"Worker {os.getpid()} lost the scheduler lease")
+        get_scheduler().pause()
+    scheduler_state["leader"] = leader
 
-def speed_test(server_id=None):
-    if is_locked():
-        return
-    create_lockfile()
-    
+def sync_worker_state():
+    # Pulls what other workers changed into this one's in-memory copies,
+    # so request handlers such as /metrics can answer without a query.
     try:
-        command = [
-            "speedtest",
-            "--accept-gdpr",
-            "--accept-license",
-            "--format=json"
-        ]
-        
-        if server_id:
-            command.extend(["-s", str(server_id)])
+        if "results" in load_content_versions():
+            load_metrics_snapshot()
+        with counters_sync_lock:
+            load_metric_counters()
+        load_saved_runs()
+        # Refreshes peer_lease, which /metrics reads as is.
+        is_locked()
+    except sqlite3.Error as e:
+        app.logger.error(f"Could not refresh state from other workers: {e}")
 
-        result = subprocess.run(
-            command,
-            text=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        if result.returncode != 0:
+def coordinate_workers():
+    renewed = None
+    while True:
+        if renewed is None or time.monotonic() - renewed >= SCHEDULER_LEASE_RENEW:
+            renewed = time.monotonic()
+            elect_scheduler_leader()
             try:
-                error_data = json.loads(result.stderr)
-                error_message = error_data.get("message", "Speedtest failed: Unknown error")
-            except json.JSONDecodeError:
-                error_message = result.stderr.strip()
+                with get_db() as conn:
+                    revision = conn.execute('SELECT revision FROM scheduler_lease WHERE id = 1').fetchone()[0]
+                if revision != scheduler_state["revision"]:
+                    if scheduler_state["revision"] is not None:
+                        sync_schedules()
+                    scheduler_state["revision"] = revision
+            except sqlite3.Error as e:
+                app.logger.error(f"Could not check the schedule revision: {e}")
+        sync_worker_state()
+        time.sleep(CONTENT_POLL_INTERVAL)
 
-            print(f"Speedtest failed: {error_message}")
-            return
+def start_background():
+    load_saved_runs()
+    schedule_default_test(load_settings_from_db())
 
-        data = json.loads(result.stdout)
-        
-        server_info = data.get('server', {})
-        server_id = server_info.get('id')
-        server_name = server_info.get('name')
+    for schedule in load_schedules():
+        apply_schedule(schedule)
 
-        with sqlite3.connect(DATABASE) as conn:
-            conn.execute('''
-                INSERT INTO speedtest_results 
-                (timestamp, download, upload, ping, url, server_id, server_name)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                datetime.now(),
-                data['download']['bandwidth'] / 125000,
-                data['upload']['bandwidth'] / 125000,
-                data['ping']['latency'],
-                data['result']['url'],
-                server_id,
-                server_name
-            ))
-            conn.commit()
-            
-        print("Automatic speedtest completed and results saved to the database.")
-        
-    except Exception as e:
-        print(f"An error occurred during automatic speedtest: {e}")
+    if PROBE_INTERVAL > 0:
+        get_scheduler().add_job(probe, 'interval', seconds=max(PROBE_INTERVAL, PROBE_MIN_INTERVAL), id='probe')
+
+    get_scheduler().add_job(prune_db, 'interval', seconds=PRUNE_INTERVAL, id='prune_db')
+
+    if COLLECTOR_URL:
+        # Jitter spreads a fleet's pushes instead of landing them together.
+        get_scheduler().add_job(push_results, 'interval', seconds=PUSH_INTERVAL, jitter=PUSH_INTERVAL // 5, id='push_results')
+    if COLLECTOR_TOKEN:
+        get_scheduler().add_job(flush_rollups, 'interval', seconds=ROLLUP_FLUSH_INTERVAL, id='flush_rollups')
+
+    load_server_cache()
+    load_metrics_snapshot()
+    if LOCK_BACKEND == 'sqlite':
+        load_content_versions()
+        load_metric_counters()
+    get_scheduler().add_job(
+        refresh_servers,
+        'interval',
+        seconds=SERVERS_TTL,
+        id='refresh_servers',
+        **({"next_run_time": datetime.now()} if servers_stale() else {})
+    )
+
+    # With the sqlite lock backend the scheduler stays paused until this
+    # worker wins the election.
+    get_scheduler().start(paused=LOCK_BACKEND == 'sqlite')
+    if LOCK_BACKEND == 'sqlite':
+        threading.Thread(target=coordinate_workers, name='coordinate-workers', daemon=True).start()
+        atexit.register(release_lease, 'scheduler_lease')
+
+@contextmanager
+def startup_phase(name):
+    start = time.perf_counter()
+    try:
+        yield
     finally:
-        remove_lockfile()
+        startup["timings"][name] = (time.perf_counter() - start) * 1000
 
+def create_app():
+    with startup_lock:
+        if startup["done"]:
+            return app
+        start = time.perf_counter()
+        with startup_phase("db"):
+            init_db()
+        with startup_phase("templates"):
+            compile_templates()
+        with startup_phase("scheduler_import"):
+            get_scheduler()
+        with startup_phase("background"):
+            start_background()
+        startup["timings"]["total"] = (time.perf_counter() - start) * 1000
+        startup["done"] = True
+    phases = ", ".join(f"{name}={ms:.1f}ms" for name, ms in startup["timings"].items() if name != "total")
+    app.logger.info(f"Started in {startup['timings']['total']:.1f}ms ({phases})")
+    return app
 
-def get_next_run_time():
-    jobs = scheduler.get_jobs()
-    if jobs:
-        next_run_time = jobs[0].next_run_time
-        return next_run_time.strftime("%Y-%m-%d %H:%M:%S")
-    return "Automatic tests are disabled."
+compiled_templates = {}
 
-def print_scheduler_state():
-    print(f"Scheduler running: {scheduler.running}")
-    print(f"Executor running: {scheduler._executors['default']._pool is not None}")
-    for job in scheduler.get_jobs():
-        print(f"Job ID: {job.id}, Next Run: {job.next_run_time}, Interval: {job.trigger.interval}")
-logging.basicConfig()
-logging.getLogger('apscheduler').setLevel(logging.DEBUG)
+def compile_templates():
+    for name, source in (("index", HTML), ("settings", SETTINGS_HTML), ("results", RESULTS_HTML)):
+        compiled_templates[name] = app.jinja_env.from_string(source)
 
+def render(template, **context):
+    # Templates are compiled once, during create_app().
+    if template not in compiled_templates:
+        compile_templates()
+    with span("template"):
+        return render_template(compiled_templates[template], **context)
 
-def update_scheduler_interval(new_interval, server_id=None):
-    scheduler.shutdown(wait=False) 
+# Rendered index/results pages keyed by an ETag built from everything they
+# show. Any change bumps a version, so a stale entry can never match; the
+# cache is also cleared so memory is released straight away.
+# With several workers the versions live in SQLite and each worker checks
+# them; sync_worker_state() reloads them every CONTENT_POLL_INTERVAL.
+# A restart may ship new templates, so ETags also carry a boot id. The
+# versions in SQLite outlive restarts and must give every worker the same
+# ETag, so there a digest of this file, which changes with any deploy,
+# stands in for it.
+boot_id = uuid.uuid4().hex[:8]
+with open(__file__, 'rb') as source:
+    code_id = hashlib.blake2b(source.read(), digest_size=4).hexdigest()
+content_versions = {"results": 0, "settings": 0}
+page_cache = {}
+page_cache_lock = threading.Lock()
+CONTENT_POLL_INTERVAL = 1.0
 
-    try:
-        for job in scheduler.get_jobs():
-            scheduler.remove_job(job_id=job.id)
-    except:
-        pass
-    if scheduler.get_job(job_id="speed_test"):
-        scheduler.remove_job(job_id="speed_test") 
-    time.sleep(1)
-    clear_and_reinitialize_executor()
-    scheduler.add_job(
-        speed_test,
-        'interval',
-        seconds=new_interval,
-        id='speed_test',
-        args=[server_id] if server_id else []
-    )
-    print(f"Modified job with interval {new_interval} seconds and server_id {server_id}")
-    print("Current jobs after modification:")
-    for job in scheduler.get_jobs():
-        print(f"Job ID: {job.id}, Next Run: {job.next_run_time}, Interval: {job.trigger.interval}")
-    with sqlite3.connect(DATABASE) as conn:
-        conn.execute('''
-            UPDATE settings
-            SET interval = ?, server_id = ?
-            WHERE id = 1
-        ''', (new_interval, server_id))
-        conn.commit()
-    print("Updated settings in the database")
+def load_content_versions():
+    with get_db() as conn:
+        versions = dict(conn.execute('SELECT name, version FROM content_versions').fetchall())
+    with page_cache_lock:
+        changed = [name for name, version in versions.items() if content_versions.get(name) != version]
+        if changed:
+            content_versions.update(versions)
+            page_cache.clear()
+    if "results" in changed:
+        expire_analytics()
+    return changed
 
-def load_settings_from_db():
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT interval, server_id FROM settings WHERE id = 1')
-        row = cursor.fetchone()
-        return {
-            "interval": row[0] if row else DEFAULT_INTERVAL,
-            "server_id": row[1] if row else None
-        }
+def bump_content_version(name):
+    if LOCK_BACKEND == 'sqlite':
+        with get_db() as conn:
+            conn.execute('UPDATE content_versions SET version = version + 1 WHERE name = ?', (name,))
+        load_content_versions()
+        return
+    with page_cache_lock:
+        content_versions[name] += 1
+        page_cache.clear()
+    if name == "results":
+        expire_analytics()
 
-settings = load_settings_from_db()
+def etag_for(*parts):
+    # Every worker builds the same ETag for the same content, so a 304 does
+    # not depend on which worker a request reaches.
+    boot = code_id if LOCK_BACKEND == 'sqlite' else boot_id
+    key = "|".join(str(part) for part in (boot,) + parts)
+    return hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
 
-scheduler.add_job(
-            speed_test,
-            'interval',
-            seconds=settings["interval"],
-            id='speed_test',
-            args=[settings["server_id"]] if settings["server_id"] else []
-        )
+def page_etag(page, *parts):
+    # Other workers' changes arrive through sync_worker_state(), so a 304
+    # needs no query.
+    return etag_for(page, content_versions["results"], content_versions["settings"], *parts)
+
+def cached_page(page, etag, template, context):
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        with page_cache_lock:
+            cached = page_cache.get(page)
+        if cached and cached[0] == etag:
+            body = cached[1]
+        else:
+            body = render(template, **context())
+            with page_cache_lock:
+                page_cache[page] = (etag, body)
+        response = make_response(body)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 @app.route("/", methods=["GET", "POST"])
 def speedtest():
     next_run_time = get_next_run_time()
 
     if request.method == "POST":
+        job = active_job()
+        if job:
+            return jsonify(job_response(job, coalesced=True)), 202
+
         last_test_time = get_last_test_time()
         current_time = datetime.now()
 
-        print(f"Last test time: {last_test_time}")
-        print(f"Current time: {current_time}")
-
         if last_test_time:
             time_since_last_test = (current_time - last_test_time).total_seconds()
-            print(f"Time since last test: {time_since_last_test} seconds")
             if time_since_last_test < COOLDOWN_PERIOD:
                 cooldown_remaining = int(COOLDOWN_PERIOD - time_since_last_test)
                 return jsonify({"error": f"Please wait {cooldown_remaining} seconds before running another test."}), 429
-                
-        if is_locked():
-            return jsonify({"waiting": True})
-        create_lockfile()
 
-        try:
-            server_id = request.form.get('server_id')
-            command = [
-                "speedtest",
-                "--accept-gdpr",
-                "--accept-license",
-                "--format=json"
-            ]
-            
-            if server_id and server_id.isdigit():
-                command.extend(["-s", str(server_id)])
-
-            result = subprocess.run(
-                command,
-                text=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            if result.returncode != 0:
-                try:
-                    error_data = json.loads(result.stderr)
-                    error_message = error_data.get("message", "Speedtest failed: Unknown error")
-                except json.JSONDecodeError:
-                    error_message = result.stderr.strip()
-
-                print(f"Speedtest failed: {error_message}")
-                return jsonify({"error": error_message}), 500
-
-            data = json.loads(result.stdout)
-
-            server_info = data.get('server', {})
-            server_id = server_info.get('id')
-            server_name = server_info.get('name')
-
-            with sqlite3.connect(DATABASE) as conn:
-                conn.execute('''
-                    INSERT INTO speedtest_results 
-                    (timestamp, download, upload, ping, url, server_id, server_name)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    current_time,
-                    data['download']['bandwidth'] / 125000,
-                    data['upload']['bandwidth'] / 125000,
-                    data['ping']['latency'],
-                    data['result']['url'],
-                    server_id,
-                    server_name
-                ))
-                conn.commit()
-            update_last_test_time()
-                
-            return jsonify({"redirect": "/results", "output": data})
-            
-        except subprocess.CalledProcessError as e:
-            error_message = f"Speedtest failed: {e.stderr}"
-            print(error_message)
-            return jsonify({"error": error_message}), 500
-        except json.JSONDecodeError as e:
-            error_message = f"Failed to parse speedtest output: {str(e)}"
-            print(error_message)
-            return jsonify({"error": error_message}), 500
-        except Exception as e:
-            error_message = f"An unexpected error occurred: {str(e)}"
-            print(error_message)
-            return jsonify({"error": error_message}), 500
-        finally:
-            remove_lockfile()
+        server_id = request.form.get('server_id')
+        if not (server_id and server_id.isdigit()):
+            server_id = None
+        job, created = submit_job(server_id)
+        return jsonify(job_response(job, coalesced=not created)), 202
 
     servers = get_servers() 
-    current_settings = load_settings_from_db()
-    return render_template_string(HTML, servers=servers, current_server_id=current_settings["server_id"], next_run_time=next_run_time)
 
+    def context():
+        current_settings = load_settings_from_db()
+        return dict(servers=servers, current_server_id=current_settings["server_id"], next_run_time=next_run_time)
+
+    return cached_page("index", page_etag("index", server_cache["fetched_at"], next_run_time), "index", context)
+
+
+SETTINGS_ADMIN_IP = "192.168.1.100"
+
+def is_authorised():
+    return request.remote_addr == SETTINGS_ADMIN_IP
+
+def render_settings(next_run_time, error_message=None):
+    current_settings = load_settings_from_db()
+    return render(
+        "settings",
+        current_interval=current_settings["interval"],
+        current_server_id=current_settings["server_id"],
+        adaptive=current_settings["adaptive"],
+        max_interval=current_settings["max_interval"],
+        adaptive_interval=current_settings["current_interval"] or current_settings["interval"],
+        next_run_time=next_run_time,
+        error_message=error_message
+    )
 
 @app.route("/settings", methods=["GET", "POST"])
 def settings():
     client_ip = request.remote_addr
     app.logger.info(f"Real client IP: {client_ip}")
     next_run_time = get_next_run_time()
-    jobs = scheduler.get_jobs()
-    if not jobs:
-        print("No jobs scheduled.")
-    else:
-        for job in jobs:
-            print(f"Job ID: {job.id}, Next Run: {job.next_run_time}, Interval: {job.trigger.interval}")
     if request.method == "POST":
-        if client_ip != "192.168.1.100":
-            error_message = "Error: Not authorised"
-            current_settings = load_settings_from_db()
-
-            return render_template_string(
-                SETTINGS_HTML,
-                current_interval=current_settings["interval"],
-                current_server_id=current_settings["server_id"],
-                next_run_time=next_run_time,
-                error_message=error_message
-            )
+        if not is_authorised():
+            return render_settings(next_run_time, "Error: Not authorised")
         new_interval = int(request.form.get("interval"))
         server_id = request.form.get("server_id")
+        adaptive = request.form.get("adaptive") == "on"
+        max_interval = int(request.form.get("max_interval") or DEFAULT_MAX_INTERVAL)
         next_run_time = get_next_run_time()
 
 
-        if new_interval < 300:
-            error_message = "Interval must be at least 5 minutes (300 seconds)."
-            current_settings = load_settings_from_db()
-            return render_template_string(SETTINGS_HTML, current_interval=current_settings["interval"], current_server_id=current_settings["server_id"], next_run_time=next_run_time, error_message=error_message)
-        update_scheduler_interval(new_interval, server_id)
+        if new_interval < MIN_INTERVAL:
+            return render_settings(next_run_time, "Interval must be at least 5 minutes (300 seconds).")
+        if adaptive and max_interval < new_interval:
+            return render_settings(next_run_time, "The maximum interval must not be shorter than the interval.")
+        update_scheduler_interval(new_interval, server_id, adaptive, max_interval)
         return redirect(f"{url_for('settings')}")
     
-    current_settings = load_settings_from_db()
-    return render_template_string(SETTINGS_HTML, current_interval=current_settings["interval"], current_server_id=current_settings["server_id"], next_run_time=next_run_time)
+    return render_settings(next_run_time)
 
 
 @app.route("/results")
 def results():
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM speedtest_results ORDER BY timestamp DESC LIMIT 10')
-        rows = cursor.fetchall()
     next_run_time = get_next_run_time()
-    labels = [row[1] for row in rows]
-    download = [row[2] for row in rows]
-    upload = [row[3] for row in rows]
-    ping = [row[4] for row in rows]
-    return render_template_string(RESULTS_HTML, labels=labels, download=download, upload=upload, ping=ping, all_results=rows,next_run_time=next_run_time)
+
+    def context():
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM speedtest_results ORDER BY timestamp DESC LIMIT 10')
+            rows = cursor.fetchall()
+        labels = [row[1] for row in rows]
+        download = [row[2] for row in rows]
+        upload = [row[3] for row in rows]
+        ping = [row[4] for row in rows]
+        return dict(labels=labels, download=download, upload=upload, ping=ping, all_results=rows, next_run_time=next_run_time)
+
+    return cached_page("results", page_etag("results", next_run_time), "results", context)
+
+def schedule_response(schedule):
+    job_id = schedule_job_id(schedule["id"])
+    next_run = scheduled_next_runs().get(job_id)
+    last_run = saved_runs["runs"].get(job_id, {}).get("last_run")
+    return dict(
+        schedule,
+        next_run_time=next_run.astimezone().isoformat() if next_run else None,
+        last_run_time=last_run.astimezone().isoformat() if last_run else None
+    )
+
+@app.route("/api/schedules", methods=["GET", "POST"])
+def api_schedules():
+    if request.method == "GET":
+        return jsonify([schedule_response(schedule) for schedule in load_schedules()])
+    if not is_authorised():
+        return jsonify({"error": "Not authorised"}), 403
+    schedule = request.get_json(silent=True) or {}
+    schedule.pop("id", None)
+    schedule.setdefault("kind", "speedtest")
+    try:
+        schedule = save_schedule(schedule)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(schedule_response(schedule)), 201
+
+@app.route("/api/schedules/<int:schedule_id>", methods=["GET", "PUT", "DELETE"])
+def api_schedule(schedule_id):
+    schedule = get_schedule(schedule_id)
+    if schedule is None:
+        return jsonify({"error": "Unknown schedule"}), 404
+    if request.method == "GET":
+        return jsonify(schedule_response(schedule))
+    if not is_authorised():
+        return jsonify({"error": "Not authorised"}), 403
+    if request.method == "DELETE":
+        delete_schedule(schedule_id)
+        return "", 204
+    schedule.update(request.get_json(silent=True) or {})
+    schedule["id"] = schedule_id
+    try:
+        schedule = save_schedule(schedule)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(schedule_response(schedule))
+
+PROBE_FIELDS = ("id", "timestamp", "target", "server_id", "latency", "jitter", "loss")
+
+@app.route("/api/probes")
+def api_probes():
+    try:
+        limit = max(min(int(request.args.get("limit", RESULTS_PAGE_SIZE)), RESULTS_MAX_PAGE_SIZE), 1)
+        since = parse_timestamp_arg("since")
+        until = parse_timestamp_arg("until")
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+    where = []
+    params = []
+    if request.args.get("target"):
+        where.append("target = ?")
+        params.append(request.args["target"])
+    if since:
+        where.append("timestamp >= ?")
+        params.append(since)
+    if until:
+        where.append("timestamp < ?")
+        params.append(until)
+    query = f"SELECT {', '.join(PROBE_FIELDS)} FROM probe_results"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY timestamp DESC LIMIT ?"
+    params.append(limit)
+    with get_db() as conn:
+        rows = conn.execute(query, params).fetchall()
+    return jsonify([dict(zip(PROBE_FIELDS, row)) for row in rows])
+
+@app.route("/api/alerts")
+def api_alerts():
+    try:
+        limit = max(min(int(request.args.get("limit", RESULTS_PAGE_SIZE)), RESULTS_MAX_PAGE_SIZE), 1)
+        since = parse_timestamp_arg("since")
+        until = parse_timestamp_arg("until")
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+    where = []
+    params = []
+    for field in ("server_id", "metric", "kind"):
+        if request.args.get(field):
+            where.append(f"{field} = ?")
+            params.append(request.args[field])
+    if since:
+        where.append("timestamp >= ?")
+        params.append(since)
+    if until:
+        where.append("timestamp < ?")
+        params.append(until)
+    query = f"SELECT {', '.join(ALERT_FIELDS)} FROM alerts"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+    params.append(limit)
+    with get_db() as conn:
+        rows = conn.execute(query, params).fetchall()
+    return jsonify([dict(zip(ALERT_FIELDS, row)) for row in rows])
+
+@app.route("/api/retention", methods=["GET", "PUT"])
+def api_retention():
+    if request.method == "PUT":
+        if not is_authorised():
+            return jsonify({"error": "Not authorised"}), 403
+        try:
+            for name, max_age_days in (request.get_json(silent=True) or {}).items():
+                save_retention_policy(name, max_age_days)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "policies": load_retention_policies(),
+        "max_db_bytes": DB_MAX_BYTES or None,
+        "db_bytes": db_size()
+    })
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+@app.route("/debug/perf")
+def debug_perf():
+    with perf_lock:
+        snapshot = {name: sorted(samples) for name, samples in perf_samples.items()}
+    return jsonify({
+        "enabled": PERF_ENABLED,
+        "slow_request_ms": SLOW_REQUEST_MS,
+        "startup_ms": startup["timings"],
+        "spans": {
+            name: {
+                "count": len(samples),
+                "p50_ms": percentile(samples, 0.50),
+                "p95_ms": percentile(samples, 0.95),
+                "p99_ms": percentile(samples, 0.99),
+                "max_ms": samples[-1]
+            }
+            for name, samples in snapshot.items() if samples
+        }
+    })
+
+def metric_labels(**labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels.items()) + "}"
+
+@app.route("/metrics")
+def prometheus_metrics():
+    with metrics_lock:
+        latest = dict(metrics["latest"])
+        duration_buckets = list(metrics["duration_buckets"])
+        duration_sum = metrics["duration_sum"]
+        duration_count = metrics["duration_count"]
+        tests = dict(metrics["tests"])
+        failures = dict(metrics["failures"])
+        alerts = dict(metrics["alerts"])
+        retries = dict(metrics["retries"])
+        db_bytes = metrics["db_bytes"]
+
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{metric_labels(**labels)} {value}")
+
+    for field, name, help_text in (
+        ("download", "speedtest_download_mbps", "Download bandwidth of the latest test in Mbps."),
+        ("upload", "speedtest_upload_mbps", "Upload bandwidth of the latest test in Mbps."),
+        ("ping", "speedtest_ping_ms", "Idle latency of the latest test in milliseconds."),
+        ("jitter", "speedtest_jitter_ms", "Idle jitter of the latest test in milliseconds."),
+        ("timestamp", "speedtest_last_result_timestamp_seconds", "Unix time of the latest result."),
+    ):
+        metric(name, "gauge", help_text, [
+            ({"server_id": server_id if server_id is not None else "", "server_name": result["server_name"] or ""}, result[field])
+            for server_id, result in latest.items() if result[field] is not None
+        ])
+
+    lines.append("# HELP speedtest_test_duration_seconds Wall-clock duration of successful tests.")
+    lines.append("# TYPE speedtest_test_duration_seconds histogram")
+    for bound, count in zip(DURATION_BUCKETS, duration_buckets):
+        lines.append(f'speedtest_test_duration_seconds_bucket{{le="{bound}"}} {count}')
+    lines.append(f'speedtest_test_duration_seconds_bucket{{le="+Inf"}} {duration_count}')
+    lines.append(f"speedtest_test_duration_seconds_sum {duration_sum}")
+    lines.append(f"speedtest_test_duration_seconds_count {duration_count}")
+
+    metric("speedtest_tests_total", "counter", "Tests attempted by source.",
+           [({"source": source}, count) for source, count in tests.items()])
+    metric("speedtest_test_failures_total", "counter", "Failed tests by cause.",
+           [({"cause": cause}, count) for cause, count in failures.items()])
+    metric("speedtest_test_retries_total", "counter", "Test attempts retried by the cause of the failed attempt.",
+           [({"cause": cause}, count) for cause, count in retries.items()])
+    metric("speedtest_alerts_total", "counter", "Anomaly alerts raised by metric and kind.",
+           [({"metric": metric_name, "kind": kind}, count) for (metric_name, kind), count in alerts.items()])
+    metric("speedtest_scheduler_next_run_timestamp_seconds", "gauge", "Unix time of each scheduled job's next run.",
+           [({"job": job_id}, run.timestamp()) for job_id, run in scheduled_next_runs().items()])
+    metric("speedtest_test_lock_held", "gauge", "1 while a bandwidth test holds the test lock.",
+           [({}, int(test_lock.locked() or peer_lease["locked"]))])
+    metric("speedtest_db_size_bytes", "gauge", "Size of the SQLite database and its WAL file.",
+           [({}, db_bytes)])
+
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+def job_response(job, coalesced=False):
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "coalesced": coalesced,
+        "status_url": url_for('job_status', job_id=job["id"])
+    }
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = find_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def job_cancel(job_id):
+    job = find_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    # Anyone may stop a manual test, as anyone may start one.
+    if job["source"] != "manual" and not is_authorised():
+        return jsonify({"error": "Not authorised"}), 403
+    if job["status"] not in ("queued", "running"):
+        return jsonify({"error": f"Job already {job['status']}"}), 409
+    job = cancel_job(job_id)
+    return jsonify(job_response(job)), 202
+
+def format_sse(event_type, payload):
+    return f"event: {event_type}\ndata: {json.dumps(payload)}\n\n"
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# The pieces of /events shared with the streaming endpoint in asgi.py.
+def follows_remote_job(job_id):
+    # Another worker's job, or one already dropped from `jobs`; either way
+    # its row in test_jobs is the only source.
+    return bool(job_id) and job_id not in jobs
+
+def ends_stream(job_id, event_type, payload):
+    # A stream following one job closes once that job has finished.
+    return bool(job_id) and event_type == "job" and payload["status"] not in ("queued", "running")
+
+def replay_events(job_id=None):
+    # The current state, so a client that connects after the job changed
+    # status does not wait for an event that already fired.
+    job = jobs.get(job_id) if job_id else active_job()
+    if not job:
+        return []
+    events = [("job", job_event(job))]
+    if job["progress"]:
+        events.append(("progress", dict(job["progress"], job_id=job["id"])))
+    return events
+
+def event_matches(job_id, payload):
+    return not job_id or payload.get("id", payload.get("job_id")) == job_id
+
+def poll_remote_job(job_id, last=None):
+    # One look at a job another worker runs: the events since the state
+    # `last`, and the new state.
+    job = load_job(job_id)
+    if not job:
+        # Pruned meanwhile; there is nothing left to follow.
+        return [], None
+    state = (job["status"], job["progress"])
+    if state == last:
+        return [], last
+    events = [("job", job_event(job))]
+    if job["progress"] and (not last or job["progress"] != last[1]):
+        events.append(("progress", dict(job["progress"], job_id=job["id"])))
+    return events, state
+
+@app.route("/events")
+def events():
+    job_id = request.args.get("job")
+
+    def remote_stream():
+        # The job runs in another worker: follow its row in test_jobs.
+        last = None
+        sent = time.monotonic()
+        while True:
+            events, last = poll_remote_job(job_id, last)
+            if last is None:
+                return
+            if events:
+                for event_type, payload in events:
+                    yield format_sse(event_type, payload)
+                if any(ends_stream(job_id, *event) for event in events):
+                    return
+                sent = time.monotonic()
+            elif time.monotonic() - sent >= SSE_KEEPALIVE:
+                yield ": keep-alive\n\n"
+                sent = time.monotonic()
+            time.sleep(LEASE_POLL_INTERVAL)
+
+    if follows_remote_job(job_id):
+        if load_job(job_id) is None:
+            return jsonify({"error": "Unknown job"}), 404
+        return Response(remote_stream(), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+    def stream():
+        subscriber = subscribe_events()
+        try:
+            for event_type, payload in replay_events(job_id):
+                yield format_sse(event_type, payload)
+                if ends_stream(job_id, event_type, payload):
+                    return
+            while True:
+                try:
+                    event_type, payload = subscriber.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event_matches(job_id, payload):
+                    yield format_sse(event_type, payload)
+                    if ends_stream(job_id, event_type, payload):
+                        return
+        finally:
+            unsubscribe_events(subscriber)
+
+    return Response(stream(), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+RESULT_FIELDS = ("id", "timestamp", "download", "upload", "ping", "url", "server_id", "server_name") + tuple(DERIVED_METRICS) + ("site_id",)
+RESULTS_PAGE_SIZE = 50
+RESULTS_MAX_PAGE_SIZE = 1000
+
+def parse_timestamp_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    # Stored timestamps are str(datetime), which sorts lexically.
+    return str(datetime.fromisoformat(value))
+
+def encode_cursor(timestamp, row_id):
+    return base64.urlsafe_b64encode(f"{timestamp}|{row_id}".encode()).decode()
+
+def decode_cursor(cursor):
+    timestamp, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+    return timestamp, int(row_id)
+
+@app.route("/api/results")
+def api_results():
+    try:
+        fields = request.args.get("fields")
+        fields = [f.strip() for f in fields.split(",") if f.strip()] if fields else list(RESULT_FIELDS)
+        unknown = [f for f in fields if f not in RESULT_FIELDS]
+        if unknown:
+            return jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400
+        limit = max(min(int(request.args.get("limit", RESULTS_PAGE_SIZE)), RESULTS_MAX_PAGE_SIZE), 1)
+        since = parse_timestamp_arg("since")
+        until = parse_timestamp_arg("until")
+        server_id = request.args.get("server_id", type=int)
+        site_id = request.args.get("site_id")
+        after = request.args.get("cursor")
+        after = decode_cursor(after) if after else None
+    except (ValueError, UnicodeDecodeError, binascii.Error) as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+
+    # Keyset pagination on (timestamp, id): every page is a range scan of
+    # idx_results_timestamp, idx_results_server_timestamp or
+    # idx_results_site_timestamp, however deep.
+    where = []
+    params = []
+    if server_id is not None:
+        where.append("server_id = ?")
+        params.append(server_id)
+    if site_id:
+        where.append("site_id = ?")
+        params.append(site_id)
+    if since:
+        where.append("timestamp >= ?")
+        params.append(since)
+    if until:
+        where.append("timestamp < ?")
+        params.append(until)
+    if after:
+        where.append("(timestamp, id) < (?, ?)")
+        params.extend(after)
+    columns = list(dict.fromkeys(fields + ["timestamp", "id"]))
+    query = f"SELECT {', '.join(columns)} FROM speedtest_results"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+    params.append(limit + 1)
+
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        rows = cursor.execute(query, params).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["timestamp"], rows[-1]["id"])
+    return jsonify({
+        "results": [{field: row[field] for field in fields} for row in rows],
+        "next_cursor": next_cursor
+    })
+
+CHART_POINTS = 500
+CHART_MAX_POINTS = 5000
+
+def lttb(xs, ys, threshold):
+    # Largest-Triangle-Three-Buckets: returns the indices of the points to
+    # keep so the downsampled line preserves the visual shape of the series.
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    selected = [0]
+    bucket_size = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        next_count = next_end - end
+        avg_x = sum(xs[end:next_end]) / next_count
+        avg_y = sum(ys[end:next_end]) / next_count
+        ax, ay = xs[a], ys[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
+
+@app.route("/api/results/<int:result_id>/raw")
+def api_raw_result(result_id):
+    data = load_raw_result(result_id)
+    if data is None:
+        return jsonify({"error": "No raw result archived for this test"}), 404
+    return jsonify(data)
+
+@app.route("/api/chart")
+def api_chart():
+    try:
+        since = parse_timestamp_arg("since")
+        until = parse_timestamp_arg("until")
+        points = max(min(int(request.args.get("points", CHART_POINTS)), CHART_MAX_POINTS), 3)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+    resolution = request.args.get("resolution", "auto")
+    stat = request.args.get("stat", "avg")
+    if resolution not in ("auto", "raw") + ROLLUP_RESOLUTIONS:
+        return jsonify({"error": f"Unknown resolution: {resolution}"}), 400
+    if stat not in ("min", "avg", "max", "p95"):
+        return jsonify({"error": f"Unknown stat: {stat}"}), 400
+    site_id = request.args.get("site_id")
+
+    def series_query(resolution):
+        if resolution == "raw":
+            table, column, columns = "speedtest_results", "timestamp", "download, upload, ping"
+            where, params = [], []
+        else:
+            table, column = "site_rollups" if site_id else "speedtest_rollups", "bucket"
+            columns = f"download_{stat}, upload_{stat}, ping_{stat}"
+            where, params = ["resolution = ?"], [resolution]
+        if site_id:
+            where.append("site_id = ?")
+            params.append(site_id)
+        if since:
+            where.append(f"{column} >= ?")
+            params.append(since)
+        if until:
+            where.append(f"{column} < ?")
+            params.append(until)
+        where = " WHERE " + " AND ".join(where) if where else ""
+        return column, columns, f"FROM {table}{where}", params
+
+    with get_db() as conn:
+        if resolution == "auto":
+            # Finest resolution that fits the point budget; LTTB trims the rest.
+            for resolution in ("raw",) + ROLLUP_RESOLUTIONS:
+                _, _, source, params = series_query(resolution)
+                if conn.execute(f"SELECT COUNT(*) {source}", params).fetchone()[0] <= points:
+                    break
+        column, columns, source, params = series_query(resolution)
+        rows = conn.execute(f"SELECT {column}, {columns} {source} ORDER BY {column}", params).fetchall()
+
+    # Downsample on download and keep the same timestamps for every series
+    # so the chart can share one label axis.
+    xs = [datetime.fromisoformat(row[0]).timestamp() for row in rows]
+    ys = [row[1] or 0.0 for row in rows]
+    rows = [rows[i] for i in lttb(xs, ys, points)]
+    return jsonify({
+        "resolution": resolution,
+        "labels": [row[0] for row in rows],
+        "download": [row[1] for row in rows],
+        "upload": [row[2] for row in rows],
+        "ping": [row[3] for row in rows]
+    })
+
+# Cross-server analytics. Percentiles are nearest-rank, like percentile(),
+# read from the analytics_bins histograms for whole days and from the
+# results themselves for the partial days at either end of the window.
+ANALYTICS_PERCENTILES = (5, 50, 95)
+ANALYTICS_DAYS = 30
+ANALYTICS_MIN_SAMPLES = 5
+ANALYTICS_CACHE_SIZE = 32
+ANALYTICS_WARM_TTL = 3600
+# Inserts arriving within this many seconds share one recompute.
+ANALYTICS_WARM_DELAY = 5
+# Change log entries older than this are dropped by prune_db().
+ANALYTICS_CHANGES_KEEP = 3600
+analytics_cache = OrderedDict()
+analytics_recent = OrderedDict()
+analytics_seen = {"id": 0}
+analytics_warm = {"pending": False}
+analytics_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='analytics')
+
+def analytics_ranges(since, until):
+    # Splits [since, until) into whole months and whole days, read from
+    # analytics_bins as (span, start, end) with end None for open-ended,
+    # and the partial days left at either end, read from the results.
+    first_day = rollup_bucket("day", datetime.fromisoformat(since))
+    if str(first_day) != since:
+        first_day += timedelta(days=1)
+    last_day = rollup_bucket("day", datetime.fromisoformat(until)) if until else None
+    if last_day is not None and last_day < first_day:
+        return [], [(since, until)]
+    edges = []
+    if str(first_day) != since:
+        edges.append((since, str(first_day)))
+    if last_day is not None and str(last_day) != until:
+        edges.append((str(last_day), until))
+
+    first_month = first_day.replace(day=1)
+    if first_month < first_day:
+        first_month = (first_month + timedelta(days=31)).replace(day=1)
+    last_month = last_day.replace(day=1) if last_day else None
+    if last_month is not None and last_month <= first_month:
+        return [("day", first_day, last_day)], edges
+    ranges = [("month", first_month, last_month)]
+    if first_day < first_month:
+        ranges.append(("day", first_day, first_month))
+    if last_month is not None and last_month < last_day:
+        ranges.append(("day", last_month, last_day))
+    return ranges, edges
+
+def binned_stats(conn, family, metrics, since, until, site_id, server_id):
+    ranges, edges = analytics_ranges(since, until)
+    stored, select = family, "grp"
+    if family == "hour" and server_id is not None:
+        # One server's hours come from server_hour, unpacked back to hours.
+        stored, select = "server_hour", f"grp - {int(server_id) * 24}"
+    parts, params = [], []
+    for span, start, end in ranges:
+        where = ["family = ?", "span = ?", "start >= ?", f"metric IN ({', '.join('?' * len(metrics))})"]
+        params.extend([stored, span, start.date().isoformat(), *metrics])
+        if end:
+            where.append("start < ?")
+            params.append(end.date().isoformat())
+        if site_id:
+            where.append("site_id = ?")
+            params.append(site_id)
+        if stored == "server_hour":
+            where.append("grp BETWEEN ? AND ?")
+            params.extend([server_id * 24, server_id * 24 + 23])
+        elif server_id is not None:
+            where.append("grp = ?")
+            params.append(server_id)
+        parts.append(f'SELECT {select} AS grp, metric, bin, count, total FROM analytics_bins WHERE {" AND ".join(where)}')
+    for start, end in edges:
+        for metric in metrics:
+            where = ["timestamp >= ?", f"{metric} IS NOT NULL"]
+            params.append(start)
+            if end:
+                where.append("timestamp < ?")
+                params.append(end)
+            if site_id:
+                where.append("site_id = ?")
+                params.append(site_id)
+            if server_id is not None:
+                where.append("server_id = ?")
+                params.append(server_id)
+            parts.append(f'''
+                SELECT {ANALYTICS_GROUPS[family]} AS grp, '{metric}' AS metric, analytics_bin({metric}) AS bin,
+                       1 AS count, {metric} AS total
+                FROM speedtest_results WHERE {" AND ".join(where)}
+            ''')
+    stats = {metric: {} for metric in metrics}
+    if not parts:
+        return stats
+    rows = conn.execute(f'''
+        SELECT grp, metric, bin, SUM(count), SUM(total)
+        FROM ({" UNION ALL ".join(parts)})
+        GROUP BY grp, metric, bin HAVING SUM(count) > 0
+        ORDER BY grp, metric, bin
+    ''', params).fetchall()
+    for (group, metric), bins in itertools.groupby(rows, key=lambda row: row[:2]):
+        bins = [row[2:] for row in bins]
+        count = sum(row[1] for row in bins)
+        ranks = {p: max(math.ceil(p / 100 * count), 1) for p in ANALYTICS_PERCENTILES}
+        picks = {}
+        seen = 0
+        for index, bin_count, total in bins:
+            seen += bin_count
+            for p, rank in ranks.items():
+                if p not in picks and seen >= rank:
+                    picks[p] = analytics_bin_value(index)
+        if family == "server" and group == -1:
+            group = None
+        stats[metric][group] = dict(
+            count=count,
+            avg=sum(row[2] for row in bins) / count,
+            **{f"p{p}": picks[p] for p in ANALYTICS_PERCENTILES}
+        )
+    return stats
+
+def scheduled_availability(conn, where, params):
+    # Share of scheduled tests that produced a result. Cancelled tests and
+    # ones skipped because another test held the link say nothing about
+    # the connection, so they are left out.
+    # Grouping by status alone follows idx_test_jobs_scheduled, so only
+    # the failures, a small share, are sorted by cause.
+    query = f'''
+        FROM test_jobs
+        WHERE source = 'scheduled' AND status IN ('done', 'failed')
+          AND COALESCE(cause, '') NOT IN ('cancelled', 'lock_busy')
+          {"".join(" AND " + clause for clause in where)}
+    '''
+    counts = dict(conn.execute(f'SELECT status, COUNT(*) {query} GROUP BY status', params).fetchall())
+    failures = dict(conn.execute(f"SELECT cause, COUNT(*) {query} AND status = 'failed' GROUP BY cause", params).fetchall())
+    scheduled = sum(counts.values())
+    succeeded = counts.get("done", 0)
+    return {
+        "scheduled": scheduled,
+        "succeeded": succeeded,
+        "ratio": succeeded / scheduled if scheduled else None,
+        "failures": failures
+    }
+
+def build_analytics(metric, since, until, site_id, server_id):
+    # test_jobs.created is isoformat(), with a T between date and time.
+    job_where, job_params = ["created >= ?"], [since.replace(" ", "T")]
+    if until:
+        job_where.append("created < ?")
+        job_params.append(until.replace(" ", "T"))
+    if server_id is not None:
+        job_where.append("server_id = ?")
+        job_params.append(server_id)
+    with get_db() as conn:
+        per_server = binned_stats(conn, "server", ROLLUP_METRICS, since, until, site_id, server_id)
+        per_hour = binned_stats(conn, "hour", (metric,), since, until, site_id, server_id)[metric]
+        names = {
+            server: conn.execute(
+                'SELECT server_name FROM speedtest_results WHERE server_id IS ? ORDER BY timestamp DESC LIMIT 1',
+                (server,)
+            ).fetchone()[0]
+            for server in per_server[metric]
+        }
+        # Test jobs are only recorded where they ran, so a collector knows
+        # the availability of its own site alone.
+        availability = scheduled_availability(conn, job_where, job_params) if site_id in (None, SITE_ID) else None
+
+    # Rank on the median; lower is worse for bandwidth and better for ping.
+    # Medians read from the same bin are equal, so the exact mean settles
+    # those ties. Servers with too few samples to judge are listed but not
+    # ranked.
+    stats = per_server[metric]
+    eligible = sorted(
+        (server for server in stats if stats[server]["count"] >= ANALYTICS_MIN_SAMPLES),
+        key=lambda server: (stats[server]["p50"] * ANOMALY_METRICS[metric], stats[server]["avg"] * ANOMALY_METRICS[metric])
+    )
+    servers = [
+        dict(
+            server_id=server,
+            server_name=names[server],
+            rank=eligible.index(server) + 1 if server in eligible else None,
+            **{name: per_server[name].get(server) for name in ANOMALY_METRICS}
+        )
+        for server in eligible + [server for server in stats if server not in eligible]
+    ]
+    return {
+        "metric": metric,
+        "since": since,
+        "until": until,
+        "servers": servers,
+        "best_server": servers[0] if eligible else None,
+        "hours": [dict(hour=hour, **per_hour[hour]) for hour in sorted(per_hour)],
+        "availability": availability
+    }
+
+def cached_analytics(query):
+    # Returns (etag, data). An entry lives until a change to the results
+    # inside its window expires it, so agent pushes for today leave a
+    # report on last month alone.
+    with page_cache_lock:
+        entry = analytics_cache.get(query)
+        if entry is not None:
+            analytics_cache.move_to_end(query)
+            return entry
+        seen = analytics_seen["id"]
+    with get_db() as conn:
+        changed = last_analytics_change(conn, query[1], query[2])
+    data = build_analytics(*query)
+    entry = (etag_for("analytics", changed, *query), data)
+    with page_cache_lock:
+        # A change that arrived meanwhile may not be in data.
+        if analytics_seen["id"] == seen:
+            analytics_cache[query] = entry
+            while len(analytics_cache) > ANALYTICS_CACHE_SIZE:
+                analytics_cache.popitem(last=False)
+    return entry
+
+def last_analytics_change(conn, since, until):
+    # The newest logged change inside [since, until), read from the shared
+    # log so every worker tags the same answer alike. Once prune_db() has
+    # dropped it, any change before the oldest kept entry stands in, which
+    # still never goes back to an earlier value.
+    return conn.execute('''
+        SELECT COALESCE(
+            (SELECT MAX(id) FROM analytics_changes WHERE until >= ? AND (? IS NULL OR since < ?)),
+            (SELECT MIN(id) - 1 FROM analytics_changes),
+            (SELECT seq FROM sqlite_sequence WHERE name = 'analytics_changes'),
+            0
+        )
+    ''', (since, until, until)).fetchone()[0]
+
+def expire_analytics():
+    # Called after the results version changes. Reads the spans logged by
+    # count_analytics() since the last call and drops the cached answers
+    # whose window overlaps one of them.
+    with get_db() as conn:
+        changes = conn.execute(
+            'SELECT id, since, until FROM analytics_changes WHERE id > ? ORDER BY id',
+            (analytics_seen["id"],)
+        ).fetchall()
+    if not changes:
+        return
+    with page_cache_lock:
+        analytics_seen["id"] = max(analytics_seen["id"], changes[-1][0])
+        stale = [
+            query for query in analytics_cache
+            if any(end >= query[1] and (query[2] is None or start < query[2]) for _, start, end in changes)
+        ]
+        for query in stale:
+            del analytics_cache[query]
+        if stale and not analytics_warm["pending"]:
+            analytics_warm["pending"] = True
+            analytics_executor.submit(warm_analytics)
+
+def warm_analytics():
+    # Recomputes the expired answers asked for in the last hour so the
+    # next dashboard request does not wait for them. The delay lets a
+    # burst of inserts or pushes settle first.
+    time.sleep(ANALYTICS_WARM_DELAY)
+    with page_cache_lock:
+        analytics_warm["pending"] = False
+        queries = [
+            query for query, asked in analytics_recent.items()
+            if time.time() - asked < ANALYTICS_WARM_TTL and query not in analytics_cache
+        ]
+    for query in reversed(queries):
+        try:
+            cached_analytics(query)
+        except sqlite3.Error as e:
+            app.logger.warning(f"Analytics refresh failed: {e}")
+            return
+
+@app.route("/api/analytics")
+def api_analytics():
+    try:
+        since = parse_timestamp_arg("since")
+        until = parse_timestamp_arg("until")
+        server_id = request.args.get("server_id", type=int)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+    metric = request.args.get("metric", "download")
+    if metric not in ANOMALY_METRICS:
+        return jsonify({"error": f"Unknown metric: {metric}"}), 400
+    site_id = request.args.get("site_id")
+    if not since:
+        # Whole days, so the default window keeps one cache key all day.
+        since = str((datetime.now() - timedelta(days=ANALYTICS_DAYS)).replace(hour=0, minute=0, second=0, microsecond=0))
+
+    query = (metric, since, until, site_id, server_id)
+    with page_cache_lock:
+        analytics_recent[query] = time.time()
+        analytics_recent.move_to_end(query)
+        while len(analytics_recent) > ANALYTICS_CACHE_SIZE:
+            analytics_recent.popitem(last=False)
+    etag, data = cached_analytics(query)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(data)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+# Bulk export/import. Every format is streamed in EXPORT_CHUNK_ROWS chunks
+# so a multi-million row history never has to fit in memory.
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "columnar": "application/vnd.speedtest.columnar"
+}
+EXPORT_EXTENSIONS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson", ".stcol": "columnar"}
+EXPORT_CHUNK_ROWS = 5000
+IMPORT_BATCH_ROWS = 1000
+RESULT_COLUMN_TYPES = {
+    "id": "int", "timestamp": "str", "download": "float", "upload": "float", "ping": "float",
+    "url": "str", "server_id": "int", "server_name": "str", "jitter": "float",
+    "packet_loss": "float", "download_bytes": "int", "upload_bytes": "int",
+    "download_elapsed": "int", "upload_elapsed": "int", "download_latency_iqm": "float",
+    "upload_latency_iqm": "float", "isp": "str", "interface": "str", "site_id": "str"
+}
+IMPORT_COLUMNS = [field for field in RESULT_FIELDS if field != "id"]
+IMPORT_REQUIRED = ("timestamp", "download", "upload", "ping")
+
+# Columnar layout: magic, a length-prefixed JSON schema, then row groups of
+# <row count><per column: length-prefixed zlib block>, ended by a zero count.
+# A block is one validity byte per row followed by little-endian values
+# (float64/int64) or, for text, uint32 lengths and the concatenated UTF-8.
+COLUMNAR_MAGIC = b"STCOL1\n"
+COLUMNAR_ARRAYS = {"float": "d", "int": "q"}
+
+def export_rows(since=None, until=None, server_id=None, site_id=None):
+    where = []
+    params = []
+    if server_id is not None:
+        where.append("server_id = ?")
+        params.append(server_id)
+    if site_id:
+        where.append("site_id = ?")
+        params.append(site_id)
+    if since:
+        where.append("timestamp >= ?")
+        params.append(since)
+    if until:
+        where.append("timestamp < ?")
+        params.append(until)
+    query = f"SELECT {', '.join(RESULT_FIELDS)} FROM speedtest_results"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY timestamp, id"
+    with get_db() as conn:
+        cursor = conn.execute(query, params)
+        while True:
+            chunk = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+            if not chunk:
+                return
+            yield chunk
+
+def little_endian(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+def encode_column(kind, values):
+    validity = bytes(0 if value is None else 1 for value in values)
+    if kind in COLUMNAR_ARRAYS:
+        body = little_endian(array(COLUMNAR_ARRAYS[kind], [value or 0 for value in values])).tobytes()
+    else:
+        encoded = [b"" if value is None else str(value).encode() for value in values]
+        body = little_endian(array("I", map(len, encoded))).tobytes() + b"".join(encoded)
+    return zlib.compress(validity + body)
+
+def decode_column(kind, block, count):
+    block = zlib.decompress(block)
+    validity, body = block[:count], block[count:]
+    if kind in COLUMNAR_ARRAYS:
+        values = array(COLUMNAR_ARRAYS[kind])
+        values.frombytes(body[:values.itemsize * count])
+        values = little_endian(values).tolist()
+    else:
+        lengths = array("I")
+        lengths.frombytes(body[:lengths.itemsize * count])
+        offset = lengths.itemsize * count
+        values = []
+        for length in little_endian(lengths):
+            values.append(body[offset:offset + length].decode())
+            offset += length
+    return [value if valid else None for value, valid in zip(values, validity)]
+
+def export_chunks(export_format, chunks):
+    if export_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(RESULT_FIELDS)
+        for chunk in chunks:
+            writer.writerows(chunk)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue().encode()
+    elif export_format == "ndjson":
+        for chunk in chunks:
+            yield "".join(json.dumps(dict(zip(RESULT_FIELDS, row))) + "\n" for row in chunk).encode()
+    else:
+        schema = json.dumps({"columns": [[field, RESULT_COLUMN_TYPES[field]] for field in RESULT_FIELDS]}).encode()
+        yield COLUMNAR_MAGIC + struct.pack("<I", len(schema)) + schema
+        for chunk in chunks:
+            parts = [struct.pack("<I", len(chunk))]
+            for index, field in enumerate(RESULT_FIELDS):
+                block = encode_column(RESULT_COLUMN_TYPES[field], [row[index] for row in chunk])
+                parts.append(struct.pack("<I", len(block)) + block)
+            yield b"".join(parts)
+        yield struct.pack("<I", 0)
+
+def read_exact(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            raise ValueError("Truncated columnar file")
+        data += more
+    return data
+
+def read_columnar(stream):
+    if read_exact(stream, len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError("Not a columnar results file")
+    schema = json.loads(read_exact(stream, struct.unpack("<I", read_exact(stream, 4))[0]))
+    columns = schema["columns"]
+    while True:
+        count = struct.unpack("<I", read_exact(stream, 4))[0]
+        if not count:
+            return
+        values = []
+        for _, kind in columns:
+            size = struct.unpack("<I", read_exact(stream, 4))[0]
+            values.append(decode_column(kind, read_exact(stream, size), count))
+        names = [name for name, _ in columns]
+        for row in zip(*values):
+            yield dict(zip(names, row))
+
+def coerce_import_value(field, value):
+    if value is None or value == "":
+        return None
+    kind = RESULT_COLUMN_TYPES[field]
+    if field == "timestamp":
+        return str(datetime.fromisoformat(str(value)))
+    if kind == "float":
+        return float(value)
+    if kind == "int":
+        return int(float(value))
+    return str(value)
+
+def parse_import(import_format, stream):
+    # Yields dict rows from a binary stream in any export format.
+    if import_format == "columnar":
+        yield from read_columnar(stream)
+        return
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    if import_format == "csv":
+        yield from csv.DictReader(text)
+    else:
+        for line in text:
+            if line.strip():
+                yield json.loads(line)
+
+def import_row(record, line, site_id=None):
+    missing = [field for field in IMPORT_REQUIRED if record.get(field) in (None, "")]
+    if missing:
+        raise ValueError(f"Row {line}: missing {', '.join(missing)}")
+    try:
+        row = [coerce_import_value(field, record.get(field)) for field in IMPORT_COLUMNS]
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Row {line}: {e}")
+    # A collector files pushed rows under the pushing site; files from
+    # before site tagging belong to this one.
+    if site_id or row[SITE_INDEX] is None:
+        row[SITE_INDEX] = site_id or SITE_ID
+    return row
+
+SITE_INDEX = IMPORT_COLUMNS.index("site_id")
+
+def import_results(records, site_id=None, defer_rollups=False):
+    # A result is identified by its share URL, or by (timestamp, server_id,
+    # site_id) when it has none, so re-importing an export is a no-op. All
+    # batches go through one transaction: a bad row leaves the database
+    # untouched. With defer_rollups the touched buckets are only marked for
+    # flush_rollups(), so frequent small pushes do not each re-aggregate.
+    columns = ", ".join(IMPORT_COLUMNS)
+    placeholders = ", ".join("?" * len(IMPORT_COLUMNS))
+    url_index = IMPORT_COLUMNS.index("url")
+    server_index = IMPORT_COLUMNS.index("server_id")
+    insert_by_url = f'''
+        INSERT INTO speedtest_results ({columns})
+        SELECT {placeholders}
+        WHERE NOT EXISTS (SELECT 1 FROM speedtest_results WHERE url = ?)
+    '''
+    insert_by_time = f'''
+        INSERT INTO speedtest_results ({columns})
+        SELECT {placeholders}
+        WHERE NOT EXISTS (SELECT 1 FROM speedtest_results WHERE timestamp = ? AND server_id IS ? AND site_id IS ?)
+    '''
+    read = 0
+    earliest = None
+    touched = set()
+    with get_db() as conn:
+        # Taking the write lock first means every id above last_id is ours.
+        conn.execute('BEGIN IMMEDIATE')
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM speedtest_results').fetchone()[0]
+        before = conn.total_changes
+
+        def flush(batch):
+            conn.executemany(insert_by_url, [row + [row[url_index]] for row in batch if row[url_index]])
+            conn.executemany(insert_by_time, [row + [row[0], row[server_index], row[SITE_INDEX]] for row in batch if not row[url_index]])
+
+        batch = []
+        for line, record in enumerate(records, start=1):
+            row = import_row(record, line, site_id)
+            batch.append(row)
+            if earliest is None or row[0] < earliest:
+                earliest = row[0]
+            if defer_rollups:
+                timestamp = datetime.fromisoformat(row[0])
+                for resolution in ROLLUP_RESOLUTIONS:
+                    bucket = str(rollup_bucket(resolution, timestamp))
+                    touched.update([("", resolution, bucket), (row[SITE_INDEX], resolution, bucket)])
+            if len(batch) >= IMPORT_BATCH_ROWS:
+                flush(batch)
+                read += len(batch)
+                batch = []
+        flush(batch)
+        read += len(batch)
+        imported = conn.total_changes - before
+        if imported:
+            count_analytics(conn, "id > ?", (last_id,))
+        if imported and defer_rollups:
+            conn.executemany('INSERT OR IGNORE INTO rollup_dirty (site_id, resolution, bucket) VALUES (?, ?, ?)', touched)
+        elif imported:
+            rebuild_rollups(conn, datetime.fromisoformat(earliest))
+            rebuild_site_rollups(conn, datetime.fromisoformat(earliest))
+    if imported:
+        bump_content_version("results")
+        if not defer_rollups:
+            load_metrics_snapshot()
+    return {"read": read, "imported": imported, "skipped": read - imported}
+
+@app.route("/api/export")
+def api_export():
+    export_format = request.args.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"Unknown format: {export_format}"}), 400
+    try:
+        since = parse_timestamp_arg("since")
+        until = parse_timestamp_arg("until")
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+    server_id = request.args.get("server_id", type=int)
+    extension = next(ext for ext, fmt in EXPORT_EXTENSIONS.items() if fmt == export_format)
+    return Response(
+        export_chunks(export_format, export_rows(since, until, server_id, request.args.get("site_id"))),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f"attachment; filename=speedtest-results{extension}"}
+    )
+
+@app.route("/api/import", methods=["POST"])
+def api_import():
+    if not is_authorised():
+        return jsonify({"error": "Not authorised"}), 403
+    import_format = request.args.get("format")
+    if not import_format:
+        mimetype = request.mimetype
+        import_format = next((fmt for fmt, mime in EXPORT_FORMATS.items() if mime == mimetype), None)
+    if import_format not in EXPORT_FORMATS:
+        return jsonify({"error": "Unknown import format; pass ?format=csv|ndjson|columnar"}), 400
+    try:
+        summary = import_results(parse_import(import_format, request.stream))
+    except (ValueError, KeyError, UnicodeDecodeError, zlib.error, struct.error) as e:
+        return jsonify({"error": f"Import failed: {e}"}), 400
+    return jsonify(summary)
+
+# Fleet mode. Agents (SPEEDTEST_COLLECTOR_URL set) push their own results
+# to a collector in gzipped NDJSON batches; the collector (which accepts
+# pushes when SPEEDTEST_COLLECTOR_TOKEN is set) files them under the
+# agent's site_id, so the usual results, export and chart views cover every
+# site and site_rollups holds per-site aggregates. The local database is
+# the agent's buffer: push_state remembers the last result the collector
+# acknowledged, and a push that fails is resent on the next run. A batch
+# the collector rejects outright would fail the same way every time, so its
+# id range is set aside in push_rejected and the push moves on.
+COLLECTOR_URL = os.environ.get('SPEEDTEST_COLLECTOR_URL')
+COLLECTOR_TOKEN = os.environ.get('SPEEDTEST_COLLECTOR_TOKEN')
+PUSH_INTERVAL = int(os.environ.get('SPEEDTEST_PUSH_INTERVAL', 300))
+PUSH_BATCH_ROWS = 1000
+PUSH_TIMEOUT = (3.05, 30)
+PUSH_ATTEMPTS = 3
+# 4xx answers about the agent or the collector rather than the batch itself;
+# the same rows go again on the next run.
+PUSH_RETRY_STATUSES = (401, 403, 404, 408, 429)
+ROLLUP_FLUSH_INTERVAL = 60
+SITE_ID_MAX_LENGTH = 64
+
+def push_batch(rows):
+    import requests
+    body = gzip.compress(b"".join(export_chunks("ndjson", [rows])), 6)
+    headers = {
+        "Content-Type": EXPORT_FORMATS["ndjson"],
+        "Content-Encoding": "gzip",
+        "X-Speedtest-Site": SITE_ID,
+        # Identical for a resend of the same rows, so the collector can
+        # answer a retry without importing again.
+        "Idempotency-Key": f"{SITE_ID}:{rows[0][0]}-{rows[-1][0]}"
+    }
+    if COLLECTOR_TOKEN:
+        headers["Authorization"] = f"Bearer {COLLECTOR_TOKEN}"
+    for attempt in range(PUSH_ATTEMPTS):
+        try:
+            response = get_http().post(f"{COLLECTOR_URL.rstrip('/')}/api/ingest", data=body, headers=headers, timeout=PUSH_TIMEOUT)
+            if response.status_code < 500:
+                response.raise_for_status()
+                return response.json()
+            error = f"collector answered {response.status_code}"
+        except requests.HTTPError:
+            raise
+        except requests.RequestException as e:
+            error = str(e)
+        if attempt + 1 < PUSH_ATTEMPTS:
+            time.sleep(2 ** attempt)
+    raise requests.RequestException(error)
+
+def push_results():
+    import requests
+    pushed = 0
+    while True:
+        with get_db() as conn:
+            last_id = conn.execute('SELECT last_result_id FROM push_state WHERE id = 1').fetchone()[0]
+            rows = conn.execute(f'''
+                SELECT {', '.join(RESULT_FIELDS)} FROM speedtest_results
+                WHERE id > ? AND site_id = ? ORDER BY id LIMIT ?
+            ''', (last_id, SITE_ID, PUSH_BATCH_ROWS)).fetchall()
+        if not rows:
+            break
+        try:
+            push_batch(rows)
+        except requests.HTTPError as e:
+            status = e.response.status_code
+            if status in PUSH_RETRY_STATUSES:
+                app.logger.warning(f"Pushing results to {COLLECTOR_URL} failed, will retry: {e}")
+                with get_db() as conn:
+                    conn.execute('UPDATE push_state SET last_error = ? WHERE id = 1', (str(e),))
+                break
+            error = f"{e}: {e.response.text[:500]}"
+            app.logger.error(f"{COLLECTOR_URL} rejected results {rows[0][0]}-{rows[-1][0]}, skipping them: {error}")
+            with get_db() as conn:
+                conn.execute('INSERT OR REPLACE INTO push_rejected (first_id, last_id, status, error, rejected) VALUES (?, ?, ?, ?, ?)',
+                             (rows[0][0], rows[-1][0], status, error, datetime.now().isoformat()))
+                conn.execute('UPDATE push_state SET last_result_id = ?, last_error = ? WHERE id = 1', (rows[-1][0], error))
+            if len(rows) < PUSH_BATCH_ROWS:
+                break
+            continue
+        except (requests.RequestException, ValueError) as e:
+            app.logger.warning(f"Pushing results to {COLLECTOR_URL} failed, will retry: {e}")
+            with get_db() as conn:
+                conn.execute('UPDATE push_state SET last_error = ? WHERE id = 1', (str(e),))
+            break
+        pushed += len(rows)
+        with get_db() as conn:
+            conn.execute('UPDATE push_state SET last_result_id = ?, last_push = ?, last_error = NULL WHERE id = 1',
+                         (rows[-1][0], datetime.now().isoformat()))
+        if len(rows) < PUSH_BATCH_ROWS:
+            break
+    if pushed:
+        app.logger.info(f"Pushed {pushed} results to {COLLECTOR_URL}")
+    return pushed
+
+def flush_rollups():
+    # Re-aggregates the buckets ingests marked since the last flush. The
+    # DELETE takes the write lock first, so a push landing meanwhile marks
+    # its buckets again for the next flush rather than being missed.
+    with get_db() as conn:
+        dirty = conn.execute('DELETE FROM rollup_dirty RETURNING site_id, resolution, bucket').fetchall()
+        by_site = {}
+        for site_id, resolution, bucket in dirty:
+            row = bucket_rollup(conn, resolution, datetime.fromisoformat(bucket), site_id or None)
+            if row:
+                by_site.setdefault(site_id, []).append(row)
+        for site_id, rollup_rows in by_site.items():
+            write_rollups(conn, rollup_rows, site_id or None)
+    return len(dirty)
+
+@app.route("/api/ingest", methods=["POST"])
+def api_ingest():
+    if not COLLECTOR_TOKEN:
+        return jsonify({"error": "This instance does not accept pushed results"}), 404
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {COLLECTOR_TOKEN}"):
+        return jsonify({"error": "Not authorised"}), 403
+    site_id = request.headers.get("X-Speedtest-Site", "").strip()
+    if not site_id or len(site_id) > SITE_ID_MAX_LENGTH:
+        return jsonify({"error": "X-Speedtest-Site must name the pushing site"}), 400
+    key = request.headers.get("Idempotency-Key")
+    if key:
+        with get_db() as conn:
+            row = conn.execute('SELECT read, imported FROM ingest_batches WHERE key = ?', (key,)).fetchone()
+        if row:
+            return jsonify({"read": row[0], "imported": row[1], "skipped": row[0] - row[1], "replayed": True})
+    stream = request.stream
+    if request.headers.get("Content-Encoding") == "gzip":
+        stream = gzip.GzipFile(fileobj=stream)
+    try:
+        summary = import_results(parse_import("ndjson", stream), site_id=site_id, defer_rollups=True)
+    except (ValueError, KeyError, UnicodeDecodeError, OSError, EOFError, zlib.error) as e:
+        return jsonify({"error": f"Ingest failed: {e}"}), 400
+    if key:
+        with get_db() as conn:
+            conn.execute('INSERT OR IGNORE INTO ingest_batches (key, site_id, received, read, imported) VALUES (?, ?, ?, ?, ?)',
+                         (key, site_id, datetime.now().isoformat(), summary["read"], summary["imported"]))
+    return jsonify(summary)
+
+@app.route("/api/sites")
+def api_sites():
+    # Counts come from the weekly rollups and the last result from the
+    # (site_id, timestamp) index, so this stays cheap with many sites.
+    with get_db() as conn:
+        rows = conn.execute('''
+            SELECT site_id, SUM(count),
+                   (SELECT MAX(timestamp) FROM speedtest_results WHERE site_id = site_rollups.site_id)
+            FROM site_rollups WHERE resolution = 'week'
+            GROUP BY site_id ORDER BY site_id
+        ''').fetchall()
+    return jsonify([{"site_id": site_id, "results": count, "last_result": last} for site_id, count, last in rows])
+
+ROLLUP_FIELDS = tuple(field.strip() for field in ROLLUP_COLUMNS.split(","))
+
+@app.route("/api/sites/<site_id>/rollups")
+def api_site_rollups(site_id):
+    resolution = request.args.get("resolution", "day")
+    if resolution not in ROLLUP_RESOLUTIONS:
+        return jsonify({"error": f"Unknown resolution: {resolution}"}), 400
+    try:
+        limit = max(min(int(request.args.get("limit", RESULTS_PAGE_SIZE)), RESULTS_MAX_PAGE_SIZE), 1)
+        since = parse_timestamp_arg("since")
+        until = parse_timestamp_arg("until")
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+    where = ["site_id = ?", "resolution = ?"]
+    params = [site_id, resolution]
+    if since:
+        where.append("bucket >= ?")
+        params.append(since)
+    if until:
+        where.append("bucket < ?")
+        params.append(until)
+    query = f"SELECT {', '.join(ROLLUP_FIELDS)} FROM site_rollups WHERE {' AND '.join(where)} ORDER BY bucket DESC LIMIT ?"
+    params.append(limit)
+    with get_db() as conn:
+        rows = conn.execute(query, params).fetchall()
+    return jsonify([dict(zip(ROLLUP_FIELDS, row)) for row in rows])
+
+@app.cli.command("push-results")
+def push_results_command():
+    if not COLLECTOR_URL:
+        raise click.UsageError("Set SPEEDTEST_COLLECTOR_URL to push results.")
+    print(f"Pushed {push_results()} results to {COLLECTOR_URL}.")
+
+def file_format(path, export_format):
+    if export_format:
+        return export_format
+    return EXPORT_EXTENSIONS.get(os.path.splitext(path)[1].lower(), "csv")
+
+@app.cli.command("export-results")
+@click.argument("path", default="-")
+@click.option("--format", "export_format", type=click.Choice(list(EXPORT_FORMATS)), help="Defaults to the file extension, or csv.")
+@click.option("--since", help="ISO timestamp, inclusive.")
+@click.option("--until", help="ISO timestamp, exclusive.")
+@click.option("--server-id", type=int)
+def export_results_command(path, export_format, since, until, server_id):
+    export_format = file_format(path, export_format)
+    since = str(datetime.fromisoformat(since)) if since else None
+    until = str(datetime.fromisoformat(until)) if until else None
+    with click.open_file(path, "wb") as output:
+        for data in export_chunks(export_format, export_rows(since, until, server_id)):
+            output.write(data)
+
+@app.cli.command("import-results")
+@click.argument("path", default="-")
+@click.option("--format", "import_format", type=click.Choice(list(EXPORT_FORMATS)), help="Defaults to the file extension, or csv.")
+def import_results_command(path, import_format):
+    with click.open_file(path, "rb") as source:
+        summary = import_results(parse_import(file_format(path, import_format), source))
+    print(f"Read {summary['read']} results, imported {summary['imported']}, skipped {summary['skipped']} already stored.")
 
 @app.route("/check_lock")
 def check_lock():
@@ -450,6 +4147,7 @@ HTML = """
                 <div id="waitingMessage" class="mt-3 hidden">
                     <div class="alert alert-warning">A speedtest is already in progress. Waiting for it to finish...</div>
                 </div>
+                <div id="progressMessage" class="mt-2 text-muted"></div>
             </div>
             <div class="card-footer">
                 <a href="{{ url_for('results') }}" class="btn btn-secondary">View Results</a>
@@ -482,34 +4180,49 @@ HTML = """
     })
     .then(response => response.json())
     .then(data => {
-        if (data.redirect) {
-            window.location.href = data.redirect; 
-        } else if (data.waiting) {
-            document.getElementById('testingMessage').classList.add('hidden');
-            document.getElementById('waitingMessage').classList.remove('hidden');
-            checkLock();
+        if (data.job_id) {
+            if (data.coalesced) {
+                document.getElementById('testingMessage').classList.add('hidden');
+                document.getElementById('waitingMessage').classList.remove('hidden');
+            }
+            watchJob(data.job_id);
         } else if (data.error) {
-            document.getElementById('testingMessage').classList.add('hidden');
-            document.getElementById('ErrorMessage').innerText = data.error;
-            document.getElementById('error').classList.remove('hidden');
+            showError(data.error);
         }
     })
     .catch(error => {
         console.error('Error:', error);
-        document.getElementById('testingMessage').classList.add('hidden');
-        document.getElementById('ErrorMessage').innerText = "An unexpected error occurred."; 
-        document.getElementById('error').classList.remove('hidden');  
+        showError("An unexpected error occurred.");
     });
 });
 
-        function checkLock() {
-            fetch("{{ url_for('check_lock') }}")
-            .then(response => response.json())
-            .then(data => {
-                if (!data.locked) {
-                window.location.href = "/results";
-                } else {
-                    setTimeout(checkLock, 1000);  
+        function showError(message) {
+            document.getElementById('testingMessage').classList.add('hidden');
+            document.getElementById('waitingMessage').classList.add('hidden');
+            document.getElementById('ErrorMessage').innerText = message;
+            document.getElementById('error').classList.remove('hidden');
+        }
+
+        function watchJob(jobId) {
+            const source = new EventSource("{{ url_for('events') }}?job=" + encodeURIComponent(jobId));
+            source.addEventListener('progress', function(event) {
+                const progress = JSON.parse(event.data);
+                let message = progress.phase + ' ' + Math.round((progress.progress || 0) * 100) + '%';
+                if (progress.bandwidth !== undefined) {
+                    message += ' (' + progress.bandwidth.toFixed(2) + ' Mbps)';
+                } else if (progress.latency !== undefined) {
+                    message += ' (' + progress.latency.toFixed(2) + ' ms)';
+                }
+                document.getElementById('progressMessage').innerText = message;
+            });
+            source.addEventListener('job', function(event) {
+                const job = JSON.parse(event.data);
+                if (job.status === 'done') {
+                    source.close();
+                    window.location.href = "{{ url_for('results') }}";
+                } else if (job.status === 'failed') {
+                    source.close();
+                    showError(job.error);
                 }
             });
         }
@@ -548,6 +4261,14 @@ SETTINGS_HTML = """
                         <label for="server_id">Predefined Server ID (optional):</label>
                         <input type="number" class="form-control" id="server_id" name="server_id" placeholder="Enter Server ID" value="{{ current_server_id if current_server_id else '' }}">
                     </div>
+                    <div class="form-check mt-3">
+                        <input type="checkbox" class="form-check-input" id="adaptive" name="adaptive" {{ 'checked' if adaptive else '' }}>
+                        <label class="form-check-label" for="adaptive">Adaptive interval (test less often while the link is stable, more often when it is not)</label>
+                    </div>
+                    <div class="form-group">
+                        <label for="max_interval">Maximum adaptive interval (in seconds):</label>
+                        <input type="number" class="form-control" id="max_interval" name="max_interval" value="{{ max_interval }}">
+                    </div>
                     <button type="submit" class="btn btn-success mt-3">Save</button>
                 </form>
             </div>
@@ -557,6 +4278,11 @@ SETTINGS_HTML = """
                 <div class="mt-3">
                     <strong>Next Automatic Test:</strong> {{ next_run_time }}
                 </div>
+                {% if adaptive %}
+                <div>
+                    <strong>Current Adaptive Interval:</strong> {{ adaptive_interval }} seconds
+                </div>
+                {% endif %}
             </div>
         </div>
     </div>
@@ -581,6 +4307,13 @@ RESULTS_HTML = """
                 <h1 class="card-title">Speedtest Results</h1>
             </div>
             <div class="card-body">
+                <select class="form-select w-auto mb-3" id="chartRange">
+                    <option value="">Last 10 tests</option>
+                    <option value="1">Last 24 hours</option>
+                    <option value="7">Last 7 days</option>
+                    <option value="30">Last 30 days</option>
+                    <option value="365">Last year</option>
+                </select>
                 <canvas id="speedtestChart" width="400" height="200"></canvas>
                 <script>
                     var ctx = document.getElementById('speedtestChart').getContext('2d');
@@ -613,6 +4346,29 @@ RESULTS_HTML = """
                             }
                         }
                     });
+                    var initialData = {
+                        labels: chart.data.labels,
+                        series: chart.data.datasets.map(dataset => dataset.data)
+                    };
+                    document.getElementById('chartRange').addEventListener('change', function() {
+                        if (!this.value) {
+                            chart.data.labels = initialData.labels;
+                            chart.data.datasets.forEach((dataset, i) => dataset.data = initialData.series[i]);
+                            chart.update();
+                            return;
+                        }
+                        var start = new Date(Date.now() - this.value * 86400000);
+                        var since = new Date(start.getTime() - start.getTimezoneOffset() * 60000).toISOString().slice(0, 19);
+                        fetch("{{ url_for('api_chart') }}?points=500&since=" + encodeURIComponent(since))
+                        .then(response => response.json())
+                        .then(data => {
+                            chart.data.labels = data.labels;
+                            chart.data.datasets[0].data = data.download;
+                            chart.data.datasets[1].data = data.upload;
+                            chart.data.datasets[2].data = data.ping;
+                            chart.update();
+                        });
+                    });
                 </script>
                 <h2 class="mt-4">All Results</h2>
                                 <div class="table-responsive">
@@ -659,4 +4415,4 @@ RESULTS_HTML = """
 """
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5008, debug=True)
+    create_app().run(host="0.0.0.0", port=5008, debug=True)
@@ -0,0 +1,250 @@
+# ASGI entry point, as an alternative to gunicorn.conf.py:
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 5000
+#
+# /events streams live on the event loop, so an idle browser tab costs a
+# coroutine and a small queue instead of a thread. Every other route (/,
+# /results, /settings, /check_lock, the APIs) is the unchanged Flask app,
+# run in a bounded thread pool. Tests still run in app.py's single test
+# worker and the scheduler in its own threads; with several uvicorn workers
+# set SPEEDTEST_LOCK_BACKEND=sqlite, as gunicorn.conf.py does.
+import asyncio
+import io
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import app
+
+WSGI_THREADS = int(os.environ.get("SPEEDTEST_THREADS", 8))
+STREAM_QUEUE_SIZE = 256
+
+wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='wsgi')
+
+class EventFanout:
+    # Subscribes to app.publish_event() like a queue. Each event crosses to
+    # the loop once, which then copies it to every open stream.
+    def __init__(self, loop):
+        self.loop = loop
+        self.streams = set()
+
+    def put_nowait(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self.dispatch, item)
+        except RuntimeError:
+            # The loop has shut down; there is nobody left to stream to.
+            pass
+
+    def dispatch(self, item):
+        for stream in self.streams:
+            if not stream.full():
+                stream.put_nowait(item)
+
+state = {"fanout": None}
+startup_lock = asyncio.Lock()
+
+async def startup():
+    async with startup_lock:
+        if state["fanout"] is None:
+            await asyncio.get_running_loop().run_in_executor(wsgi_executor, app.create_app)
+            state["fanout"] = app.subscribe_events(EventFanout(asyncio.get_running_loop()))
+
+def shutdown():
+    if state["fanout"] is not None:
+        app.unsubscribe_events(state["fanout"])
+        state["fanout"] = None
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await startup()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+class RequestBody(io.RawIOBase):
+    # wsgi.input read straight from receive(). The pool thread running
+    # Flask asks the loop for the next message only when it has used up the
+    # last one, so /api/import and /api/ingest stream in constant memory.
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.pending = b""
+        self.more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending and self.more:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            if message["type"] == "http.disconnect":
+                # A cut-off upload must fail, not import what arrived.
+                raise OSError("Client disconnected during the request body")
+            self.pending = message.get("body", b"")
+            self.more = message.get("more_body", False)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+def wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        # WSGI carries the path as latin-1 decoded bytes.
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        # The body ends where the client's does, with or without a length.
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+async def call_flask(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    environ = wsgi_environ(scope, io.BufferedReader(RequestBody(receive, loop)))
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+        return lambda data: None
+
+    def begin():
+        # The first chunk comes with the call, saving a hop to the pool for
+        # the usual single-chunk response.
+        body = app.app(environ, start_response)
+        chunks = iter(body)
+        return body, chunks, next(chunks, None)
+
+    body, chunks, chunk = await loop.run_in_executor(wsgi_executor, begin)
+    try:
+        await send({"type": "http.response.start", "status": response["status"], "headers": response["headers"]})
+        # Streamed responses such as /api/export pull each chunk in the pool.
+        while chunk is not None:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            chunk = await loop.run_in_executor(wsgi_executor, next, chunks, None)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(body, "close"):
+            await loop.run_in_executor(wsgi_executor, body.close)
+
+async def local_events(job_id, send):
+    stream = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    fanout = state["fanout"]
+    fanout.streams.add(stream)
+    try:
+        events = await asyncio.get_running_loop().run_in_executor(wsgi_executor, app.replay_events, job_id)
+        for event_type, payload in events:
+            await send_sse(send, app.format_sse(event_type, payload))
+            if app.ends_stream(job_id, event_type, payload):
+                return
+        while True:
+            try:
+                event_type, payload = await asyncio.wait_for(stream.get(), app.SSE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                await send_sse(send, ": keep-alive\n\n")
+                continue
+            if app.event_matches(job_id, payload):
+                await send_sse(send, app.format_sse(event_type, payload))
+                if app.ends_stream(job_id, event_type, payload):
+                    return
+    finally:
+        fanout.streams.discard(stream)
+
+async def remote_events(job_id, send):
+    # The job runs in another worker: poll its row, sleeping on the loop.
+    loop = asyncio.get_running_loop()
+    last = None
+    sent = loop.time()
+    while True:
+        events, last = await loop.run_in_executor(wsgi_executor, app.poll_remote_job, job_id, last)
+        if last is None:
+            return
+        if events:
+            for event_type, payload in events:
+                await send_sse(send, app.format_sse(event_type, payload))
+            if any(app.ends_stream(job_id, *event) for event in events):
+                return
+            sent = loop.time()
+        elif loop.time() - sent >= app.SSE_KEEPALIVE:
+            await send_sse(send, ": keep-alive\n\n")
+            sent = loop.time()
+        await asyncio.sleep(app.LEASE_POLL_INTERVAL)
+
+async def send_sse(send, text):
+    await send({"type": "http.response.body", "body": text.encode(), "more_body": True})
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def events(scope, receive, send):
+    job_id = parse_qs(scope["query_string"].decode("latin-1")).get("job", [None])[0]
+    remote = app.follows_remote_job(job_id)
+    if remote and await asyncio.get_running_loop().run_in_executor(wsgi_executor, app.load_job, job_id) is None:
+        body = json.dumps({"error": "Unknown job"}).encode()
+        await send({"type": "http.response.start", "status": 404, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+        return
+    headers = [(b"content-type", b"text/event-stream; charset=utf-8")]
+    headers += [(name.lower().encode(), value.encode()) for name, value in app.SSE_HEADERS.items()]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    stream = remote_events(job_id, send) if remote else local_events(job_id, send)
+    tasks = [asyncio.ensure_future(stream), asyncio.ensure_future(wait_for_disconnect(receive))]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not task.cancelled() and task.exception() and not isinstance(task.exception(), OSError):
+                raise task.exception()
+        if tasks[0] in done and not tasks[0].exception():
+            # The followed job finished: close the response.
+            await send({"type": "http.response.body", "body": b""})
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    # Servers without lifespan support start the app on the first request.
+    await startup()
+    if scope["path"] == "/events" and scope["method"] == "GET":
+        await events(scope, receive, send)
+    else:
+        await call_flask(scope, receive, send)
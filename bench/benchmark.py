@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# Benchmarks for app.py against the fake CLI and the stub servers API.
+#
+#   python bench/benchmark.py                       # everything
+#   python bench/benchmark.py --stages routes --concurrency 16 --duration 20
+#   python bench/benchmark.py --sizes 10000,100000 --json after.json --baseline before.json
+#
+# Each stage runs in its own process with a throwaway database, so the app's
+# import and create_app() startup are measured fresh every time.
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+FAKE_SPEEDTEST = os.path.join(BENCH_DIR, "fake_speedtest.py")
+ROUTES = ("/", "/results", "/check_lock")
+DEFAULT_SIZES = "10000,100000,1000000"
+ROUTE_ROWS = 10000
+QUERY_REPEAT = 20
+SEED_CHUNK = 10000
+
+def summarize(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+
+    def rank(fraction):
+        return samples[max(int(round(fraction * len(samples))) - 1, 0)] * 1000
+
+    return {
+        "count": len(samples),
+        "p50_ms": rank(0.50),
+        "p95_ms": rank(0.95),
+        "p99_ms": rank(0.99),
+        "max_ms": samples[-1] * 1000
+    }
+
+def timed(fn, repeat=QUERY_REPEAT, before=None):
+    samples = []
+    for _ in range(repeat):
+        if before:
+            before()
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+def seed_results(app, rows):
+    # One row every 15 minutes ending now, spread over a few servers.
+    now = datetime.now().replace(microsecond=0)
+    start = now - timedelta(minutes=15 * rows)
+    columns = ("timestamp", "download", "upload", "ping", "url", "server_id", "server_name", "jitter", "packet_loss")
+
+    def generate():
+        for index in range(rows):
+            server_id = 10001 + index % 4
+            yield (
+                str(start + timedelta(minutes=15 * index)),
+                random.gauss(95, 10), random.gauss(20, 2), random.gauss(12, 2),
+                f"https://www.speedtest.net/result/c/bench-{index}",
+                server_id, f"Bench Hosting {server_id - 10000}",
+                abs(random.gauss(1.5, 0.5)), 0.0
+            )
+
+    started = time.perf_counter()
+    with app.get_db() as conn:
+        conn.executemany(
+            f"INSERT INTO speedtest_results ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            generate()
+        )
+        seeded = time.perf_counter() - started
+        started = time.perf_counter()
+        app.rebuild_rollups(conn)
+        rebuilt = time.perf_counter() - started
+    app.bump_content_version("results")
+    return {"seed_s": seeded, "rebuild_rollups_s": rebuilt}
+
+def reset_cooldown(app):
+    with app.get_db() as conn:
+        conn.execute("UPDATE global_cooldown SET last_test_time = NULL")
+
+def wait_for_job(app, job, timeout=60):
+    deadline = time.monotonic() + timeout
+    while job["status"] in ("queued", "running") and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return job["status"]
+
+def stage_routes(app, args):
+    import requests
+    from werkzeug.serving import make_server
+
+    seed_results(app, ROUTE_ROWS)
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    report = {}
+    try:
+        for route in ROUTES:
+            latencies = []
+            errors = [0]
+            lock = threading.Lock()
+            deadline = time.monotonic() + args.duration
+
+            def client():
+                session = requests.Session()
+                local = []
+                failed = 0
+                while time.monotonic() < deadline:
+                    started = time.perf_counter()
+                    try:
+                        response = session.get(base + route, timeout=10)
+                        if response.status_code != 200:
+                            failed += 1
+                    except requests.RequestException:
+                        failed += 1
+                    local.append(time.perf_counter() - started)
+                with lock:
+                    latencies.extend(local)
+                    errors[0] += failed
+
+            started = time.perf_counter()
+            threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            report[route] = dict(summarize(latencies), rps=len(latencies) / elapsed, errors=errors[0])
+    finally:
+        server.shutdown()
+    return report
+
+def stage_db(app, args):
+    report = {"rows": args.rows}
+    report.update(seed_results(app, args.rows))
+    client = app.app.test_client()
+    with app.get_db() as conn:
+        newest, oldest = conn.execute("SELECT MAX(timestamp), MIN(timestamp) FROM speedtest_results").fetchone()
+        middle_id = conn.execute("SELECT id FROM speedtest_results ORDER BY id LIMIT 1 OFFSET ?", (args.rows // 2,)).fetchone()[0]
+        middle_timestamp = conn.execute("SELECT timestamp FROM speedtest_results WHERE id = ?", (middle_id,)).fetchone()[0]
+    last_week = str(datetime.fromisoformat(newest) - timedelta(weeks=1))
+    deep_cursor = app.encode_cursor(middle_timestamp, middle_id)
+
+    def get(url):
+        return lambda: client.get(url)
+
+    def invalidate():
+        app.bump_content_version("results")
+
+    queries = {
+        "api_results_first_page": get("/api/results"),
+        "api_results_deep_page": get(f"/api/results?cursor={deep_cursor}"),
+        "api_results_server": get("/api/results?server_id=10002&limit=200"),
+        "chart_auto_all": get("/api/chart"),
+        "chart_raw_last_week": get(f"/api/chart?resolution=raw&since={last_week}"),
+        "chart_day_all": get("/api/chart?resolution=day"),
+        "metrics_snapshot": app.load_metrics_snapshot,
+        "export_ndjson_last_week": lambda: b"".join(app.export_chunks("ndjson", app.export_rows(since=last_week))),
+    }
+    report["queries"] = {name: timed(fn) for name, fn in queries.items()}
+    report["queries"]["results_page_uncached"] = timed(get("/results"), before=invalidate)
+
+    data = json.loads(subprocess.run([FAKE_SPEEDTEST, "--format=json"], capture_output=True, text=True,
+                                     env=dict(os.environ, FAKE_SPEEDTEST_DELAY="0")).stdout)
+    report["queries"]["save_result"] = timed(lambda: app.save_result(dict(data, result={"url": None}), datetime.now()))
+    return report
+
+def stage_scheduler(app, args):
+    report = {}
+
+    # Lag between a job's due time and the moment the executor runs it.
+    lags = []
+    done = threading.Event()
+    due_times = []
+
+    def tick(index):
+        lags.append(time.time() - due_times[index])
+        if len(lags) == args.jobs:
+            done.set()
+
+    now = time.time()
+    for index in range(args.jobs):
+        due = now + 0.5 + index * 0.01
+        due_times.append(due)
+        app.get_scheduler().add_job(tick, "date", run_date=datetime.fromtimestamp(due), args=(index,))
+    done.wait(30)
+    report["dispatch_lag"] = summarize(lags)
+
+    report["reschedule"] = timed(lambda: app.update_scheduler_interval(random.randint(300, 7200), None), repeat=50)
+    report["next_run_time"] = timed(app.get_next_run_time, repeat=200)
+
+    # Whole pipeline for a scheduled test with an instant fake CLI: process
+    # spawn, output parsing, the DB write and rollups.
+    os.environ["FAKE_SPEEDTEST_DELAY"] = "0"
+    samples = []
+    for _ in range(args.tests):
+        started = time.perf_counter()
+        job, _ = app.submit_job(source="scheduled")
+        if wait_for_job(app, job) != "done":
+            report["pipeline_error"] = job["error"]
+            break
+        samples.append(time.perf_counter() - started)
+    report["scheduled_test_pipeline"] = summarize(samples)
+
+    # CPU burned by the scheduler and its background jobs while idle.
+    cpu = time.process_time()
+    time.sleep(args.idle)
+    report["idle_cpu_percent"] = (time.process_time() - cpu) / args.idle * 100
+    return report
+
+STAGES = {"routes": stage_routes, "db": stage_db, "scheduler": stage_scheduler}
+
+def run_stage(args):
+    # Child process: the environment already points at a throwaway database.
+    started = time.perf_counter()
+    sys.path.insert(0, ROOT_DIR)
+    import app
+    import_s = time.perf_counter() - started
+    app.create_app()
+    reset_cooldown(app)
+    report = STAGES[args.run_stage](app, args)
+    report["app_import_s"] = import_s
+    report["startup_ms"] = app.startup["timings"]
+    app.get_scheduler().shutdown(wait=False)
+    print(json.dumps(report))
+
+def spawn_stage(name, args, servers_url, rows=None):
+    with tempfile.TemporaryDirectory(prefix="speedtest-bench-") as workdir:
+        env = dict(
+            os.environ,
+            SPEEDTEST_DB=os.path.join(workdir, "speedtest.db"),
+            SPEEDTEST_BIN=FAKE_SPEEDTEST,
+            SPEEDTEST_SERVERS_URL=servers_url,
+            SPEEDTEST_LOG_LEVEL="WARNING",
+            PROBE_INTERVAL="0",
+            FAKE_SPEEDTEST_DELAY=str(args.fake_delay)
+        )
+        command = [
+            sys.executable, os.path.abspath(__file__), "--run-stage", name,
+            "--rows", str(rows or 0), "--concurrency", str(args.concurrency),
+            "--duration", str(args.duration), "--jobs", str(args.jobs),
+            "--tests", str(args.tests), "--idle", str(args.idle)
+        ]
+        completed = subprocess.run(command, env=env, cwd=workdir, stdout=subprocess.PIPE, text=True)
+        if completed.returncode != 0:
+            raise SystemExit(f"Stage {name} failed with exit code {completed.returncode}")
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def flatten(report, prefix=""):
+    for key, value in report.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from flatten(value, name + ".")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+def print_report(report, baseline):
+    previous = dict(flatten(baseline)) if baseline else {}
+    for name, value in flatten(report):
+        line = f"{name:<70} {value:>12.3f}"
+        if previous.get(name):
+            line += f"  {(value - previous[name]) / previous[name] * 100:+7.1f}%"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the speedtest app")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma-separated: " + ", ".join(STAGES))
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="row counts for the db stage")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients per route")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load per route")
+    parser.add_argument("--jobs", type=int, default=200, help="jobs for the dispatch lag measurement")
+    parser.add_argument("--tests", type=int, default=10, help="scheduled tests to run end to end")
+    parser.add_argument("--idle", type=float, default=5, help="seconds to measure idle CPU")
+    parser.add_argument("--fake-delay", type=float, default=1.0, help="FAKE_SPEEDTEST_DELAY for the stages")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="earlier --json report to compare against")
+    parser.add_argument("--run-stage", choices=list(STAGES), help=argparse.SUPPRESS)
+    parser.add_argument("--rows", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        run_stage(args)
+        return
+
+    sys.path.insert(0, BENCH_DIR)
+    import stub_servers
+    stub = stub_servers.start()
+    servers_url = stub_servers.servers_url(stub)
+
+    report = {}
+    for name in args.stages.split(","):
+        name = name.strip()
+        if name == "db":
+            for rows in (int(size) for size in args.sizes.split(",")):
+                print(f"Running db stage with {rows} rows...", file=sys.stderr)
+                report[f"db_{rows}"] = spawn_stage(name, args, servers_url, rows)
+        else:
+            print(f"Running {name} stage...", file=sys.stderr)
+            report[name] = spawn_stage(name, args, servers_url)
+    stub.shutdown()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
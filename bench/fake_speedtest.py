@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# Stand-in for the Ookla speedtest CLI. Accepts the flags app.py passes and
+# prints a result shaped like the real one, as a single JSON document
+# (--format=json) or as progress events followed by the result (jsonl).
+#
+# Environment:
+#   FAKE_SPEEDTEST_DELAY      seconds the whole test takes (default 1.0)
+#   FAKE_SPEEDTEST_FAIL_RATE  probability of failing, 0..1 (default 0)
+#   FAKE_SPEEDTEST_FAILURE    cli_error, no_result or hang (default cli_error)
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+DELAY = float(os.environ.get("FAKE_SPEEDTEST_DELAY", 1.0))
+FAIL_RATE = float(os.environ.get("FAKE_SPEEDTEST_FAIL_RATE", 0))
+FAILURE = os.environ.get("FAKE_SPEEDTEST_FAILURE", "cli_error")
+PROGRESS_STEPS = 4
+
+def option(name, default=None):
+    for index, arg in enumerate(sys.argv):
+        if arg == name and index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+        if arg.startswith(name + "="):
+            return arg.split("=", 1)[1]
+    return default
+
+def timestamp():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def emit(event):
+    print(json.dumps(event), flush=True)
+
+def fail(jsonl):
+    if FAILURE == "hang":
+        while True:
+            time.sleep(60)
+    if FAILURE == "no_result":
+        sys.exit(0)
+    message = "Cannot open socket: Timeout occurred in connect."
+    if jsonl:
+        emit({"type": "log", "timestamp": timestamp(), "message": message, "level": "error"})
+    else:
+        print(f"[error] {message}", file=sys.stderr)
+    sys.exit(2)
+
+def build_result(server_id, interface):
+    ping = random.gauss(12, 2)
+    download = random.gauss(12_000_000, 1_500_000)
+    upload = random.gauss(2_500_000, 300_000)
+    return {
+        "type": "result",
+        "timestamp": timestamp(),
+        "ping": {"jitter": abs(random.gauss(1.5, 0.5)), "latency": ping, "low": ping - 2, "high": ping + 3},
+        "download": {
+            "bandwidth": int(download),
+            "bytes": int(download * 10),
+            "elapsed": 10000,
+            "latency": {"iqm": ping + 15, "low": ping, "high": ping + 80, "jitter": 4.2}
+        },
+        "upload": {
+            "bandwidth": int(upload),
+            "bytes": int(upload * 8),
+            "elapsed": 8000,
+            "latency": {"iqm": ping + 30, "low": ping, "high": ping + 120, "jitter": 6.1}
+        },
+        "packetLoss": random.choice([0, 0, 0, 0.3]),
+        "isp": "Bench Networks",
+        "interface": {
+            "internalIp": "192.168.1.20",
+            "name": interface or "eth0",
+            "macAddr": "02:00:00:00:00:01",
+            "isVpn": False,
+            "externalIp": "203.0.113.7"
+        },
+        "server": {
+            "id": server_id,
+            "host": "speedtest.bench.invalid",
+            "port": 8080,
+            "name": "Bench Server",
+            "location": "Amsterdam",
+            "country": "Netherlands",
+            "ip": "198.51.100.1"
+        },
+        "result": {
+            "id": "%08x-0000-4000-8000-%012x" % (random.getrandbits(32), random.getrandbits(48)),
+            "url": "https://www.speedtest.net/result/c/%032x" % random.getrandbits(128),
+            "persisted": True
+        }
+    }
+
+def main():
+    jsonl = option("--format", "json") == "jsonl"
+    server_id = int(option("-s", option("--server-id", 12345)))
+    result = build_result(server_id, option("--interface"))
+    failing = random.random() < FAIL_RATE
+
+    if not jsonl:
+        time.sleep(DELAY)
+        if failing:
+            fail(jsonl)
+        emit(result)
+        return
+
+    emit({"type": "testStart", "timestamp": timestamp(), "isp": result["isp"],
+          "interface": result["interface"], "server": result["server"]})
+    for phase in ("ping", "download", "upload"):
+        for step in range(1, PROGRESS_STEPS + 1):
+            time.sleep(DELAY / (3 * PROGRESS_STEPS))
+            progress = step / PROGRESS_STEPS
+            if phase == "ping":
+                details = {"jitter": result["ping"]["jitter"], "latency": result["ping"]["latency"], "progress": progress}
+            else:
+                details = {
+                    "bandwidth": result[phase]["bandwidth"],
+                    "bytes": int(result[phase]["bytes"] * progress),
+                    "elapsed": int(result[phase]["elapsed"] * progress),
+                    "progress": progress
+                }
+            emit({"type": phase, "timestamp": timestamp(), phase: details})
+        if failing and phase == "download":
+            fail(jsonl)
+    emit(result)
+
+if __name__ == "__main__":
+    main()
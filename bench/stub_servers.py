@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# Local stand-in for the speedtest.net servers API. Point the app at it with
+# SPEEDTEST_SERVERS_URL=http://127.0.0.1:8099/api/js/servers
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def build_servers(count):
+    return [
+        {
+            "url": f"http://speedtest{index}.bench.invalid:8080/speedtest/upload.php",
+            "lat": "52.3667",
+            "lon": "4.9000",
+            "distance": index * 7,
+            "name": "Amsterdam",
+            "country": "Netherlands",
+            "cc": "NL",
+            "sponsor": f"Bench Hosting {index}",
+            "id": str(10000 + index),
+            "preferred": 0,
+            "https_functional": 1,
+            "host": f"speedtest{index}.bench.invalid:8080"
+        }
+        for index in range(1, count + 1)
+    ]
+
+def make_handler(servers, delay, status):
+    payload = json.dumps(servers).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if not self.path.startswith("/api/js/servers"):
+                self.send_error(404)
+                return
+            time.sleep(delay)
+            if status != 200:
+                self.send_error(status)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def start(port=0, count=10, delay=0.0, status=200):
+    # Serves from a daemon thread; returns the server so callers can read
+    # server.server_port and shut it down.
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(build_servers(count), delay, status))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def servers_url(server):
+    return f"http://127.0.0.1:{server.server_port}/api/js/servers?engine=js&limit=10&https_functional=true"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub speedtest.net servers API")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--count", type=int, default=10, help="servers in the catalog")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds before answering")
+    parser.add_argument("--status", type=int, default=200, help="HTTP status to answer with")
+    args = parser.parse_args()
+    server = start(args.port, args.count, args.delay, args.status)
+    print(f"Serving {args.count} servers at {servers_url(server)}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,34 @@
+import multiprocessing
+import os
+
+# Workers are separate processes sharing one SQLite database, so app.py must
+# coordinate through it: the sqlite lock backend serialises tests across
+# workers and elects the single worker that runs the scheduler.
+os.environ.setdefault("SPEEDTEST_LOCK_BACKEND", "sqlite")
+
+bind = os.environ.get("SPEEDTEST_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", min(multiprocessing.cpu_count() * 2 + 1, 8)))
+# Open /events streams each hold a thread for as long as the page is open.
+worker_class = "gthread"
+threads = int(os.environ.get("SPEEDTEST_THREADS", 8))
+timeout = 60
+graceful_timeout = 30
+# create_app() starts the scheduler and coordination threads, which must
+# happen in each worker rather than in the master before the fork.
+preload_app = False
+accesslog = "-"
+
+def migrate():
+    import app
+    app.init_db()
+
+def on_starting(server):
+    # Migrate once before any worker forks: an upgrade can rebuild rollups
+    # or vacuum for longer than a worker may take to boot. A child process
+    # does it so the master never imports app.py and hands its state
+    # (lease owner, pools) down to the workers.
+    process = multiprocessing.Process(target=migrate)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError("Database migration failed")